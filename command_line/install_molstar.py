@@ -57,12 +57,15 @@ def run(build_dir="../../../build",molstar_repo_dir="../../molstar"):
   dst_prefix = build_molstar
   files = [
     "src/apps/phenix-viewer/app.ts",
+    "src/apps/phenix-viewer/color-array.ts",
     "src/apps/phenix-viewer/favicon.ico",
     "src/apps/phenix-viewer/helpers.ts",
     "src/apps/phenix-viewer/index.html",
     "src/apps/phenix-viewer/index.ts",
     "src/apps/phenix-viewer/api.ts",
     "src/apps/phenix-viewer/phenix.ts",
+    "src/apps/phenix-viewer/transforms.ts",
+    "src/perf-tests/phenix-query-helper.ts",
     "src/phenix/server.js",
     "package.json",
     "webpack.config.js",
@@ -14,12 +14,15 @@ if adaptbx_dir is not None:
   dst_prefix = molstar_dir
   files = [
     "src/apps/phenix-viewer/app.ts",
+    "src/apps/phenix-viewer/color-array.ts",
     "src/apps/phenix-viewer/favicon.ico",
     "src/apps/phenix-viewer/helpers.ts",
     "src/apps/phenix-viewer/index.html",
     "src/apps/phenix-viewer/index.ts",
     "src/apps/phenix-viewer/api.ts",
     "src/apps/phenix-viewer/phenix.ts",
+    "src/apps/phenix-viewer/transforms.ts",
+    "src/perf-tests/phenix-query-helper.ts",
     "src/phenix/server.js",
     "package.json",
     "webpack.config.js",
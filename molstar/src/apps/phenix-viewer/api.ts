@@ -11,7 +11,9 @@
  */
 
 import { PhenixViewer } from './app';
-import { PhenixReference } from './helpers';
+import { colorsFromRgb, colorsFromValues } from './color-array';
+import { Color } from '../../mol-util/color';
+import { PhenixReference, PhenixStateChange, ModelFormat, ModelEncoding, decodeModelData, base64ToBytes } from './helpers';
 
 // Base class for handling JSON serialization and deserialization
 export class ApiClass {
@@ -28,7 +30,7 @@ export class ApiClass {
   }
 
   toJSON(): string {
-    return JSON.stringify(this.toDict(), null, 2);
+    return JSON.stringify(this.toDict());
   }
 
   toDict(): Record<string, any> {
@@ -53,18 +55,24 @@ export class ApiClass {
 export class ApiRequest extends ApiClass {
   name: string;
   data: ApiClass;
+  request_id: string | undefined; // Echoed back so responses match their requests
 
-  constructor(data: ApiClass) {
+  constructor(data: ApiClass, request_id?: string) {
     super("ApiRequest");
     this.name = data.constructor.name; // Automatically set the name from the data class
     this.data = data;
+    this.request_id = request_id;
   }
 
   toDict(): Record<string, any> {
-    return {
+    const dict: Record<string, any> = {
       name: this.data.className, // Include the data class name
       data: this.data.toDict(),
     };
+    if (this.request_id !== undefined) {
+      dict.request_id = this.request_id;
+    }
+    return dict;
   }
 
   static fromDict(data: any): ApiRequest {
@@ -77,17 +85,26 @@ export class ApiRequest extends ApiClass {
       'RawJS': RawJS,
       'RawJSAsync': RawJSAsync,
       'ApiRequest': ApiRequest,
+      'ApiBatch': ApiBatch,
       'MolstarState': MolstarState,
       'SelectionPoll': SelectionPoll,
       'MakeSelection': MakeSelection,
+      'MakeAtomSelection': MakeAtomSelection,
+      'SelectionCacheInfo': SelectionCacheInfo,
       'LoadModel': LoadModel,
+      'LoadCachedModel': LoadCachedModel,
+      'UpdateCoordinates': UpdateCoordinates,
+      'AppendFrames': AppendFrames,
+      'TrajectoryStatus': TrajectoryStatus,
+      'PlayTrajectory': PlayTrajectory,
       'ClearViewer': ClearViewer,
       'ResetView': ResetView,
       'Focus': Focus,
       'ToggleSelectionMode': ToggleSelectionMode,
       'SetPickingGranularity': SetPickingGranularity,
       'AddRepresentation': AddRepresentation,
-      'SetColor': SetColor
+      'SetColor': SetColor,
+      'SetColorArray': SetColorArray
     };
     // @ts-ignore
     const dataClass = classMap[data.name];
@@ -96,7 +113,32 @@ export class ApiRequest extends ApiClass {
     }
 
     const dataInstance = dataClass.fromDict(data.data);
-    return new ApiRequest(dataInstance);
+    return new ApiRequest(dataInstance, data.request_id);
+  }
+}
+
+// ApiBatch class for running several requests in one round trip
+export class ApiBatch extends ApiClass {
+  commands: any[]; // Serialized ApiRequest objects, run in order
+
+  constructor(commands: any[] = []) {
+    super("ApiBatch");
+    this.commands = commands;
+  }
+
+  async run(viewer: PhenixViewer) {
+    // Each output replaces its input, so the response mirrors the request
+    const outputs: any[] = [];
+    for (let i = 0; i < this.commands.length; i++) {
+      const request = ApiRequest.fromDict(this.commands[i]);
+      try {
+        await Promise.resolve(request.data.run(viewer));
+      } catch (error) {
+        throw new Error(`ApiBatch command ${i} (${request.data.className}) failed: ${error.message}`);
+      }
+      outputs.push(request.toDict());
+    }
+    this.commands = outputs;
   }
 }
 
@@ -147,6 +189,10 @@ export class MolstarState extends ApiClass {
   connection_id: string | undefined = undefined;
   has_synced: boolean = false;
   references: PhenixReference[] = []
+  // Starts at the page load time, so versions from an earlier page are older
+  version: number = Date.now(); // Output: bumped by every change to the state
+  since_version: number | null = null; // Input: return only the changes after this version
+  changes: PhenixStateChange[] | null = null; // Output, if since_version was given
 
   constructor(has_synced: boolean = false, references: PhenixReference[] = []) {
     super("MolstarState");
@@ -167,26 +213,46 @@ export class MolstarState extends ApiClass {
     //   then the molstar web app is sufficiently set up
     viewer.phenixState.connection_id = this.connection_id
     this.has_synced = viewer.phenixState.has_synced;
-    this.references = viewer.phenixState.references;
-    
+    this.version = viewer.phenixState.version;
+    if (this.since_version === null || this.since_version === undefined) {
+      // The whole tree
+      this.references = viewer.phenixState.references;
+    } else {
+      this.references = [];
+      this.changes = viewer.phenix.getStateChanges(this.since_version);
+    }
   }
 }
 
 
 export class SelectionPoll extends ApiClass {
+  columnar: boolean = false; // Input: return atom_columns instead of atom_records
+  ranges: boolean = false; // Input: return atom_ranges instead
   atom_records: any[]
+  atom_columns: { [key: string]: any[] }
+  atom_ranges: number[] | undefined // [start, stop) runs of atom indices in file order (i_seqs), flattened
+  ref_id: string | undefined // Output: the model the selected atoms belong to
 
   constructor(){
     super("SelectionPoll");
   }
   run(viewer: PhenixViewer) {
-    this.atom_records =  viewer.phenix.pollSelection()
+    this.ref_id = viewer.phenix.getRefIdForLoci(viewer.phenix.getSelectedLoci())
+    if (this.ranges) {
+      this.atom_ranges = viewer.phenix.pollSelectionRanges()
+    } else if (this.columnar) {
+      this.atom_columns = viewer.phenix.pollSelectionColumns()
+    } else {
+      this.atom_records =  viewer.phenix.pollSelection()
+    }
   }
 }
 
 export class MakeSelection extends ApiClass {
   pymol_sel: string;
   focus: boolean = true;
+  ref_id: string | null = null; // The model atom_ranges refer to
+  atom_ranges: number[] | null = null; // [start, stop) runs of atom indices (i_seqs), used instead of pymol_sel
 
   constructor(pymol_sel: string = '') {
     super("MakeSelection");
@@ -194,18 +260,71 @@ export class MakeSelection extends ApiClass {
   }
 
   run(viewer: PhenixViewer) {
-    const exp = viewer.parse("pymol", this.pymol_sel) 
+    if (this.atom_ranges) {
+      if (this.ref_id === null) throw new Error('MakeSelection with atom_ranges needs a ref_id');
+      viewer.phenix.selectAtomRanges(this.ref_id, this.atom_ranges, this.focus);
+      return;
+    }
+    const query = viewer.phenix.getPymolSelectionQuery(this.pymol_sel)
     let focus = this.focus
     if (this.pymol_sel == 'none') {
       focus = false
     }
-    viewer.phenix.selectFromSel(exp,focus);
+    viewer.phenix.selectFromQuery(query,focus);
+}
+}
+
+export class MakeAtomSelection extends ApiClass {
+  ref_id: string; // Application-wide identifier of a loaded model
+  indices: string; // base64 of little-endian uint32
+  n_atoms: number;
+  by: 'index' | 'id' = 'index'; // 0-based index in file order (i_seq), or atom serial (id)
+  focus: boolean = true;
+  n_selected: number | undefined; // Output
+
+  constructor(ref_id: string = 'default_ref', indices: string = '', n_atoms: number = 0) {
+    super("MakeAtomSelection");
+    this.ref_id = ref_id;
+    this.indices = indices;
+    this.n_atoms = n_atoms;
+  }
+
+  run(viewer: PhenixViewer) {
+    const indices = new Uint32Array(base64ToBytes(this.indices).buffer);
+    this.indices = ''; // Do not echo the indices back
+    if (indices.length !== this.n_atoms) {
+      throw new Error(`Expected ${this.n_atoms} atom indices, got ${indices.length}`);
+    }
+    this.n_selected = viewer.phenix.selectAtoms(this.ref_id, indices, this.by, this.focus);
+  }
 }
+
+export class SelectionCacheInfo extends ApiClass {
+  clear: boolean = false; // Input: empty the cache and reset the counts after reading them
+  hits: number = 0; // Outputs
+  misses: number = 0;
+  size: number = 0;
+  maxsize: number = 0;
+
+  constructor() {
+    super("SelectionCacheInfo");
+  }
+
+  run(viewer: PhenixViewer) {
+    const info = viewer.phenix.selectionCacheInfo(this.clear);
+    this.hits = info.hits;
+    this.misses = info.misses;
+    this.size = info.size;
+    this.maxsize = info.maxsize;
+  }
 }
 
 export class LoadModel extends ApiClass {
-  pdb_str: string; // Text of model in pdb format
+  pdb_str: string; // The model in 'format', as text or base64 according to 'encoding'
   ref_id: string; // Application-wide identifier
+  format: ModelFormat = 'pdb';
+  encoding: ModelEncoding = 'text';
+  content_hash: string | undefined = undefined; // If set, keep the data for LoadCachedModel
 
   constructor(ref_id: string = 'default_ref',pdb_str: string = '') {
     super("LoadModel");
@@ -213,9 +332,132 @@ export class LoadModel extends ApiClass {
     this.pdb_str = pdb_str;
   }
 
-  run(viewer: PhenixViewer) {
+  async run(viewer: PhenixViewer) {
     console.log("Running load model in js")
-    viewer.phenix.loadStructureFromPdbString(this.pdb_str,'pdb', 'model', this.ref_id);
+    const data = await decodeModelData(this.pdb_str, this.format, this.encoding);
+    this.pdb_str = ''; // Release the payload, and do not echo it back
+    // BinaryCIF is parsed by the mmcif trajectory provider
+    const format = this.format === 'bcif' ? 'mmcif' : this.format;
+    if (this.content_hash) {
+      viewer.phenix.cacheModelData(this.content_hash, data, format);
+    }
+    await viewer.phenix.loadStructureFromPdbString(data, format, 'model', this.ref_id);
+  }
+}
+
+export class LoadCachedModel extends ApiClass {
+  ref_id: string; // Application-wide identifier
+  content_hash: string; // The content_hash of a previous LoadModel
+  found: boolean = false; // Output: whether the data was cached and loaded
+
+  constructor(ref_id: string = 'default_ref', content_hash: string = '') {
+    super("LoadCachedModel");
+    this.ref_id = ref_id;
+    this.content_hash = content_hash;
+  }
+
+  async run(viewer: PhenixViewer) {
+    const cached = viewer.phenix.getCachedModelData(this.content_hash);
+    this.found = cached !== undefined;
+    if (cached) {
+      await viewer.phenix.loadStructureFromPdbString(cached.data, cached.format, 'model', this.ref_id);
+    }
+  }
+}
+
+export class UpdateCoordinates extends ApiClass {
+  ref_id: string; // Application-wide identifier of a loaded model
+  xyz: string; // base64 of little-endian float32 x,y,z per atom, in model order
+  n_atoms: number;
+
+  constructor(ref_id: string = 'default_ref', xyz: string = '', n_atoms: number = 0) {
+    super("UpdateCoordinates");
+    this.ref_id = ref_id;
+    this.xyz = xyz;
+    this.n_atoms = n_atoms;
+  }
+
+  async run(viewer: PhenixViewer) {
+    const xyz = new Float32Array(base64ToBytes(this.xyz).buffer);
+    this.xyz = ''; // Do not echo the coordinates back
+    if (xyz.length !== 3 * this.n_atoms) {
+      throw new Error(`Expected ${3 * this.n_atoms} coordinates, got ${xyz.length}`);
+    }
+    await viewer.phenix.updateCoordinates(this.ref_id, xyz);
+  }
+}
+
+export class AppendFrames extends ApiClass {
+  ref_id: string; // Application-wide identifier of a loaded model
+  xyz: string; // base64 of little-endian float32 x,y,z per atom, frame after frame
+  n_atoms: number;
+  n_frames: number;
+  capacity: number = 1024;
+  keep_frames: boolean = false;
+  complete: boolean = false;
+  restart: boolean = false; // Discard frames from a previous stream
+  buffered: number; // Output
+  total: number; // Output
+
+  constructor(ref_id: string = 'default_ref', xyz: string = '', n_atoms: number = 0, n_frames: number = 0) {
+    super("AppendFrames");
+    this.ref_id = ref_id;
+    this.xyz = xyz;
+    this.n_atoms = n_atoms;
+    this.n_frames = n_frames;
+  }
+
+  run(viewer: PhenixViewer) {
+    const xyz = new Float32Array(base64ToBytes(this.xyz).buffer);
+    this.xyz = ''; // Do not echo the frames back
+    if (xyz.length !== 3 * this.n_atoms * this.n_frames) {
+      throw new Error(`Expected ${3 * this.n_atoms * this.n_frames} coordinates, got ${xyz.length}`);
+    }
+    const trajectory = viewer.phenix.appendFrames(this.ref_id, xyz, this.n_atoms, this.n_frames, this.capacity, this.keep_frames, this.complete, this.restart);
+    this.buffered = trajectory.buffered;
+    this.total = trajectory.total;
+  }
+}
+
+export class TrajectoryStatus extends ApiClass {
+  ref_id: string;
+  buffered: number;
+  capacity: number;
+  total: number;
+  current: number;
+  playing: boolean;
+
+  constructor(ref_id: string = 'default_ref') {
+    super("TrajectoryStatus");
+    this.ref_id = ref_id;
+  }
+
+  run(viewer: PhenixViewer) {
+    const trajectory = viewer.trajectories.get(this.ref_id);
+    if (!trajectory) {
+      throw new Error(`No trajectory streamed for ref_id: ${this.ref_id}`);
+    }
+    this.buffered = trajectory.buffered;
+    this.capacity = trajectory.capacity;
+    this.total = trajectory.total;
+    this.current = trajectory.current;
+    this.playing = trajectory.playing;
+  }
+}
+
+export class PlayTrajectory extends ApiClass {
+  ref_id: string;
+  fps: number = 10;
+  loop: boolean = false;
+  play: boolean = true;
+
+  constructor(ref_id: string = 'default_ref') {
+    super("PlayTrajectory");
+    this.ref_id = ref_id;
+  }
+
+  run(viewer: PhenixViewer) {
+    viewer.phenix.playTrajectory(this.ref_id, this.fps, this.loop, this.play);
   }
 }
 
@@ -308,3 +550,47 @@ export class SetColor extends ApiClass {
     viewer.phenix.colorSelection(this.R, this.G, this.B)
   }
 }
+
+export class SetColorArray extends ApiClass {
+  ref_id: string; // Application-wide identifier of a loaded model
+  per: 'atom' | 'residue' = 'atom'; // in model order
+  n_values: number = 0;
+  values: string | null = null; // base64 of little-endian float32, colored by color_scale. NaN is missing
+  rgb: string | null = null; // base64 of r, g, b bytes per value, used instead of values
+  color_scale: string[] | string | null = null; // '#rrggbb' colors from low to high, or a molstar color list name
+  domain: [number, number] | null = null; // of color_scale, the range of values by default
+  missing_color: string = '#808080';
+  clear: boolean = false; // Restore the default coloring instead
+
+  constructor(ref_id: string = 'default_ref') {
+    super("SetColorArray");
+    this.ref_id = ref_id;
+  }
+
+  async run(viewer: PhenixViewer) {
+    if (this.clear) {
+      await viewer.phenix.colorByArray(this.ref_id, undefined);
+      return;
+    }
+    const missingColor = Color.fromHexStyle(this.missing_color);
+    let colors: Uint32Array;
+    let legend = undefined;
+    if (this.rgb) {
+      colors = colorsFromRgb(base64ToBytes(this.rgb));
+    } else if (this.values) {
+      const values = new Float32Array(base64ToBytes(this.values).buffer);
+      const scale = typeof this.color_scale === 'string' ? this.color_scale as any
+        : this.color_scale?.map(color => Color.fromHexStyle(color));
+      ({ colors, legend } = colorsFromValues(values, scale, this.domain ?? undefined, missingColor));
+    } else {
+      throw new Error('SetColorArray needs values or rgb');
+    }
+    if (colors.length !== this.n_values) {
+      throw new Error(`Expected ${this.n_values} colors, got ${colors.length}`);
+    }
+    // Do not echo the arrays back
+    this.values = null;
+    this.rgb = null;
+    await viewer.phenix.colorByArray(this.ref_id, colors, this.per, missingColor, legend);
+  }
+}
@@ -28,7 +28,7 @@ import { MolScriptBuilder as MS} from '../../mol-script/language/builder';
 import { Script } from '../../mol-script/script';
 import { parse } from '../../mol-script/transpile';
 import {  StructureSelectionQuery, StructureSelectionQueries } from '../../mol-plugin-state/helpers/structure-selection-query'
-import { TwoWayDictionary } from './helpers';
+import { TwoWayDictionary, PhenixTrajectory, PhenixEvent, PhenixStateChange, AtomSourceOrder } from './helpers';
 import { StructureProperties as Props, StructureProperties } from '../../mol-model/structure';
 import { VolumeStreaming } from '../../mol-plugin/behavior/dynamic/volume-streaming/behavior';
 import { StateSelection } from '../../mol-state';
@@ -42,6 +42,7 @@ import { Phenix } from './phenix';
 import { StructureRepresentation3D } from '../../mol-plugin-state/transforms/representation';
 import { CreateVolumeStreamingBehavior, InitVolumeStreaming } from '../../mol-plugin/behavior/dynamic/volume-streaming/transformers';
 import { ApiRequest, MolstarState } from './api';
+import { PhenixColorArrayThemeProvider } from './color-array';
 import { PluginContext } from '../../mol-plugin/context';
 
 
@@ -125,6 +126,18 @@ export class PhenixViewer {
     hasVolumes = false;
     isFocused = false;
     phenixState = new MolstarState();
+    stateChangeLog: PhenixStateChange[] = []; // Changes to phenixState, oldest first
+    stateChangeLogSize = 1000;
+    modelDataCache = new Map<string, { data: string | Uint8Array, format: string }>(); // content_hash: decoded model data
+    modelDataCacheSize = 8;
+    selectionQueryCache = new Map<string, StructureSelectionQuery>(); // pymol selection string: compiled query
+    selectionQueryCacheSize = 256;
+    selectionQueryCacheStats = { hits: 0, misses: 0 };
+    coordinateRefs = new Map<string, string>(); // phenix ref_id: ModelCoordinates transform ref
+    atomIdIndexCache = new WeakMap<object, Map<number, number>>(); // Model: {atom serial: atom index}
+    atomSourceOrderCache = new WeakMap<object, AtomSourceOrder>(); // Model: atom index <-> i_seq
+    trajectories = new Map<string, PhenixTrajectory>(); // phenix ref_id: streamed frames
+    eventSink: ((event: PhenixEvent) => void) | undefined = undefined; // Receives hover, click and selection events
     currentSelExpression: any;
     StateObjectSelector = StateObjectSelector;
     MS = MS;
@@ -141,6 +154,8 @@ export class PhenixViewer {
     constructor(public plugin: PluginUIContext) {
         // Save renderer defaults
         this.defaultRendererProps = { ...this.plugin.canvas3d!.props.renderer };
+        // Color theme used by SetColorArray
+        this.plugin.representation.structure.themes.colorThemeRegistry.add(PhenixColorArrayThemeProvider);
     }
     // All api functions are defined in a second file, 
     //   (phenix.ts) and bound to the viewer class in the .phenix. namespace
@@ -156,13 +171,27 @@ export class PhenixViewer {
         // Old, need to identify unused.
         cameraMode: Phenix.cameraMode.bind(this),
         postInit: Phenix.postInit.bind(this),
+        emitEvent: Phenix.emitEvent.bind(this),
         loadStructureFromPdbString: Phenix.loadStructureFromPdbString.bind(this),
+        cacheModelData: Phenix.cacheModelData.bind(this),
+        updateCoordinates: Phenix.updateCoordinates.bind(this),
+        colorByArray: Phenix.colorByArray.bind(this),
+        appendFrames: Phenix.appendFrames.bind(this),
+        playTrajectory: Phenix.playTrajectory.bind(this),
+        getCachedModelData: Phenix.getCachedModelData.bind(this),
         generateUniqueKey: Phenix.generateUniqueKey.bind(this),
         //getState: Phenix.getState.bind(this),
         setState: Phenix.setState.bind(this),
         updateFromExternal: Phenix.updateFromExternal.bind(this),
+        recordStateChange: Phenix.recordStateChange.bind(this),
+        getStateChanges: Phenix.getStateChanges.bind(this),
         getSel: Phenix.getSel.bind(this),
         pollSelection: Phenix.pollSelection.bind(this),
+        pollSelectionColumns: Phenix.pollSelectionColumns.bind(this),
+        pollSelectionRanges: Phenix.pollSelectionRanges.bind(this),
+        getPymolSelectionQuery: Phenix.getPymolSelectionQuery.bind(this),
+        selectionCacheInfo: Phenix.selectionCacheInfo.bind(this),
+        getRefIdForLoci: Phenix.getRefIdForLoci.bind(this),
         focusSelected: Phenix.focusSelected.bind(this),
         toggleSelectionMode: Phenix.toggleSelectionMode.bind(this),
         colorSelection: Phenix.colorSelection.bind(this),
@@ -180,20 +209,30 @@ export class PhenixViewer {
         queryFromExpression: Phenix.queryFromExpression.bind(this),
         selectFromQuery: Phenix.selectFromQuery.bind(this),
         selectFromSel: Phenix.selectFromSel.bind(this),
+        selectAtoms: Phenix.selectAtoms.bind(this),
+        selectAtomRanges: Phenix.selectAtomRanges.bind(this),
+        lociFromAtomRanges: Phenix.lociFromAtomRanges.bind(this),
+        lociFromAtomIndices: Phenix.lociFromAtomIndices.bind(this),
+        atomIdIndex: Phenix.atomIdIndex.bind(this),
+        atomSourceOrder: Phenix.atomSourceOrder.bind(this),
         getLocations: Phenix.getLocations.bind(this),
         getLociStats: Phenix.getLociStats.bind(this),
         setTransparencyQuery: Phenix.setTransparencyQuery.bind(this),
 
 
     };
-    async process_request(data: string): Promise<any> {
+    async process_request(data: string | Record<string, any>, timing?: Record<string, number>): Promise<any> {
+        // timing, if given, receives the run_start and run_end timestamps
+        const now = () => performance.timeOrigin + performance.now();
         try {
-            // Assume Request.fromJSON is defined elsewhere
-            const request = ApiRequest.fromJSON(data);
+            // Accept the request as json text or as an already parsed object
+            const request = typeof data === 'string' ? ApiRequest.fromJSON(data) : ApiRequest.fromDict(data);
 
             // Process the request (handle both sync and async cases)
+            if (timing) timing.run_start = now();
             await Promise.resolve(request.data.run(this));
-            return request.toJSON();  // Return the successful output
+            if (timing) timing.run_end = now();
+            return request.toDict();  // Return the successful output, encoded once by the caller
         } catch (error) {
             // Return an error message if something went wrong
             return { error: error.message || 'Unknown error in PhenixViewer process_request()' };
@@ -0,0 +1,125 @@
+/*
+ * Phenix specific color theme.
+ *
+ * The 'phenix-color-array' theme colors a structure with one color per atom
+ * or per residue, as sent by SetColorArray. Atoms are in file order (i_seq)
+ * and residues in the order of their first atom (the residue groups of the
+ * model in Python), not in molstar's sorted order. The colors are
+ * computed once when the call arrives (from values and a continuous color
+ * scale, or from rgb bytes) and kept in the theme parameters, so the theme
+ * itself is a lookup.
+ */
+
+import { Bond, Model, StructureElement, Unit } from '../../mol-model/structure';
+import { Location } from '../../mol-model/location';
+import { ColorTheme, LocationColor } from '../../mol-theme/color';
+import { ThemeDataContext } from '../../mol-theme/theme';
+import { Color } from '../../mol-util/color';
+import { ColorListEntry } from '../../mol-util/color/color';
+import { ColorListName } from '../../mol-util/color/lists';
+import { ColorScale } from '../../mol-util/color/scale';
+import { ScaleLegend } from '../../mol-util/legend';
+import { ParamDefinition as PD } from '../../mol-util/param-definition';
+
+export const DefaultColorScale: ColorListEntry[] = [Color(0x0000ff), Color(0xffffff), Color(0xff0000)]; // blue-white-red
+
+export const PhenixColorArrayThemeParams = {
+    colors: PD.Value<Uint32Array | undefined>(undefined, { isHidden: true }), // A Color per atom or residue
+    per: PD.Select('atom', PD.arrayToOptions(['atom', 'residue'] as const)),
+    missingColor: PD.Color(Color(0x808080)),
+    legend: PD.Value<ScaleLegend | undefined>(undefined, { isHidden: true }),
+};
+export type PhenixColorArrayThemeParams = typeof PhenixColorArrayThemeParams;
+
+export function colorsFromValues(values: Float32Array, scale: ColorListEntry[] | ColorListName = DefaultColorScale, domain?: [number, number], missingColor: Color = Color(0x808080)) {
+    // Map each value through a continuous color scale, NaN to missingColor
+    if (!domain) {
+        let min = Infinity, max = -Infinity;
+        for (let i = 0; i < values.length; i++) {
+            const v = values[i];
+            if (v < min) min = v;
+            if (v > max) max = v;
+        }
+        domain = min <= max ? [min, max] : [0, 1];
+    }
+    const colorScale = ColorScale.create({ listOrName: scale, domain });
+    const colors = new Uint32Array(values.length);
+    for (let i = 0; i < values.length; i++) {
+        const v = values[i];
+        colors[i] = Number.isNaN(v) ? missingColor : colorScale.color(v);
+    }
+    return { colors, legend: colorScale.legend };
+}
+
+export function colorsFromRgb(rgb: Uint8Array): Uint32Array {
+    // r, g, b bytes per atom or residue
+    const colors = new Uint32Array(rgb.length / 3);
+    for (let i = 0, j = 0; i < colors.length; i++, j += 3) {
+        colors[i] = Color.fromRgb(rgb[j], rgb[j + 1], rgb[j + 2]);
+    }
+    return colors;
+}
+
+const residueOrderCache = new WeakMap<Model, Int32Array>();
+
+function residueOrder(model: Model): Int32Array {
+    // Residue index: rank of the residue by its first atom in file order
+    let order = residueOrderCache.get(model);
+    if (!order) {
+        const { residueAtomSegments, atomSourceIndex } = model.atomicHierarchy;
+        const { offsets, count } = residueAtomSegments;
+        const firstSource = new Int32Array(count);
+        for (let r = 0; r < count; r++) {
+            let first = atomSourceIndex.value(offsets[r]);
+            for (let i = offsets[r] + 1; i < offsets[r + 1]; i++) {
+                first = Math.min(first, atomSourceIndex.value(i));
+            }
+            firstSource[r] = first;
+        }
+        const byFirst = Int32Array.from(firstSource.keys()).sort((a, b) => firstSource[a] - firstSource[b]);
+        order = new Int32Array(count);
+        for (let k = 0; k < count; k++) order[byFirst[k]] = k;
+        residueOrderCache.set(model, order);
+    }
+    return order;
+}
+
+export function PhenixColorArrayTheme(ctx: ThemeDataContext, props: PD.Values<PhenixColorArrayThemeParams>): ColorTheme<PhenixColorArrayThemeParams> {
+    const { colors, missingColor } = props;
+    const perResidue = props.per === 'residue';
+
+    function elementColor(unit: Unit, element: number): Color {
+        if (!colors || !Unit.isAtomic(unit)) return missingColor;
+        const { residueAtomSegments, atomSourceIndex } = unit.model.atomicHierarchy;
+        const index = perResidue ? residueOrder(unit.model)[residueAtomSegments.index[element]] : atomSourceIndex.value(element);
+        return index < colors.length ? colors[index] as Color : missingColor;
+    }
+
+    const color: LocationColor = (location: Location): Color => {
+        if (StructureElement.Location.is(location)) {
+            return elementColor(location.unit, location.element);
+        } else if (Bond.isLocation(location)) {
+            return elementColor(location.aUnit, location.aUnit.elements[location.aIndex]);
+        }
+        return missingColor;
+    };
+
+    return {
+        factory: PhenixColorArrayTheme,
+        granularity: 'group',
+        color,
+        props,
+        description: 'Colors from Phenix, per atom or residue.',
+        legend: props.legend,
+    };
+}
+
+export const PhenixColorArrayThemeProvider: ColorTheme.Provider<PhenixColorArrayThemeParams, 'phenix-color-array'> = {
+    name: 'phenix-color-array',
+    label: 'Phenix Color Array',
+    category: ColorTheme.Category.Misc,
+    factory: PhenixColorArrayTheme,
+    getParams: () => PhenixColorArrayThemeParams,
+    defaultValues: PD.getDefaultValues(PhenixColorArrayThemeParams),
+    isApplicable: (ctx: ThemeDataContext) => !!ctx.structure,
+};
@@ -1,6 +1,6 @@
 
 import * as Expression from '../../mol-script/language/expression';
-import { StructureSelection, StructureProperties } from '../../mol-model/structure';
+import { Model, StructureSelection, StructureProperties, StructureElement, Unit } from '../../mol-model/structure';
 import { Queries } from '../../mol-model/structure';
 import { Location } from '../../mol-model/structure/structure/element/location';
 import { Loci } from '../../mol-model/loci';
@@ -33,6 +33,37 @@ export function getLocationArray(loci: any): Location[] {
     return locationArray;
 }
 
+// Model transport
+
+export type ModelFormat = 'pdb' | 'mmcif' | 'bcif';
+export type ModelEncoding = 'text' | 'base64' | 'gzip'; // gzip: base64 of gzipped bytes
+
+export function base64ToBytes(b64: string): Uint8Array {
+    const binary = atob(b64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0, _i = binary.length; i < _i; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+export async function gunzipBytes(bytes: Uint8Array): Promise<Uint8Array> {
+    // Native browser decompression, streamed
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+export async function decodeModelData(payload: string, format: ModelFormat, encoding: ModelEncoding): Promise<string | Uint8Array> {
+    // Returns text for text formats, and bytes for BinaryCIF
+    if (encoding === 'text') return payload;
+    let bytes = base64ToBytes(payload);
+    if (encoding === 'gzip') {
+        bytes = await gunzipBytes(bytes);
+    }
+    if (format === 'bcif') return bytes;
+    return new TextDecoder().decode(bytes);
+}
+
 export const locationAttrs: { [key: string]: (loc: Location) => any } = {
     //'entity_id': StructureProperties.entity.id,
     'auth_asym_id': StructureProperties.chain.auth_asym_id,
@@ -49,8 +80,128 @@ export const locationAttrs: { [key: string]: (loc: Location) => any } = {
 
     'label_alt_id': StructureProperties.atom.label_alt_id,
     'id': StructureProperties.atom.id,
+    // Row in the file the model was loaded from, which is its i_seq in Python
+    'source_index': (loc: Location) => loc.unit.model.atomicHierarchy.atomSourceIndex.value(loc.element),
 };
 
+export function phenixRecordFromLocation(location: Location): { [key: string]: any } {
+    const record: { [key: string]: any } = {};
+    for (const key in locationAttrs) {
+        record[key] = locationAttrs[key](location);
+    }
+    return record;
+}
+
+// An interaction event pushed from the viewer to Python
+export type PhenixEventName = 'hover' | 'click' | 'selection';
+export interface PhenixEvent {
+    event: PhenixEventName;
+    time: number;
+    data: { [key: string]: any };
+}
+
+// One change to phenixState. 'add' inserts a reference, structure, component
+//   or representation under its parent; 'reset' empties the state.
+export type PhenixStateChangeKind = 'reference' | 'structure' | 'component' | 'representation';
+export interface PhenixStateChange {
+    version: number; // phenixState.version after the change
+    op: 'add' | 'reset';
+    kind?: PhenixStateChangeKind;
+    parent?: string; // phenixKey of the parent
+    data?: { [key: string]: any };
+}
+
+// molstar sorts atom_site by entity and chain, so its atom indices are not
+//   the order of the atoms in the file, which is the i_seq order of the
+//   model sent from Python. atomSourceIndex maps the first to the second.
+export interface AtomSourceOrder {
+    sourceIndex: Int32Array; // Atom index: source index (i_seq)
+    atomIndex: Int32Array; // Source index: atom index, -1 if none
+    // Maximal segments of atoms consecutive in both orders, sorted by atom
+    //   index, and their indices sorted by source index. Runs of atoms are
+    //   mapped segment by segment, in O(runs + segments) rather than O(atoms).
+    segmentAtomStart: Int32Array;
+    segmentSourceStart: Int32Array;
+    segmentLength: Int32Array;
+    segmentsBySource: Int32Array;
+}
+
+export function buildAtomSourceOrder(model: Model): AtomSourceOrder {
+    const column = model.atomicHierarchy.atomSourceIndex;
+    const atomCount = model.atomicHierarchy.atoms._rowCount;
+    const sourceIndex = new Int32Array(atomCount);
+    let sourceCount = 0;
+    for (let i = 0; i < atomCount; i++) {
+        const source = column.value(i);
+        sourceIndex[i] = source;
+        if (source >= sourceCount) sourceCount = source + 1;
+    }
+    const atomIndex = new Int32Array(sourceCount).fill(-1);
+    for (let i = 0; i < atomCount; i++) {
+        atomIndex[sourceIndex[i]] = i;
+    }
+    const starts: number[] = [];
+    for (let i = 0; i < atomCount; i++) {
+        if (i === 0 || sourceIndex[i] !== sourceIndex[i - 1] + 1) starts.push(i);
+    }
+    const n = starts.length;
+    const segmentAtomStart = Int32Array.from(starts);
+    const segmentSourceStart = new Int32Array(n);
+    const segmentLength = new Int32Array(n);
+    for (let k = 0; k < n; k++) {
+        segmentSourceStart[k] = sourceIndex[starts[k]];
+        segmentLength[k] = (k + 1 < n ? starts[k + 1] : atomCount) - starts[k];
+    }
+    const segmentsBySource = Int32Array.from(starts.keys()).sort((a, b) => segmentSourceStart[a] - segmentSourceStart[b]);
+    return { sourceIndex, atomIndex, segmentAtomStart, segmentSourceStart, segmentLength, segmentsBySource };
+}
+
+export function mergeRuns(runs: [number, number][]): number[] {
+    // Sort [start, stop) runs and merge those that overlap or touch, flattened
+    //   as [start0, stop0, start1, stop1, ...]
+    runs.sort((a, b) => a[0] - b[0]);
+    const flat: number[] = [];
+    for (const [start, stop] of runs) {
+        const n = flat.length;
+        if (n > 0 && start <= flat[n - 1]) {
+            flat[n - 1] = Math.max(flat[n - 1], stop);
+        } else {
+            flat.push(start, stop);
+        }
+    }
+    return flat;
+}
+
+export function mapAtomRuns(ranges: ArrayLike<number>, order: AtomSourceOrder, to: 'source' | 'atom'): number[] {
+    // Map flattened [start, stop) runs from atom indices to source indices,
+    //   or back, splitting them where they cross segments. The result is
+    //   sorted and merged again, as the segments are in a different order.
+    const toSource = to === 'source';
+    const from = toSource ? order.segmentAtomStart : order.segmentSourceStart;
+    const onto = toSource ? order.segmentSourceStart : order.segmentAtomStart;
+    const length = order.segmentLength;
+    const sorted = toSource ? undefined : order.segmentsBySource;
+    const n = from.length;
+    const runs: [number, number][] = [];
+    for (let r = 0; r < ranges.length; r += 2) {
+        const start = ranges[r], stop = ranges[r + 1];
+        // The last segment starting at or before start
+        let lo = 0, hi = n - 1;
+        while (lo < hi) {
+            const mid = (lo + hi + 1) >> 1;
+            if (from[sorted ? sorted[mid] : mid] <= start) lo = mid; else hi = mid - 1;
+        }
+        for (let p = lo; p < n; p++) {
+            const k = sorted ? sorted[p] : p;
+            const segmentStart = from[k];
+            if (segmentStart >= stop) break;
+            const s = Math.max(start, segmentStart), e = Math.min(stop, segmentStart + length[k]);
+            if (s < e) runs.push([onto[k] + s - segmentStart, onto[k] + e - segmentStart]);
+        }
+    }
+    return mergeRuns(runs);
+}
+
 export function phenixSelFromLoci(loci: Loci): any {
     const locations = getLocationArray(loci);
     const result = locations.map((loc: Location) => {
@@ -67,6 +218,73 @@ export function phenixSelFromLoci(loci: Loci): any {
 }
   
 
+export function phenixColumnsFromLoci(loci: Loci): { [key: string]: any[] } {
+    // Same attributes as phenixSelFromLoci, as one array per attribute
+    const keys = Object.keys(locationAttrs);
+    const funcs = keys.map(key => locationAttrs[key]);
+    const arrays: any[][] = keys.map(() => []);
+    if (!Loci.isEmpty(loci) && StructureElement.Loci.is(loci)) {
+        const location = Location.create(loci.structure);
+        for (const e of loci.elements) {
+            const { unit, indices } = e;
+            location.unit = unit;
+            const { elements } = unit;
+            for (let i = 0, _i = OrderedSet.size(indices); i < _i; i++) {
+                location.element = elements[OrderedSet.getAt(indices, i)];
+                for (let k = 0; k < funcs.length; k++) {
+                    arrays[k].push(funcs[k](location));
+                }
+            }
+        }
+    }
+    const columns: { [key: string]: any[] } = {};
+    keys.forEach((key, k) => columns[key] = arrays[k]);
+    return columns;
+}
+
+export function phenixRangesFromLoci(loci: Loci, sourceOrder: (model: Model) => AtomSourceOrder): number[] {
+    // The atoms of the loci as sorted, disjoint [start, stop) runs of source
+    //   indices (i_seqs), flattened: [start0, stop0, start1, stop1, ...].
+    //   Whole chains, residue ranges and ligands are one run each. Runs are
+    //   found in atom index order, then mapped to source order per model.
+    const modelRuns = new Map<Model, [number, number][]>();
+    if (!Loci.isEmpty(loci) && StructureElement.Loci.is(loci)) {
+        for (const { unit, indices } of loci.elements) {
+            const { elements } = unit;
+            let runs = modelRuns.get(unit.model);
+            if (!runs) modelRuns.set(unit.model, runs = []);
+            const size = OrderedSet.size(indices);
+            if (size === 0) continue;
+            if (OrderedSet.isInterval(indices)) {
+                const min = OrderedSet.min(indices), max = OrderedSet.max(indices);
+                if (elements[max] - elements[min] === max - min) {
+                    runs.push([elements[min], elements[max] + 1]);
+                    continue;
+                }
+            }
+            let start: number = elements[OrderedSet.getAt(indices, 0)], stop = start + 1;
+            for (let i = 1; i < size; i++) {
+                const element = elements[OrderedSet.getAt(indices, i)];
+                if (element === stop) {
+                    stop++;
+                } else {
+                    runs.push([start, stop]);
+                    start = element;
+                    stop = element + 1;
+                }
+            }
+            runs.push([start, stop]);
+        }
+    }
+    // Units are not in atom order, and symmetry copies repeat atoms
+    const sourceRuns: [number, number][] = [];
+    modelRuns.forEach((runs, model) => {
+        const flat = mapAtomRuns(mergeRuns(runs), sourceOrder(model), 'source');
+        for (let i = 0; i < flat.length; i += 2) sourceRuns.push([flat[i], flat[i + 1]]);
+    });
+    return mergeRuns(sourceRuns);
+}
+
 export function queryFromLoci(this:any, loci: Loci): SelectionQuery {
     // deprecate
     const locations = getLocationArray(loci);
@@ -258,6 +476,55 @@ export interface PhenixSelection {
     }
   }
   
+export class PhenixTrajectory {
+    // Frames streamed for one model, buffered for playback
+    frames: Float32Array[] = []; // Buffered frames, frames[0] has index 'offset'
+    offset = 0; // Index of frames[0] (frames before it were played and dropped)
+    current = -1; // Index of the frame shown
+    capacity: number;
+    keepFrames: boolean; // Keep played frames (allows looping), else drop them
+    complete = false; // No more frames will be appended
+    playing = false;
+    fps = 10;
+    loop = false;
+
+    constructor(capacity: number, keepFrames: boolean) {
+        this.capacity = capacity;
+        this.keepFrames = keepFrames;
+    }
+
+    get buffered() {
+        return this.frames.length;
+    }
+
+    get total() {
+        return this.offset + this.frames.length;
+    }
+
+    append(xyz: Float32Array, nAtoms: number, nFrames: number) {
+        if (this.frames.length + nFrames > this.capacity) {
+            throw new Error(`Trajectory buffer overflow: ${this.frames.length} + ${nFrames} frames > capacity ${this.capacity}`);
+        }
+        const frameLength = 3 * nAtoms;
+        for (let i = 0; i < nFrames; i++) {
+            this.frames.push(xyz.subarray(i * frameLength, (i + 1) * frameLength));
+        }
+    }
+
+    frameAt(index: number): Float32Array | undefined {
+        return this.frames[index - this.offset];
+    }
+
+    dropPlayed() {
+        if (this.keepFrames) return;
+        const nPlayed = this.current - this.offset;
+        if (nPlayed > 0) {
+            this.frames.splice(0, nPlayed);
+            this.offset += nPlayed;
+        }
+    }
+}
+
 // End 'Dataclasses'
 
 
@@ -459,58 +726,104 @@ export namespace QueryHelper {
     }
 
 
-    // New function that prefers label
-    export function getMolstarQuery(query: SelectionQuery, contextData: any): Expression.Expression {
-        // console.log('query:');
-        // console.log(JSON.stringify(query));
-        const selections: any = [];
-
-        query.selections.forEach(param => {
-            const selection: any = {};
-
-            Object.keys(param).forEach(keyword => {
-                const conditions = param[keyword].ops;
-                // Map keyword to test name
-                const testName = mapKeywordToTestName(keyword);
-
-
-                selection[`${testName}Test`] = (l: any) => {
-                    return conditions.every(cond => {
-                        const operator = cond.op;
-                        const value = cond.value;
-
-                        // Handle wildcard
-                        if (value === '*') {
-                            return true;
-                        }
-                        // console.log(keyword);
-                        const structureFunction = getStructurePropertyFunction(keyword);
-
-                        const elementValue = structureFunction(l.element);
-                        switch (operator) {
-                            case '==':
-                                return elementValue === value;
-                            case '>=':
-                                return elementValue >= value;
-                            case '<=':
-                                return elementValue <= value;
-                            default:
-                                return false;
-                        }
-                        
-                    });
-                };
-            });
-            // console.log('Current selection:', selection); // debug
-            selections.push(selection);
-        });
+    // A compiled test of one location, with its property getters resolved
+    type LocationTest = (l: StructureElement.Location) => boolean;
+    type Level = 'chain' | 'residue' | 'atom';
 
-        const atmGroupsQueries: any[] = [];
-        selections.forEach((selection: any) => {
-            atmGroupsQueries.push(Queries.generators.atoms(selection));
-        });
+    function compileCondition(keyword: string, cond: Condition): LocationTest {
+        const getter = getStructurePropertyFunction(keyword);
+        if (!getter) {
+            throw new Error(`Unknown selection keyword: ${keyword}`);
+        }
+        const value = cond.value;
+        switch (cond.op) {
+            case '==': return l => getter(l) === value;
+            case '>=': return l => getter(l) >= value;
+            case '<=': return l => getter(l) <= value;
+            case '>': return l => getter(l) > value;
+            case '<': return l => getter(l) < value;
+            default: return l => false;
+        }
+    }
 
-        return Queries.combinators.merge(atmGroupsQueries);
+    function allOf(tests: LocationTest[]): LocationTest | undefined {
+        if (tests.length === 0) return undefined;
+        if (tests.length === 1) return tests[0];
+        if (tests.length === 2) {
+            const [a, b] = tests;
+            return l => a(l) && b(l);
+        }
+        return l => {
+            for (let i = 0, _i = tests.length; i < _i; i++) {
+                if (!tests[i](l)) return false;
+            }
+            return true;
+        };
+    }
+
+    export function compileSelection(selection: Selection): { [level in Level]: LocationTest | undefined } {
+        // Group the conditions of all keywords by the level they apply to.
+        //   Wildcards always pass, so they are dropped here.
+        const tests: { [level in Level]: LocationTest[] } = { chain: [], residue: [], atom: [] };
+        for (const keyword of Object.keys(selection)) {
+            const testName = mapKeywordToTestName(keyword);
+            const level: Level = testName === 'chain' || testName === 'residue' ? testName : 'atom';
+            for (const cond of selection[keyword].ops) {
+                if (cond.value === '*') continue;
+                tests[level].push(compileCondition(keyword, cond));
+            }
+        }
+        return { chain: allOf(tests.chain), residue: allOf(tests.residue), atom: allOf(tests.atom) };
+    }
+
+    function unitChainTest(chainTest: LocationTest) {
+        // A unit holds a contiguous range of the model's chains, and is
+        //   skipped when none of them passes. The test runs once per model
+        //   chain: results are kept per model (1 pass, -1 fail).
+        const results = new WeakMap<object, Int8Array>();
+        const probe = StructureElement.Location.create(void 0);
+        return (ctx: any) => {
+            const unit: Unit = ctx.element.unit;
+            if (!Unit.isAtomic(unit)) return true;
+            const { chainAtomSegments } = unit.model.atomicHierarchy;
+            let modelResults = results.get(unit.model);
+            if (!modelResults) {
+                modelResults = new Int8Array(chainAtomSegments.count);
+                results.set(unit.model, modelResults);
+            }
+            const elements = unit.elements;
+            const first = chainAtomSegments.index[elements[0]];
+            const last = chainAtomSegments.index[elements[elements.length - 1]];
+            probe.structure = ctx.element.structure;
+            probe.unit = unit;
+            for (let c = first; c <= last; c++) {
+                if (modelResults[c] === 0) {
+                    probe.element = chainAtomSegments.offsets[c];
+                    modelResults[c] = chainTest(probe) ? 1 : -1;
+                }
+                if (modelResults[c] === 1) return true;
+            }
+            return false;
+        };
+    }
+
+    export function getMolstarQuery(query: SelectionQuery, contextData: any): Expression.Expression {
+        // Each selection is compiled once: getters and operators are resolved
+        //   up front, and chain and residue conditions are tested per unit,
+        //   chain and residue rather than per atom.
+        const atmGroupsQueries: any[] = [];
+        for (const selection of query.selections) {
+            const { chain, residue, atom } = compileSelection(selection);
+            const params: any = {};
+            if (chain) {
+                params.unitTest = unitChainTest(chain);
+                params.chainTest = (ctx: any) => chain(ctx.element);
+            }
+            if (residue) params.residueTest = (ctx: any) => residue(ctx.element);
+            if (atom) params.atomTest = (ctx: any) => atom(ctx.element);
+            atmGroupsQueries.push(Queries.generators.atoms(params));
+        }
+        return Queries.combinators.merge(atmGroupsQueries) as any;
     }
 
 
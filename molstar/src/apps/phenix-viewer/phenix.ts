@@ -1,5 +1,6 @@
-import { Loci } from '../../mol-model/loci';
-import { StructureElement } from '../../mol-model/structure';
+import { EmptyLoci, Loci } from '../../mol-model/loci';
+import { Model, Structure, StructureElement, Unit } from '../../mol-model/structure';
+import { OrderedSet, SortedArray } from '../../mol-data/int';
 import { clearStructureOverpaint } from '../../mol-plugin-state/helpers/structure-overpaint';
 import { StructureQueryHelper } from '../../mol-plugin-state/helpers/structure-query';
 import { StructureComponentManager } from '../../mol-plugin-state/manager/structure/component';
@@ -9,9 +10,14 @@ import { Color } from '../../mol-util/color';
 import { ParamDefinition } from '../../mol-util/param-definition';
 import { PhenixViewer } from './app';
 import { MolstarState } from './api';
-import { getLocationArray, phenixSelFromLoci, TwoWayDictionary} from './helpers';
-import {  PhenixReferenceClass, PhenixStructureClass, PhenixComponentClass, PhenixRepresentationClass} from './helpers';
+import { getLocationArray, phenixSelFromLoci, phenixColumnsFromLoci, phenixRangesFromLoci, phenixRecordFromLocation, TwoWayDictionary} from './helpers';
+import { AtomSourceOrder, buildAtomSourceOrder, mapAtomRuns } from './helpers';
+import { PhenixEvent, PhenixEventName, PhenixStateChange, PhenixStateChangeKind } from './helpers';
+import {  PhenixReferenceClass, PhenixStructureClass, PhenixComponentClass, PhenixRepresentationClass, PhenixTrajectory} from './helpers';
 import { StructureSelectionQuery } from '../../mol-plugin-state/helpers/structure-selection-query';
+import { ModelCoordinates } from './transforms';
+import { PhenixColorArrayThemeProvider } from './color-array';
+import { ScaleLegend } from '../../mol-util/legend';
 
 
 // @ts-ignore
@@ -24,32 +30,61 @@ export namespace Phenix {
         }
     }
     
-    export function postInit(this: PhenixViewer) {
-        // subscribe hover
+    export function postInit(this: PhenixViewer, sink?: (event: PhenixEvent) => void) {
+        // Push interaction events to sink (the server, which throttles them
+        //   and forwards them to Python)
+        if (sink) this.eventSink = sink;
+
+        // subscribe hover, only emitting when the hovered atom changes
+        let lastHover: string | undefined = undefined;
         this.plugin.behaviors.interaction.hover.subscribe(ev => {
+            let atom = null;
+            let ref_id = undefined;
             if (StructureElement.Loci.is(ev.current.loci)) {
-                // console.log('hover');
                 const l = StructureElement.Loci.getFirstLocation(ev.current.loci);
                 if (l) {
-                    // Hover related logic...
+                    atom = phenixRecordFromLocation(l);
+                    ref_id = this.phenix.getRefIdForLoci(ev.current.loci);
                 }
             }
+            const key = JSON.stringify([ref_id, atom]);
+            if (key === lastHover) return;
+            lastHover = key;
+            this.phenix.emitEvent('hover', { ref_id, atom });
         });
 
         // subscribe click
         this.plugin.behaviors.interaction.click.subscribe(ev => {
             if (StructureElement.Loci.is(ev.current.loci)) {
-                console.log('click');
                 const l = StructureElement.Loci.getFirstLocation(ev.current.loci);
                 if (l) {
-                    // Click related logic...
                     this.isFocused = true;
+                    const ref_id = this.phenix.getRefIdForLoci(ev.current.loci);
+                    this.phenix.emitEvent('click', { ref_id, atom: phenixRecordFromLocation(l), button: ev.button });
                 }
             }
         });
+
+        // subscribe selection changes
+        this.plugin.managers.structure.selection.events.changed.subscribe(() => {
+            if (!this.eventSink) return;
+            let loci: Loci = EmptyLoci;
+            try {
+                loci = this.phenix.getSelectedLoci();
+            } catch (error) {
+                // Nothing selected, or a selection across several structures
+            }
+            const ref_id = this.phenix.getRefIdForLoci(loci);
+            this.phenix.emitEvent('selection', { ref_id, atom_columns: phenixColumnsFromLoci(loci) });
+        });
     }
 
-    export async function loadStructureFromPdbString(this: PhenixViewer, data: string, format: string, label: string, external_ref_id: string) {
+    export function emitEvent(this: PhenixViewer, event: PhenixEventName, data: { [key: string]: any }) {
+        if (!this.eventSink) return;
+        this.eventSink({ event, time: Date.now(), data });
+    }
+
+    export async function loadStructureFromPdbString(this: PhenixViewer, data: string | Uint8Array, format: string, label: string, external_ref_id: string) {
         // V2 Function
         this.hasSynced = false;
         const _data = await this.plugin.builders.data.rawData({ data: data, label: label });
@@ -62,6 +97,125 @@ export namespace Phenix {
     }
     
 
+    export async function updateCoordinates(this: PhenixViewer, external_ref_id: string, xyz: Float32Array) {
+        // Replace the coordinates of a loaded model, keeping its topology.
+        //   On first use a ModelCoordinates transform is inserted after the
+        //   model, later calls only update its parameters.
+        const coordinatesRef = this.coordinateRefs.get(external_ref_id);
+        if (coordinatesRef && this.plugin.state.data.cells.has(coordinatesRef)) {
+            await this.plugin.build().to(coordinatesRef).update({ xyz }).commit();
+            return;
+        }
+        const structure = this.phenix.getStructureForRef(external_ref_id);
+        if (!structure || !structure.model) {
+            throw new Error(`No model loaded with ref_id: ${external_ref_id}`);
+        }
+        const update = this.plugin.build().to(structure.model.cell.transform.ref).insert(ModelCoordinates, { xyz });
+        this.coordinateRefs.set(external_ref_id, update.ref);
+        await update.commit();
+    }
+
+    export async function colorByArray(this: PhenixViewer, external_ref_id: string, colors: Uint32Array | undefined, per: 'atom' | 'residue' = 'atom', missingColor?: Color, legend?: ScaleLegend) {
+        // Apply a color per atom or residue to every representation of a
+        //   model in one state update, or restore the default theme if
+        //   colors is undefined
+        const structureRef = this.phenix.getStructureForRef(external_ref_id)?.cell?.transform.ref;
+        const structure = this.plugin.managers.structure.hierarchy.current.structures.find(s => s.cell.transform.ref === structureRef);
+        if (!structure) {
+            throw new Error(`No model loaded with ref_id: ${external_ref_id}`);
+        }
+        const componentManager = this.plugin.managers.structure.component;
+        if (!colors) {
+            await componentManager.updateRepresentationsTheme(structure.components, { color: 'default' });
+            return;
+        }
+        const colorParams = { colors, per, missingColor: missingColor ?? Color(0x808080), legend };
+        await componentManager.updateRepresentationsTheme(structure.components, { color: PhenixColorArrayThemeProvider.name as any, colorParams: colorParams as any });
+    }
+
+    export function appendFrames(this: PhenixViewer, external_ref_id: string, xyz: Float32Array, nAtoms: number, nFrames: number, capacity: number, keepFrames: boolean, complete: boolean, restart: boolean): PhenixTrajectory {
+        let trajectory = this.trajectories.get(external_ref_id);
+        if (trajectory && restart) {
+            trajectory.playing = false;
+            trajectory = undefined;
+        }
+        if (!trajectory) {
+            trajectory = new PhenixTrajectory(capacity, keepFrames);
+            this.trajectories.set(external_ref_id, trajectory);
+        }
+        trajectory.append(xyz, nAtoms, nFrames);
+        trajectory.complete = complete;
+        return trajectory;
+    }
+
+    export function playTrajectory(this: PhenixViewer, external_ref_id: string, fps: number, loop: boolean, play: boolean) {
+        // Frames are shown by updating the ModelCoordinates transform, since
+        //   they arrive while playing and molstar trajectories are fixed once built
+        const trajectory = this.trajectories.get(external_ref_id);
+        if (!trajectory) {
+            throw new Error(`No trajectory streamed for ref_id: ${external_ref_id}`);
+        }
+        trajectory.fps = fps;
+        trajectory.loop = loop;
+        if (!play || trajectory.playing) {
+            trajectory.playing = play;
+            return;
+        }
+        trajectory.playing = true;
+        const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+        const step = async () => {
+            while (trajectory.playing) {
+                const t0 = performance.now();
+                let next = trajectory.current + 1;
+                if (next >= trajectory.total) {
+                    if (trajectory.loop && trajectory.keepFrames && trajectory.complete && trajectory.total > 0) {
+                        next = 0;
+                    } else if (trajectory.complete) {
+                        trajectory.playing = false;
+                        break;
+                    } else {
+                        // Waiting for more frames
+                        await sleep(1000 / trajectory.fps);
+                        continue;
+                    }
+                }
+                trajectory.current = next;
+                const xyz = trajectory.frameAt(next);
+                trajectory.dropPlayed();
+                if (xyz) {
+                    await this.phenix.updateCoordinates(external_ref_id, xyz);
+                }
+                const wait = 1000 / trajectory.fps - (performance.now() - t0);
+                if (wait > 0) await sleep(wait);
+            }
+        };
+        step().catch(error => {
+            trajectory.playing = false;
+            console.error('Error playing trajectory:', error);
+        });
+    }
+
+    export function cacheModelData(this: PhenixViewer, contentHash: string, data: string | Uint8Array, format: string) {
+        // Keep decoded model data so an identical model can be reloaded without a transfer
+        this.modelDataCache.delete(contentHash);
+        this.modelDataCache.set(contentHash, { data, format });
+        // Map iterates in insertion order, so the first key is least recently used
+        while (this.modelDataCache.size > this.modelDataCacheSize) {
+            const oldest = this.modelDataCache.keys().next().value;
+            this.modelDataCache.delete(oldest);
+        }
+    }
+
+    export function getCachedModelData(this: PhenixViewer, contentHash: string) {
+        const cached = this.modelDataCache.get(contentHash);
+        if (cached) {
+            // Mark as most recently used
+            this.modelDataCache.delete(contentHash);
+            this.modelDataCache.set(contentHash, cached);
+        }
+        return cached;
+    }
+
     export async function updateFromExternal(this: PhenixViewer, external_ref_id: string) {
         // V2 Function
         // Manage reference ids
@@ -106,6 +260,7 @@ export namespace Phenix {
       
           if (!this.phenixState.hasPhenixReferenceKey(phenixRefKey)) {
             this.phenixState.references.push(phenixReference);
+            this.phenix.recordStateChange('add', 'reference', undefined, phenixReference);
           }
       
           // Structures
@@ -141,6 +296,7 @@ export namespace Phenix {
       
           if (!phenixReference.hasPhenixStructureKey(phenixStructureKey)) {
             phenixReference.structures.push(phenixStructure);
+            this.phenix.recordStateChange('add', 'structure', phenixRefKey, phenixStructure);
           }
       
           // Components
@@ -176,6 +332,7 @@ export namespace Phenix {
       
             if (!phenixStructure.hasPhenixComponentKey(phenixComponentKey)) {
               phenixStructure.components.push(phenixComponent);
+              this.phenix.recordStateChange('add', 'component', phenixStructureKey, phenixComponent);
             }
       
             // Representations
@@ -218,6 +375,7 @@ export namespace Phenix {
       
               if (!phenixComponent.hasPhenixRepresentationKey(phenixRepresentationKey)) {
                 phenixComponent.representations.push(phenixRepresentation);
+                this.phenix.recordStateChange('add', 'representation', phenixComponentKey, phenixRepresentation);
               }
             });
           });
@@ -226,6 +384,65 @@ export namespace Phenix {
       }
       
 
+    function stateChangeData(kind: PhenixStateChangeKind, node: any): { [key: string]: any } {
+        // The fields of a state node, without its children
+        switch (kind) {
+            case 'reference':
+                return { phenixKey: node.phenixKey, molstarKey: node.molstarKey };
+            case 'structure':
+                return { phenixReferenceKey: node.phenixReferenceKey, phenixKey: node.phenixKey, data_id: node.data_id, key: node.key, molstarKey: node.molstarKey };
+            case 'component':
+                return { phenixKey: node.phenixKey, molstarKey: node.molstarKey, key: node.key };
+            case 'representation':
+                return { phenixKey: node.phenixKey, molstarKey: node.molstarKey, name: node.name };
+        }
+    }
+
+    export function recordStateChange(this: PhenixViewer, op: 'add' | 'reset', kind?: PhenixStateChangeKind, parent?: string, node?: any) {
+        // Every change to phenixState bumps its version and is logged, so
+        //   MolstarState can return the changes since a version
+        const change: PhenixStateChange = { version: ++this.phenixState.version, op };
+        if (kind !== undefined) {
+            change.kind = kind;
+            change.parent = parent;
+            change.data = stateChangeData(kind, node);
+        }
+        const log = this.stateChangeLog;
+        log.push(change);
+        if (log.length > this.stateChangeLogSize) {
+            log.splice(0, log.length - this.stateChangeLogSize);
+        }
+    }
+
+    export function getStateChanges(this: PhenixViewer, sinceVersion: number): PhenixStateChange[] {
+        // The changes after sinceVersion. If the log does not reach back that
+        //   far (or sinceVersion is from another page load), a snapshot of the
+        //   whole state is returned instead, as a reset followed by adds.
+        const state = this.phenixState;
+        const log = this.stateChangeLog;
+        if (sinceVersion === state.version) {
+            return [];
+        }
+        if (sinceVersion < state.version && log.length > 0 && log[0].version <= sinceVersion + 1) {
+            return log.slice(log.length - (state.version - sinceVersion));
+        }
+        const version = state.version;
+        const changes: PhenixStateChange[] = [{ version, op: 'reset' }];
+        for (const reference of state.references) {
+            changes.push({ version, op: 'add', kind: 'reference', data: stateChangeData('reference', reference) });
+            for (const structure of reference.structures) {
+                changes.push({ version, op: 'add', kind: 'structure', parent: reference.phenixKey as string, data: stateChangeData('structure', structure) });
+                for (const component of structure.components) {
+                    changes.push({ version, op: 'add', kind: 'component', parent: structure.phenixKey, data: stateChangeData('component', component) });
+                    for (const representation of component.representations) {
+                        changes.push({ version, op: 'add', kind: 'representation', parent: component.phenixKey, data: stateChangeData('representation', representation) });
+                    }
+                }
+            }
+        }
+        return changes;
+    }
+
     export function generateUniqueKey(this: PhenixViewer, length: number = 16): string {
         // Define a string with all possible characters for the key
         const characters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789';
@@ -274,6 +491,40 @@ export namespace Phenix {
         this.phenix.selectFromQuery(selectionQuery,focus)
     }
 
+    export function getPymolSelectionQuery(this: PhenixViewer, pymolSel: string): StructureSelectionQuery {
+        // Parsing and compiling a selection is cached by its text
+        const cache = this.selectionQueryCache;
+        let selectionQuery = cache.get(pymolSel);
+        if (selectionQuery) {
+            this.selectionQueryCacheStats.hits++;
+            // Mark as most recently used
+            cache.delete(pymolSel);
+            cache.set(pymolSel, selectionQuery);
+            return selectionQuery;
+        }
+        this.selectionQueryCacheStats.misses++;
+        selectionQuery = StructureSelectionQuery('Custom Query', this.parse('pymol', pymolSel));
+        cache.set(pymolSel, selectionQuery);
+        while (cache.size > this.selectionQueryCacheSize) {
+            cache.delete(cache.keys().next().value);
+        }
+        return selectionQuery;
+    }
+
+    export function selectionCacheInfo(this: PhenixViewer, clear: boolean = false) {
+        const info = {
+            hits: this.selectionQueryCacheStats.hits,
+            misses: this.selectionQueryCacheStats.misses,
+            size: this.selectionQueryCache.size,
+            maxsize: this.selectionQueryCacheSize,
+        };
+        if (clear) {
+            this.selectionQueryCache.clear();
+            this.selectionQueryCacheStats = { hits: 0, misses: 0 };
+        }
+        return info;
+    }
+
     export function selectFromQuery(this: PhenixViewer, selectionQuery: any, focus: boolean = true) {
         // V2 Function
         this.currentSelExpression = selectionQuery.expression;
@@ -297,6 +548,133 @@ export namespace Phenix {
             this.plugin.managers.camera.focusLoci(loci);
         }
     }
+    export function atomIdIndex(this: PhenixViewer, model: Model): Map<number, number> {
+        // Atom serial (id): atom index in model order, built once per model
+        let index = this.atomIdIndexCache.get(model);
+        if (!index) {
+            index = new Map<number, number>();
+            const atomId = model.atomicConformation.atomId;
+            for (let i = 0, n = model.atomicHierarchy.atoms._rowCount; i < n; i++) {
+                index.set(atomId.value(i), i);
+            }
+            this.atomIdIndexCache.set(model, index);
+        }
+        return index;
+    }
+
+    export function atomSourceOrder(this: PhenixViewer, model: Model): AtomSourceOrder {
+        // Atom index <-> source index (i_seq), built once per model
+        let order = this.atomSourceOrderCache.get(model);
+        if (!order) {
+            order = buildAtomSourceOrder(model);
+            this.atomSourceOrderCache.set(model, order);
+        }
+        return order;
+    }
+
+    export function lociFromAtomIndices(this: PhenixViewer, structure: Structure, indices: Uint32Array, by: 'index' | 'id' = 'index'): StructureElement.Loci {
+        // Build the loci directly from atom indices (file order, the i_seqs
+        //   of the model in Python) or atom serials, in one pass over the
+        //   indices and one over the structure
+        const model = structure.model;
+        const atomCount = model.atomicHierarchy.atoms._rowCount;
+        const mask = new Uint8Array(atomCount);
+        const idIndex = by === 'id' ? this.phenix.atomIdIndex(model) : undefined;
+        const atomIndex = by === 'index' ? this.phenix.atomSourceOrder(model).atomIndex : undefined;
+        for (let i = 0; i < indices.length; i++) {
+            const index = idIndex ? idIndex.get(indices[i]) : atomIndex![indices[i]];
+            if (index === undefined || index < 0 || index >= atomCount) {
+                throw new Error(`No atom with ${by} ${indices[i]}`);
+            }
+            mask[index] = 1;
+        }
+        const elements: StructureElement.Loci['elements'][0][] = [];
+        for (const unit of structure.units) {
+            if (!Unit.isAtomic(unit)) continue;
+            const unitIndices: number[] = [];
+            const unitElements = unit.elements;
+            for (let j = 0; j < unitElements.length; j++) {
+                if (mask[unitElements[j]]) unitIndices.push(j);
+            }
+            if (unitIndices.length > 0) {
+                elements.push({ unit, indices: OrderedSet.ofSortedArray(unitIndices as StructureElement.UnitIndex[]) });
+            }
+        }
+        return StructureElement.Loci(structure, elements);
+    }
+
+    export function lociFromAtomRanges(this: PhenixViewer, structure: Structure, sourceRanges: ArrayLike<number>): StructureElement.Loci {
+        // Build the loci from [start, stop) runs of source indices (i_seqs,
+        //   sorted and disjoint). The runs are mapped to atom index runs once
+        //   per model, then found with a binary search per run and unit.
+        const elements: StructureElement.Loci['elements'][0][] = [];
+        const modelRanges = new Map<Model, number[]>();
+        for (const unit of structure.units) {
+            if (!Unit.isAtomic(unit)) continue;
+            let ranges = modelRanges.get(unit.model);
+            if (!ranges) {
+                ranges = mapAtomRuns(sourceRanges, this.phenix.atomSourceOrder(unit.model), 'atom');
+                modelRanges.set(unit.model, ranges);
+            }
+            const unitElements = unit.elements;
+            const first = unitElements[0], last = unitElements[unitElements.length - 1];
+            const unitRanges: [number, number][] = []; // [min, max] of UnitIndex
+            let size = 0;
+            for (let r = 0; r < ranges.length; r += 2) {
+                const start = ranges[r], stop = ranges[r + 1];
+                if (stop <= first) continue;
+                if (start > last) break;
+                const min = SortedArray.findPredecessorIndex(unitElements, start);
+                const end = SortedArray.findPredecessorIndex(unitElements, stop);
+                if (end > min) {
+                    unitRanges.push([min, end - 1]);
+                    size += end - min;
+                }
+            }
+            if (unitRanges.length === 1) {
+                elements.push({ unit, indices: OrderedSet.ofRange(unitRanges[0][0] as StructureElement.UnitIndex, unitRanges[0][1] as StructureElement.UnitIndex) });
+            } else if (unitRanges.length > 1) {
+                const unitIndices = new Int32Array(size);
+                let k = 0;
+                for (const [min, max] of unitRanges) {
+                    for (let i = min; i <= max; i++) unitIndices[k++] = i;
+                }
+                elements.push({ unit, indices: OrderedSet.ofSortedArray(unitIndices as any as StructureElement.UnitIndex[]) });
+            }
+        }
+        return StructureElement.Loci(structure, elements);
+    }
+
+    function selectLoci(viewer: PhenixViewer, loci: StructureElement.Loci, focus: boolean): number {
+        // Select exactly the atoms of loci, without granularity
+        viewer.currentSelExpression = undefined;
+        viewer.plugin.managers.interactivity.lociSelects.selectOnly({ loci }, false);
+        if (focus && !Loci.isEmpty(loci)) {
+            viewer.plugin.managers.camera.focusLoci(loci);
+        }
+        return StructureElement.Loci.size(loci);
+    }
+
+    function structureForRef(viewer: PhenixViewer, external_ref_id: string): Structure {
+        const structure: Structure | undefined = viewer.phenix.getStructureForRef(external_ref_id)?.cell?.obj?.data;
+        if (!structure) {
+            throw new Error(`No model loaded with ref_id: ${external_ref_id}`);
+        }
+        return structure;
+    }
+
+    export function selectAtoms(this: PhenixViewer, external_ref_id: string, indices: Uint32Array, by: 'index' | 'id' = 'index', focus: boolean = true): number {
+        // Select exactly the given atoms of a model, without a query
+        const structure = structureForRef(this, external_ref_id);
+        return selectLoci(this, this.phenix.lociFromAtomIndices(structure, indices, by), focus);
+    }
+
+    export function selectAtomRanges(this: PhenixViewer, external_ref_id: string, ranges: ArrayLike<number>, focus: boolean = true): number {
+        // Select the atoms in [start, stop) runs of atom indices of a model
+        const structure = structureForRef(this, external_ref_id);
+        return selectLoci(this, this.phenix.lociFromAtomRanges(structure, ranges), focus);
+    }
+
     export function focusSelected(this: PhenixViewer){
         const loci = this.phenix.getSelectedLoci();
         // if empty, stop
@@ -322,6 +700,16 @@ export namespace Phenix {
         const phenixSel = phenixSelFromLoci(loci)
         return phenixSel
     }
+
+    export function pollSelectionColumns(this: PhenixViewer) {
+        const loci = this.phenix.getSelectedLoci();
+        return phenixColumnsFromLoci(loci);
+    }
+
+    export function pollSelectionRanges(this: PhenixViewer) {
+        const loci = this.phenix.getSelectedLoci();
+        return phenixRangesFromLoci(loci, this.phenix.atomSourceOrder);
+    }
     
     export function setColor(this: PhenixViewer, param: { highlight?: any, select?: any }) {
 
@@ -403,7 +791,11 @@ export namespace Phenix {
         this.plugin.build();
         this.objectStorageMolstar = new TwoWayDictionary();
         this.objectStoragePhenix = new TwoWayDictionary();
+        // The version carries on, so Python sees the reset as a change
+        const version = this.phenixState.version;
         this.phenixState = new MolstarState();
+        this.phenixState.version = version;
+        this.phenix.recordStateChange('reset');
         this.hasSynced = true;
         // this.hasVolumes = false;
     }
@@ -530,6 +922,18 @@ export namespace Phenix {
     }
       
 
+    export function getRefIdForLoci(this: PhenixViewer, loci: Loci): string | undefined {
+        // The external ref_id of the model a selection belongs to
+        if (!StructureElement.Loci.is(loci)) return undefined;
+        const root = loci.structure.root;
+        for (const structure of this.plugin.managers.structure.hierarchy.current.structures) {
+            if (structure.cell.obj?.data.root !== root) continue;
+            const reference = this.objectStorageMolstar.getByKey(structure.cell.transform.ref);
+            return reference?.phenixKey;
+        }
+        return undefined;
+    }
+
     export function getStructureForRef(this:PhenixViewer, phenixRefId: string){
         const refObj = this.objectStoragePhenix.getByKey(phenixRefId);
         const structureKey = refObj.getStructureKey()
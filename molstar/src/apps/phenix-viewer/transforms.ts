@@ -0,0 +1,59 @@
+/*
+ * Phenix specific state transforms.
+ *
+ * ModelCoordinates sits between a model and its structure in the state tree
+ * and replaces the model's coordinates. Updating its parameters propagates
+ * new coordinates to the structure and representations without re-parsing
+ * the model or rebuilding the hierarchy.
+ */
+
+import { PluginStateObject as SO, PluginStateTransform } from '../../mol-plugin-state/objects';
+import { ParamDefinition as PD } from '../../mol-util/param-definition';
+import { Model } from '../../mol-model/structure';
+import { Coordinates, Frame, Time } from '../../mol-model/structure/coordinates';
+import { Task } from '../../mol-task';
+
+export function frameFromXyz(xyz: Float32Array, time: number = 0): Frame {
+    // xyz is packed x,y,z per atom, in the order atoms appear in the source file
+    const elementCount = xyz.length / 3;
+    const x = new Float32Array(elementCount);
+    const y = new Float32Array(elementCount);
+    const z = new Float32Array(elementCount);
+    for (let i = 0, j = 0; i < elementCount; i++, j += 3) {
+        x[i] = xyz[j];
+        y[i] = xyz[j + 1];
+        z[i] = xyz[j + 2];
+    }
+    return { elementCount, time: Time(time, 'step'), xyzOrdered: false, x, y, z };
+}
+
+export function modelWithXyz(model: Model, xyz: Float32Array): Task<Model> {
+    const atomCount = model.atomicHierarchy.atoms._rowCount;
+    if (xyz.length !== 3 * atomCount) {
+        throw new Error(`Expected coordinates for ${atomCount} atoms, got ${xyz.length / 3}`);
+    }
+    const coordinates = Coordinates.create([frameFromXyz(xyz)], Time(1, 'step'), Time(0, 'step'));
+    const trajectory = Model.trajectoryFromModelAndCoordinates(model, coordinates);
+    return Task.create('Model With Coordinates', ctx => Task.resolveInContext(trajectory.getFrameAtIndex(0), ctx));
+}
+
+export { ModelCoordinates };
+type ModelCoordinates = typeof ModelCoordinates;
+const ModelCoordinates = PluginStateTransform.BuiltIn({
+    name: 'phenix-model-coordinates',
+    display: { name: 'Phenix Coordinates', description: 'Replace the coordinates of a model.' },
+    from: SO.Molecule.Model,
+    to: SO.Molecule.Model,
+    params: {
+        xyz: PD.Value<Float32Array | undefined>(undefined, { isHidden: true }),
+    }
+})({
+    apply({ a, params }) {
+        return Task.create('Apply Coordinates', async ctx => {
+            const props = { label: a.label, description: a.description };
+            if (!params.xyz) return new SO.Molecule.Model(a.data, props);
+            const model = await modelWithXyz(a.data, params.xyz).runInContext(ctx);
+            return new SO.Molecule.Model(model, props);
+        });
+    }
+});
@@ -0,0 +1,202 @@
+/*
+ * Benchmark of QueryHelper.getMolstarQuery (apps/phenix-viewer/helpers.ts)
+ * against its previous implementation, on a synthetic 500k atom structure.
+ *
+ * The previous implementation, kept below as legacyGetMolstarQuery, looked up
+ * the property getter and switched on the operator for every atom and
+ * condition. The compiled one resolves both once per query and tests chain
+ * and residue conditions per unit, chain and residue.
+ *
+ *   npm run build-tsc
+ *   node lib/commonjs/perf-tests/phenix-query-helper.js [n_chains] [n_residues]
+ */
+
+import * as B from 'benchmark';
+import { CIF } from '../mol-io/reader/cif';
+import { trajectoryFromMmCIF } from '../mol-model-formats/structure/mmcif';
+import { Queries, Structure, StructureProperties, StructureQuery, StructureSelection } from '../mol-model/structure';
+import { QueryHelper, SelectionQuery } from '../apps/phenix-viewer/helpers';
+
+const AtomNames = ['N', 'CA', 'C', 'O', 'CB'];
+
+function chainName(i: number) {
+    return `C${i}`;
+}
+
+function mmcifText(nChains: number, nResidues: number) {
+    // nChains * nResidues * 5 atoms, alternating ALA and GLY residues
+    const lines = [
+        'data_bench',
+        'loop_',
+        '_atom_site.group_PDB',
+        '_atom_site.id',
+        '_atom_site.type_symbol',
+        '_atom_site.label_atom_id',
+        '_atom_site.label_alt_id',
+        '_atom_site.label_comp_id',
+        '_atom_site.label_asym_id',
+        '_atom_site.label_entity_id',
+        '_atom_site.label_seq_id',
+        '_atom_site.pdbx_PDB_ins_code',
+        '_atom_site.Cartn_x',
+        '_atom_site.Cartn_y',
+        '_atom_site.Cartn_z',
+        '_atom_site.occupancy',
+        '_atom_site.B_iso_or_equiv',
+        '_atom_site.auth_seq_id',
+        '_atom_site.auth_comp_id',
+        '_atom_site.auth_asym_id',
+        '_atom_site.auth_atom_id',
+        '_atom_site.pdbx_PDB_model_num',
+    ];
+    let id = 1;
+    for (let c = 0; c < nChains; c++) {
+        const chain = chainName(c);
+        for (let r = 1; r <= nResidues; r++) {
+            const comp = r % 2 ? 'ALA' : 'GLY';
+            for (const name of AtomNames) {
+                const x = (c * 10 + r * 0.1).toFixed(3), y = (r * 1.5).toFixed(3), z = (id % 7).toFixed(3);
+                lines.push(`ATOM ${id} ${name[0]} ${name} . ${comp} ${chain} 1 ${r} ? ${x} ${y} ${z} 1.00 20.00 ${r} ${comp} ${chain} ${name} 1`);
+                id++;
+            }
+        }
+    }
+    return lines.join('\n');
+}
+
+async function createStructure(nChains: number, nResidues: number) {
+    const parsed = await CIF.parseText(mmcifText(nChains, nResidues)).run();
+    if (parsed.isError) throw new Error(parsed.toString());
+    const trajectory = await trajectoryFromMmCIF(parsed.result.blocks[0], parsed.result).run();
+    return Structure.ofModel(trajectory.representative);
+}
+
+// The previous implementation
+function legacyGetStructurePropertyFunction(keyword: string): any {
+    const testName = legacyMapKeywordToTestName(keyword);
+    if (!testName) {
+        console.error(`Keyword '${keyword}' not in mapping`);
+        return null;
+    }
+    if (!StructureProperties || !(testName in StructureProperties)) {
+        console.error(`StructureProperties[${keyword}] is undefined`);
+        return null;
+    }
+    // @ts-ignore
+    if (typeof StructureProperties[testName][keyword] !== 'function') {
+        console.error(`StructureProperties[${testName}][${keyword}] is not a function`);
+        return null;
+    }
+    // @ts-ignore
+    return StructureProperties[testName][keyword];
+}
+
+function legacyMapKeywordToTestName(keyword: string): string {
+    const mapping: any = {
+        'asym_id': 'chain',
+        'auth_asym_id': 'chain',
+        'label_asym_id': 'chain',
+        'seq_id': 'residue',
+        'auth_seq_id': 'residue',
+        'label_seq_id': 'residue',
+        'comp_id': 'atom',
+        'auth_comp_id': 'atom',
+        'label_comp_id': 'atom',
+        'atom_id': 'atom',
+        'label_atom_id': 'atom',
+        'label_alt_id': 'atom',
+    };
+    return mapping[keyword] || keyword;
+}
+
+function legacyGetMolstarQuery(query: SelectionQuery): StructureQuery {
+    const selections: any = [];
+    query.selections.forEach(param => {
+        const selection: any = {};
+        Object.keys(param).forEach(keyword => {
+            const conditions = param[keyword].ops;
+            const testName = legacyMapKeywordToTestName(keyword);
+            selection[`${testName}Test`] = (l: any) => {
+                return conditions.every(cond => {
+                    const operator = cond.op;
+                    const value = cond.value;
+                    if (value === '*') {
+                        return true;
+                    }
+                    const structureFunction = legacyGetStructurePropertyFunction(keyword);
+                    const elementValue = structureFunction(l.element);
+                    switch (operator) {
+                        case '==':
+                            return elementValue === value;
+                        case '>=':
+                            return elementValue >= value;
+                        case '<=':
+                            return elementValue <= value;
+                        default:
+                            return false;
+                    }
+                });
+            };
+        });
+        selections.push(selection);
+    });
+    return Queries.combinators.merge(selections.map((selection: any) => Queries.generators.atoms(selection)));
+}
+
+function selectionQuery(selection: any): SelectionQuery {
+    return { selections: [selection], params: { refId: '' } };
+}
+
+function cases(nChains: number, nResidues: number): [string, SelectionQuery][] {
+    const chain = chainName(Math.floor(nChains / 2));
+    const first = Math.floor(nResidues / 10), last = Math.floor(nResidues / 5);
+    return [
+        ['chain', selectionQuery({ auth_asym_id: { ops: [{ op: '==', value: chain }] } })],
+        ['chain + residue range', selectionQuery({
+            auth_asym_id: { ops: [{ op: '==', value: chain }] },
+            auth_seq_id: { ops: [{ op: '>=', value: first }, { op: '<=', value: last }] },
+        })],
+        ['residue range + atom name', selectionQuery({
+            auth_seq_id: { ops: [{ op: '>=', value: first }, { op: '<=', value: last }] },
+            auth_atom_id: { ops: [{ op: '==', value: 'CA' }] },
+        })],
+        ['single atom', selectionQuery({
+            auth_asym_id: { ops: [{ op: '==', value: chain }] },
+            auth_seq_id: { ops: [{ op: '==', value: first }] },
+            auth_atom_id: { ops: [{ op: '==', value: 'CA' }] },
+        })],
+        // Two atom level keywords. The legacy implementation kept only the
+        //   last one, so it selects every CA rather than those of GLY.
+        ['residue name + atom name', selectionQuery({
+            auth_comp_id: { ops: [{ op: '==', value: 'GLY' }] },
+            auth_atom_id: { ops: [{ op: '==', value: 'CA' }] },
+        })],
+    ];
+}
+
+function count(query: StructureQuery, structure: Structure) {
+    return StructureSelection.unionStructure(StructureQuery.run(query, structure)).elementCount;
+}
+
+async function run() {
+    const nChains = parseInt(process.argv[2] || '100');
+    const nResidues = parseInt(process.argv[3] || '1000');
+    console.log(`Building a structure of ${nChains} chains of ${nResidues} residues...`);
+    const structure = await createStructure(nChains, nResidues);
+    console.log(`${structure.elementCount} atoms, ${structure.units.length} units`);
+
+    for (const [label, query] of cases(nChains, nResidues)) {
+        const legacy = legacyGetMolstarQuery(query);
+        const compiled = QueryHelper.getMolstarQuery(query, structure) as any as StructureQuery;
+        console.log(`\n${label}: ${count(legacy, structure)} atoms (legacy), ${count(compiled, structure)} atoms (compiled)`);
+        const suite = new B.Suite();
+        suite
+            .add(`legacy   ${label}`, () => StructureQuery.run(legacy, structure))
+            .add(`compiled ${label}`, () => StructureQuery.run(compiled, structure))
+            .add(`compile + run ${label}`, () => StructureQuery.run(QueryHelper.getMolstarQuery(query, structure) as any, structure))
+            .on('cycle', (e: any) => console.log(String(e.target)))
+            .run();
+    }
+}
+
+run();
@@ -2,18 +2,62 @@ const express = require('express');
 const cors = require('cors');
 const WebSocket = require('ws');
 const path = require('path');
+const fs = require('fs');
+const crypto = require('crypto');
+const { performance } = require('perf_hooks');
 const app = express();
 
+// Wall clock time in ms, comparable with the timestamps of Python and the viewer
+const now = () => performance.timeOrigin + performance.now();
+
 // Get the port from the command line argument (default to 3000 if not provided)
 const args = process.argv.slice(2);
 const portIndex = args.indexOf('--port');
 const port = portIndex !== -1 && args[portIndex + 1] ? parseInt(args[portIndex + 1], 10) : 3000;
-console.log("Port:",port)
+// Maximum size of a request body, e.g. a large uncompressed model
+const bodyLimitIndex = args.indexOf('--body-limit');
+const bodyLimit = bodyLimitIndex !== -1 && args[bodyLimitIndex + 1] ? args[bodyLimitIndex + 1] : '100mb';
+// How long to wait for viewers to respond to a request (ms)
+const timeoutIndex = args.indexOf('--request-timeout');
+const requestTimeout = timeoutIndex !== -1 && args[timeoutIndex + 1] ? parseInt(args[timeoutIndex + 1], 10) : 5000;
+// Hover events are throttled to one per interval, selection events are sent
+//   once no further change arrives for the debounce delay (ms)
+const throttleIndex = args.indexOf('--event-throttle');
+const eventThrottle = throttleIndex !== -1 && args[throttleIndex + 1] ? parseInt(args[throttleIndex + 1], 10) : 50;
+const debounceIndex = args.indexOf('--event-debounce');
+const eventDebounce = debounceIndex !== -1 && args[debounceIndex + 1] ? parseInt(args[debounceIndex + 1], 10) : 100;
+// Append every request to this file as json lines, for replay by testing/bench_e2e.py
+const recordIndex = args.indexOf('--record');
+const recordStream = recordIndex !== -1 && args[recordIndex + 1] ? fs.createWriteStream(args[recordIndex + 1], { flags: 'a' }) : undefined;
+// Messages below this level are not logged: error, warn, info or debug
+const logLevelIndex = args.indexOf('--log-level');
+const logLevels = ['error', 'warn', 'info', 'debug'];
+const logLevel = logLevels.indexOf(logLevelIndex !== -1 && args[logLevelIndex + 1] ? args[logLevelIndex + 1] : 'info');
+const log = {
+  error: (...msg) => { if (logLevel >= 0) console.error(...msg); },
+  warn: (...msg) => { if (logLevel >= 1) console.warn(...msg); },
+  info: (...msg) => { if (logLevel >= 2) console.log(...msg); },
+  debug: (...msg) => { if (logLevel >= 3) console.log(...msg); },
+};
+log.info("Port:",port)
+app.use((req, res, next) => {
+  // Before the body is parsed, for the timing of requests
+  req.serverReceive = now();
+  next();
+});
 app.use(cors());
-app.use(express.json({ limit: '100mb' }));
+app.use(express.json({ limit: bodyLimit }));
 
-const clients = [];  // SSE clients
-const wsClients = new Map();  // WebSocket clients
+// Viewers register with a client id (the client_id query parameter of their
+//   SSE and WebSocket urls), which Python uses to target requests to them
+const sseClients = new Map();  // SSE clients, clientId: response
+const wsClients = new Map();  // WebSocket clients, clientId: ws
+let anonymousClients = 0;
+
+function clientIdFromUrl(url) {
+  const clientId = new URL(url, 'http://localhost').searchParams.get('client_id');
+  return clientId || `anonymous-${++anonymousClients}`;
+}
 
 // Serve static files from 'molstar/build/phenix-viewer'
 const staticPath = path.join(__dirname, '../../build/phenix-viewer');
@@ -31,74 +75,367 @@ app.get('/events', (req, res) => {
   res.setHeader('Connection', 'keep-alive');
   res.flushHeaders();
 
-  clients.push(res);
-  console.log('New client connected. Total clients:', clients.length);
+  const clientId = clientIdFromUrl(req.url);
+  sseClients.set(clientId, res);
+  log.debug('New client connected:', clientId, 'Total clients:', sseClients.size);
 
   req.on('close', () => {
-    clients.splice(clients.indexOf(res), 1);
-    console.log('Client disconnected. Total clients:', clients.length);
+    if (sseClients.get(clientId) === res) {
+      sseClients.delete(clientId);
+    }
+    log.debug('Client disconnected:', clientId, 'Total clients:', sseClients.size);
   });
 });
 
-function handlePostRequest(req, res) {
-  const payload = req.body;  // Receive the JSON payload (action and args)
+// Viewers that have signalled their plugin is initialized
+const readyClients = new Set();
+// /health requests waiting for a viewer to become ready: { res, timer }
+const readyWaiters = [];
+
+function isReady(clientId) {
+  return clientId ? readyClients.has(clientId) : readyClients.size > 0;
+}
+
+function healthBody(clientId) {
+  return {
+    status: 'ok',
+    viewers: wsClients.size,
+    clients: Array.from(wsClients.keys()),
+    ready: isReady(clientId),
+    pending_requests: pendingRequests.size
+  };
+}
+
+// Health Endpoint. With ?wait_ready=ms, respond as soon as a viewer is
+//   ready, or after ms at the latest, instead of immediately. With
+//   ?client_id=id, only that viewer counts.
+app.get('/health', (req, res) => {
+  const wait = parseInt(req.query.wait_ready, 10);
+  const clientId = req.query.client_id;
+  if (isReady(clientId) || !(wait > 0)) {
+    res.json(healthBody(clientId));
+    return;
+  }
+  const waiter = { res, clientId, timer: undefined };
+  waiter.timer = setTimeout(() => {
+    readyWaiters.splice(readyWaiters.indexOf(waiter), 1);
+    res.json(healthBody(clientId));
+  }, wait);
+  readyWaiters.push(waiter);
+});
+
+function handleClientReady(clientId) {
+  readyClients.add(clientId);
+  log.info('Viewer ready:', clientId);
+  for (let i = readyWaiters.length - 1; i >= 0; i--) {
+    const waiter = readyWaiters[i];
+    if (isReady(waiter.clientId)) {
+      readyWaiters.splice(i, 1);
+      clearTimeout(waiter.timer);
+      waiter.res.json(healthBody(waiter.clientId));
+    }
+  }
+}
+
+// SSE Endpoint for sending viewer interaction events to Python listeners
+const eventListeners = [];
+app.get('/viewer-events', (req, res) => {
+  res.setHeader('Content-Type', 'text/event-stream');
+  res.setHeader('Cache-Control', 'no-cache');
+  res.setHeader('Connection', 'keep-alive');
+  res.flushHeaders();
+
+  eventListeners.push(res);
+  log.debug('New event listener connected. Total listeners:', eventListeners.length);
+
+  req.on('close', () => {
+    eventListeners.splice(eventListeners.indexOf(res), 1);
+    log.debug('Event listener disconnected. Total listeners:', eventListeners.length);
+  });
+});
+
+// Rate limiting state per client and event name: { timer, latest, last }
+const eventTimers = new Map();
+
+function broadcastEvent(event) {
+  const text = `data: ${JSON.stringify(event)}\n\n`;
+  eventListeners.forEach(listener => {
+    listener.write(text);
+  });
+}
+
+function throttleEvent(key, event, interval) {
+  // Send at most one event per interval, always ending with the latest one
+  let state = eventTimers.get(key);
+  if (!state) {
+    state = { timer: undefined, latest: undefined, last: 0 };
+    eventTimers.set(key, state);
+  }
+  const t = now();
+  state.latest = event;
+  if (state.timer) return;
+  const wait = interval - (t - state.last);
+  if (wait <= 0) {
+    state.last = t;
+    broadcastEvent(event);
+    return;
+  }
+  state.timer = setTimeout(() => {
+    state.timer = undefined;
+    state.last = now();
+    broadcastEvent(state.latest);
+  }, wait);
+}
+
+function debounceEvent(key, event, delay) {
+  // Send the event once no newer one has arrived for delay
+  const state = eventTimers.get(key);
+  if (state) clearTimeout(state.timer);
+  eventTimers.set(key, {
+    timer: setTimeout(() => {
+      eventTimers.delete(key);
+      broadcastEvent(event);
+    }, delay),
+    latest: event,
+    last: 0
+  });
+}
+
+function handleViewerEvent(clientId, event) {
+  if (eventListeners.length === 0) return;
+  event.client_id = clientId;
+  const key = `${clientId}:${event.event}`;
+  if (event.event === 'hover') {
+    throttleEvent(key, event, eventThrottle);
+  } else if (event.event === 'selection') {
+    debounceEvent(key, event, eventDebounce);
+  } else {
+    broadcastEvent(event);
+  }
+}
+
+// Timing of requests per api class, see phenix/metrics.py. Durations are in
+//   ms, the bucket bounds are the same as in Python.
+const metricBuckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000];
+const metrics = new Map();  // api class name: { stage: histogram }
+
+function newHistogram() {
+  return { count: 0, sum: 0, min: null, max: null, counts: new Array(metricBuckets.length + 1).fill(0) };
+}
 
-  // Broadcast the payload to all connected SSE clients
-  clients.forEach(client => {
-    client.write(`data: ${JSON.stringify(payload)}\n\n`);
+function recordMetric(name, stage, value) {
+  if (!(value >= 0) || !Number.isFinite(value)) return;  // Missing stamps, or clocks out of step
+  let stages = metrics.get(name);
+  if (!stages) {
+    stages = {};
+    metrics.set(name, stages);
+  }
+  const histogram = stages[stage] || (stages[stage] = newHistogram());
+  let i = 0;
+  while (i < metricBuckets.length && value > metricBuckets[i]) i++;
+  histogram.counts[i]++;
+  histogram.count++;
+  histogram.sum += value;
+  histogram.min = histogram.min === null ? value : Math.min(histogram.min, value);
+  histogram.max = histogram.max === null ? value : Math.max(histogram.max, value);
+}
+
+function recordRequestMetrics(name, timing, responses) {
+  recordMetric(name, 'server_total', timing.server_reply - timing.server_receive);
+  const client = responses.length > 0 && responses[0].data ? responses[0].data.timing : undefined;
+  if (client) {
+    recordMetric(name, 'relay', client.client_receive - timing.server_receive);
+    recordMetric(name, 'run', client.run_end - client.run_start);
+    recordMetric(name, 'client_total', client.client_reply - client.client_receive);
+    recordMetric(name, 'to_server_reply', timing.server_reply - client.client_reply);
+  }
+}
+
+// Metrics Endpoint: histograms of stage durations per api class. With
+//   ?reset=1 they are cleared after reading.
+app.get('/metrics', (req, res) => {
+  const calls = {};
+  metrics.forEach((stages, name) => {
+    calls[name] = stages;
   });
+  res.json({ buckets: metricBuckets, calls: calls });
+  if (req.query.reset === '1') {
+    metrics.clear();
+  }
+});
+
+// Requests awaiting responses, keyed by request_id:
+//   { reply, responses, waiting (Set of clientIds), mode, name, timing, timeout }
+const pendingRequests = new Map();
+
+function finishRequest(requestId, success, message) {
+  const pending = pendingRequests.get(requestId);
+  if (!pending) return;
+  pendingRequests.delete(requestId);
+  clearTimeout(pending.timeout);
+  pending.timing.server_reply = now();
+  recordRequestMetrics(pending.name, pending.timing, pending.responses);
+  const body = {
+    success: success,
+    message: message,
+    request_id: requestId,
+    timing: pending.timing,
+    responses: pending.responses
+  };
+  if (!success) {
+    body.failedClients = pending.waiting.size;  // Report number of clients that didn't respond
+  }
+  pending.reply(body);
+}
+
+function startRequest(payload, message, reply, relay, serverReceive) {
+  // Send a request to the viewers and call reply(body) once they respond.
+  //   relay: 'sse' to send over SSE, 'ws' to relay the message frame
+  //   directly over each viewer's WebSocket.
+  //   message: payload as json text, or undefined to encode it here.
+  //
+  // Routing, from the payload:
+  //   target: the client id of one viewer. Only that viewer gets the request.
+  //   mode: 'target' (the default when target is set), 'first' to send to all
+  //     viewers and reply with the first response, or 'all' (the default
+  //     otherwise) to send to all viewers and wait for every response.
+
+  // Tag the request so responses can be matched to it, even when several
+  //   requests are in flight at once
+  if (!payload.request_id) {
+    payload.request_id = crypto.randomUUID();
+    message = undefined;
+  }
+  const requestId = payload.request_id;
+  if (pendingRequests.has(requestId)) {
+    reply({ success: false, message: `Duplicate request_id: ${requestId}`, request_id: requestId, responses: [] });
+    return;
+  }
+  const mode = payload.mode || (payload.target ? 'target' : 'all');
+  let recipients;
+  if (mode === 'target') {
+    if (!wsClients.has(payload.target)) {
+      reply({ success: false, message: `No viewer connected with client id: ${payload.target}`, request_id: requestId, responses: [] });
+      return;
+    }
+    recipients = [payload.target];
+  } else if (mode === 'first' || mode === 'all') {
+    recipients = Array.from(wsClients.keys());
+  } else {
+    reply({ success: false, message: `Unknown routing mode: ${mode}`, request_id: requestId, responses: [] });
+    return;
+  }
+  if (message === undefined) {
+    message = JSON.stringify(payload);
+  }
+  if (recordStream) {
+    recordStream.write(`{"time":${now()},"relay":"${relay}","payload":${message}}\n`);
+  }
 
   // Track responses from WebSocket clients
-  const responses = [];
-  const totalClients = wsClients.size;
-  let completedClients = 0;
+  const pending = {
+    reply: reply,
+    responses: [],
+    waiting: new Set(),
+    mode: mode,
+    name: payload.name,
+    timing: { server_receive: serverReceive || now() },
+    timeout: undefined
+  };
+  pendingRequests.set(requestId, pending);
 
   // Set a timeout to ensure we don't wait indefinitely for responses
-  const timeoutDuration = 5000;  // Timeout after 5 seconds
-  const timeout = setTimeout(() => {
-    // Respond to the HTTP client after the timeout, including partial results
-    res.json({
-      success: false,
-      message: 'Timeout waiting for some clients to respond',
-      responses: responses,  // Return the partial responses we got
-      failedClients: totalClients - completedClients  // Report number of clients that didn't respond
-    });
+  const timeoutDuration = requestTimeout;  // Timeout after 5 seconds by default
+  pending.timeout = setTimeout(() => {
+    // Respond to the client after the timeout, including partial results
+    finishRequest(requestId, false, 'Timeout waiting for some clients to respond');
   }, timeoutDuration);
 
-  // Broadcast the payload to all WebSocket clients and wait for their responses
-  wsClients.forEach((ws, clientId) => {
+  // Viewers receive the request over SSE or their WebSocket, and respond
+  //   over their WebSocket
+  recipients.forEach(clientId => {
+    const ws = wsClients.get(clientId);
     if (ws.readyState === WebSocket.OPEN) {
-      ws.send(JSON.stringify(payload));
-
-      // Listen for a response from the WebSocket client
-      ws.once('message', (message) => {
-        const data = JSON.parse(message);
-        responses.push({ clientId, data });
-        completedClients++;
-
-        // Check if all clients have responded before the timeout
-        if (completedClients === totalClients) {
-          clearTimeout(timeout);  // Clear the timeout if all clients responded
-          res.json({
-            success: true,
-            message: 'All clients responded',
-            responses: responses
-          });
+      if (relay === 'sse') {
+        const sse = sseClients.get(clientId);
+        if (!sse) {
+          pending.responses.push({ clientId, error: 'Event stream not open' });
+          return;
         }
-      });
+        sse.write(`data: ${message}\n\n`);
+      }
+      pending.waiting.add(clientId);
+      if (relay === 'ws') {
+        ws.send(message);
+      }
     } else {
       // Handle the case where the WebSocket connection is not open
-      responses.push({ clientId, error: 'WebSocket not open' });
-      completedClients++;
-
-      // If all clients have responded (or failed), return the response early
-      if (completedClients === totalClients) {
-        clearTimeout(timeout);  // Clear the timeout if all clients responded
-        res.json({
-          success: true,
-          message: 'Some clients failed to respond, but continuing',
-          responses: responses
-        });
+      pending.responses.push({ clientId, error: 'WebSocket not open' });
+    }
+  });
+
+  // If no client can respond, return early
+  if (pending.waiting.size === 0 && pending.responses.length > 0) {
+    finishRequest(requestId, true, 'Some clients failed to respond, but continuing');
+  }
+}
+
+function handlePostRequest(req, res) {
+  const payload = req.body;  // Receive the JSON payload (action and args)
+  startRequest(payload, undefined, (body) => res.json(body), 'sse', req.serverReceive);
+}
+
+function handleControlConnection(ws) {
+  // A persistent channel from a Python client. Each frame is a request,
+  //   relayed as-is to the viewers' WebSockets, and each reply is sent back
+  //   on the same channel with the same body as a /run response.
+  log.debug('Control client connected');
+  ws.on('message', (message) => {
+    const serverReceive = now();
+    const text = message.toString();
+    let payload;
+    try {
+      payload = JSON.parse(text);
+    } catch (error) {
+      ws.send(JSON.stringify({ success: false, message: 'Invalid json in request', responses: [] }));
+      return;
+    }
+    startRequest(payload, text, (body) => {
+      if (ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify(body));
+      }
+    }, 'ws', serverReceive);
+  });
+  ws.on('close', () => {
+    log.debug('Control client disconnected');
+  });
+}
+
+function handleClientResponse(clientId, data) {
+  // Credit a WebSocket response to the request it answers
+  const pending = pendingRequests.get(data.request_id);
+  if (!pending || !pending.waiting.has(clientId)) {
+    log.debug('Ignoring response for unknown or completed request:', data.request_id);
+    return;
+  }
+  pending.waiting.delete(clientId);
+  pending.responses.push({ clientId, data });
+
+  // Check if all clients have responded before the timeout
+  if (pending.mode === 'first') {
+    finishRequest(data.request_id, true, 'First client responded');
+  } else if (pending.waiting.size === 0) {
+    finishRequest(data.request_id, true, 'All clients responded');
+  }
+}
+
+function handleClientClose(clientId) {
+  // Stop waiting on a client that went away
+  pendingRequests.forEach((pending, requestId) => {
+    if (pending.waiting.delete(clientId)) {
+      pending.responses.push({ clientId, error: 'WebSocket closed' });
+      if (pending.waiting.size === 0) {
+        finishRequest(requestId, true, 'Some clients failed to respond, but continuing');
       }
     }
   });
@@ -107,24 +444,51 @@ app.post('/run', handlePostRequest);
 
 // WebSocket Server for receiving responses from clients
 const server = app.listen(port, () => {
-  console.log(`Server running on http://localhost:${port}`);
+  log.info(`Server running on http://localhost:${port}`);
 });
 
 const wss = new WebSocket.Server({ server });
 
-wss.on('connection', (ws) => {
-  // Assign a unique identifier to the client (you could use something more robust in real scenarios)
-  const clientId = Date.now();
+wss.on('connection', (ws, req) => {
+  if (req.url && req.url.startsWith('/control')) {
+    handleControlConnection(ws);
+    return;
+  }
+
+  // The viewer's registered client id. A reconnecting viewer replaces its
+  //   previous socket.
+  const clientId = clientIdFromUrl(req.url);
   wsClients.set(clientId, ws);
+  log.debug('WebSocket client connected:', clientId);
 
   ws.on('message', (message) => {
     const data = JSON.parse(message);
     //console.log('Received data from client:', data);
-    ws.emit('response', data);  // Emit response event to resolve request
+    if (data.event === 'ready') {
+      handleClientReady(clientId);
+      return;
+    }
+    if (data.event) {
+      // Pushed by the viewer, not a response to a request
+      handleViewerEvent(clientId, data);
+      return;
+    }
+    handleClientResponse(clientId, data);
   });
 
   ws.on('close', () => {
+    if (wsClients.get(clientId) !== ws) {
+      return;  // Replaced by a newer connection with the same client id
+    }
     wsClients.delete(clientId);
-    console.log('WebSocket client disconnected');
+    readyClients.delete(clientId);
+    eventTimers.forEach((state, key) => {
+      if (key.startsWith(`${clientId}:`)) {
+        clearTimeout(state.timer);
+        eventTimers.delete(key);
+      }
+    });
+    handleClientClose(clientId);
+    log.debug('WebSocket client disconnected:', clientId);
   });
 });
\ No newline at end of file
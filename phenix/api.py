@@ -12,42 +12,92 @@ defined in api.ts, which is the typescript counterpart. The program flow is:
   6. The return value of the method is serialized to json and sent back to Python
   7. The json response is interpreted on the Python side.
 """
+import sys
 import json
-from dataclasses import dataclass, asdict, fields, is_dataclass
+import gzip
+import array
+import base64
+import hashlib
+from dataclasses import dataclass, fields, is_dataclass
 from typing import List, Dict, Optional, Literal
-import matplotlib.colors as mcolors
+
+from molstar_adaptbx.phenix.colors import to_rgb
+from molstar_adaptbx.phenix.selection import selection_indices
 
 #################################################################
 # Base class and 'ApiRequest' class                                #
 #################################################################
 
+# Version of the request/response envelope. From version 2 the viewer returns
+#   its output as a json object inside the envelope, rather than as json text
+#   nested in it, so responses are decoded once.
+ENVELOPE_VERSION = 2
+
+# Field kinds, see ApiClass._field_specs
+_PLAIN, _API, _API_LIST = 0, 1, 2
+
+
 class ApiClass:
   """ Base class for all API classes """
-  
+
+  # Class name: class, for every subclass. Used to resolve 'name' in requests.
+  registry = {}
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    ApiClass.registry[cls.__name__] = cls
+
+  @classmethod
+  def _field_specs(cls):
+    """
+    (name, kind, api class) for each field, computed once per class. kind
+    says whether the value is an ApiClass, a list of them, or plain json.
+    """
+    specs = cls.__dict__.get('_field_specs_cache')
+    if specs is None:
+      specs = []
+      for field in fields(cls):
+        if is_dataclass(field.type):
+          specs.append((field.name, _API, field.type))
+        elif getattr(field.type, '__args__', None) and is_dataclass(field.type.__args__[0]):
+          specs.append((field.name, _API_LIST, field.type.__args__[0]))
+        else:
+          specs.append((field.name, _PLAIN, None))
+      specs = tuple(specs)
+      cls._field_specs_cache = specs
+    return specs
+
   def to_dict(self) -> dict:
-    """ Recursively convert dataclass to dict. """
-    return asdict(self)
+    """
+    Convert to a dict of json types. Unlike dataclasses.asdict, plain field
+    values are not copied, so large payloads are serialized in place.
+    """
+    data = {}
+    for name, kind, _ in self._field_specs():
+      value = getattr(self, name)
+      if value is not None:
+        if kind == _API:
+          value = value.to_dict()
+        elif kind == _API_LIST:
+          value = [item.to_dict() for item in value]
+      data[name] = value
+    return data
 
   def to_json(self) -> str:
-    """Convert the object to a JSON string."""
-    data_dict = self.to_dict()
-    return json.dumps(data_dict, indent=2)
+    """Convert the object to a compact JSON string."""
+    return json.dumps(self.to_dict(), separators=(',', ':'))
 
   @classmethod
   def from_dict(cls, data: dict):
     """Recursively instantiate dataclass from dict."""
     init_args = {}
-    
-    for field in fields(cls):
-      field_value = data.get(field.name)
-
-      if is_dataclass(field.type) and isinstance(field_value, dict):
-        init_args[field.name] = field.type.from_dict(field_value)
-      elif isinstance(field_value, list) and is_dataclass(field.type.__args__[0]):
-        init_args[field.name] = [field.type.__args__[0].from_dict(item) for item in field_value]
-      else:
-        init_args[field.name] = field_value
-    
+    for name, kind, api_class in cls._field_specs():
+      value = data.get(name)
+      if kind == _API and isinstance(value, dict):
+        value = api_class.from_dict(value)
+      elif kind == _API_LIST and isinstance(value, list):
+        value = [api_class.from_dict(item) for item in value]
+      init_args[name] = value
     return cls(**init_args)
 
   @classmethod
@@ -59,10 +109,65 @@ class ApiClass:
 
   @classmethod
   def from_response(cls,response):
-    d = response.json()
-    if isinstance(d,dict) and  "responses" in d and isinstance(d["responses"],list):
-      if isinstance(d["responses"][0],dict) and "output" in d["responses"][0]:
-        return cls.from_json(json.loads(d["responses"][0]["output"]))
+    return ApiRequest.from_response_dict(response.json()).data
+
+
+def float32_bytes(values) -> bytes:
+  """
+  Pack numbers (a flex.double, numpy array or sequence) as little-endian float32
+  """
+  if hasattr(values, 'as_numpy_array'):
+    values = values.as_numpy_array()
+  if hasattr(values, 'astype'):
+    return values.astype('<f4').tobytes()
+  packed = array.array('f', values)
+  if sys.byteorder == 'big':
+    packed.byteswap()
+  return packed.tobytes()
+
+def pack_float32(values) -> str:
+  """
+  Pack numbers as little-endian float32 and return the bytes as base64 text
+  """
+  return base64.b64encode(float32_bytes(values)).decode('ascii')
+
+def pack_uint32(values) -> str:
+  """
+  Pack non-negative integers (a flex.size_t, numpy array or sequence) as
+  little-endian uint32 and return the bytes as base64 text
+  """
+  if hasattr(values, 'as_numpy_array'):
+    values = values.as_numpy_array()
+  if hasattr(values, 'astype'):
+    packed = values.astype('<u4').tobytes()
+  else:
+    packed = array.array('I', values)
+    assert packed.itemsize == 4
+    if sys.byteorder == 'big':
+      packed.byteswap()
+    packed = packed.tobytes()
+  return base64.b64encode(packed).decode('ascii')
+
+def pack_uint8(values) -> str:
+  """
+  Pack integers in [0, 255] (a sequence, or numpy array) as bytes and return
+  them as base64 text
+  """
+  if hasattr(values, 'astype'):
+    return base64.b64encode(values.astype('u1').tobytes()).decode('ascii')
+  return base64.b64encode(bytes(values)).decode('ascii')
+
+def _hex_color(color):
+  # A color name, hex code or (r, g, b) floats in [0, 1], as '#rrggbb'
+  if isinstance(color, str):
+    color = to_rgb(color)
+  return '#' + ''.join(f'{int(round(c*255)):02x}' for c in color)
+
+def _flat_sites(sites_cart):
+  # flex.vec3_double or (n_atoms, 3) numpy array, as a flat sequence
+  if hasattr(sites_cart, 'as_double'):
+    return sites_cart.as_double()
+  return sites_cart.reshape(-1)
 
 
 #################################################################
@@ -91,28 +196,179 @@ class RawJSAsync(ApiClass):
 @dataclass
 class SelectionPoll(ApiClass):
   # Inputs:
-  # None
-  
+  columnar: bool = False # Return atom_columns instead of atom_records
+  ranges: bool = False # Return atom_ranges instead of either
+
   # Outputs:
   atom_records: Optional[List[dict]] = None
-  
+  atom_columns: Optional[Dict[str, list]] = None # One list per atom attribute
+  atom_ranges: Optional[List[int]] = None # [start, stop) runs of atom indices, flattened
+  ref_id: Optional[str] = None # The model the selected atoms belong to
+
   def __post_init__(self):
     if self.atom_records and isinstance(self.atom_records,str):
       self.atom_records = json.loads(self.atom_records)
+    if self.atom_columns and isinstance(self.atom_columns,str):
+      self.atom_columns = json.loads(self.atom_columns)
 
 @dataclass
 class MakeSelection(ApiClass):
   # Inputs:
   pymol_sel: str
   focus: bool
+  ref_id: Optional[str] = None # The model atom_ranges refer to
+  atom_ranges: Optional[List[int]] = None # [start, stop) runs of atom indices, used instead of pymol_sel
+
+
+@dataclass
+class MakeAtomSelection(ApiClass):
+  """
+  Select atoms of a loaded model by index, without a selection string. The
+  viewer builds the selection directly from the packed indices.
+  """
+  # Inputs:
+  ref_id: str
+  indices: str # base64 of little-endian uint32
+  n_atoms: int
+  by: Literal['index', 'id'] = 'index' # 0-based index in model order (i_seq), or atom serial (id)
+  focus: bool = True
+  # Outputs:
+  n_selected: Optional[int] = None
 
+  @classmethod
+  def from_selection(cls, ref_id, selection, by='index', focus=True):
+    """
+    selection: a boolean mask over all atoms (flex.bool or numpy bool
+      array), or atom indices (a flex.size_t, numpy array or sequence), e.g.
+      from a neighbor search or outlier list. Negative indices are an error.
+    """
+    selection = selection_indices(selection)
+    return cls(ref_id=ref_id, indices=pack_uint32(selection), n_atoms=len(selection),
+      by=by, focus=focus)
+
+
+@dataclass
+class SelectionCacheInfo(ApiClass):
+  # Inputs:
+  clear: bool = False # Empty the viewer's selection cache after reading it
+
+  # Outputs:
+  hits: int = 0
+  misses: int = 0
+  size: int = 0
+  maxsize: int = 0
 
 
 @dataclass
 class LoadModel(ApiClass):
   # Inputs:
   ref_id: str
-  pdb_str: str
+  pdb_str: str  # The model in 'format', as text or base64 according to 'encoding'
+  format: Literal['pdb','mmcif','bcif'] = 'pdb'
+  encoding: Literal['text','base64','gzip'] = 'text' # gzip: base64 of gzipped bytes
+  content_hash: Optional[str] = None # If set, the viewer keeps the data for LoadCachedModel
+
+  @classmethod
+  def from_model_data(cls, ref_id, data, format='pdb', compress=False, compress_level=1):
+    """
+    Build a LoadModel call from model text (pdb/mmcif) or bytes (bcif),
+    optionally gzip compressed. Binary payloads are sent as base64.
+    """
+    assert format in ['pdb','mmcif','bcif'], f"Unsupported model format: {format}"
+    if isinstance(data, str) and not compress:
+      payload = data
+      encoding = 'text'
+    else:
+      if isinstance(data, str):
+        data = data.encode('utf-8')
+      if compress:
+        data = gzip.compress(data, compresslevel=compress_level)
+        encoding = 'gzip'
+      else:
+        encoding = 'base64'
+      payload = base64.b64encode(data).decode('ascii')
+    content_hash = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return cls(ref_id=ref_id, pdb_str=payload, format=format, encoding=encoding,
+               content_hash=content_hash)
+
+
+@dataclass
+class LoadCachedModel(ApiClass):
+  # Inputs:
+  ref_id: str
+  content_hash: str # The content_hash of a LoadModel call the viewer has seen
+
+  # Outputs:
+  found: bool = False # If False, nothing was loaded and the full LoadModel is needed
+
+@dataclass
+class UpdateCoordinates(ApiClass):
+  # Inputs:
+  ref_id: str
+  xyz: str  # base64 of little-endian float32 x,y,z per atom, in model order
+  n_atoms: int
+
+  @classmethod
+  def from_sites_cart(cls, ref_id, sites_cart):
+    """
+    sites_cart: a flex.vec3_double (e.g. model.get_sites_cart()), or an
+      (n_atoms, 3) numpy array
+    """
+    values = _flat_sites(sites_cart)
+    n_atoms = len(values) // 3
+    return cls(ref_id=ref_id, xyz=pack_float32(values), n_atoms=n_atoms)
+
+@dataclass
+class AppendFrames(ApiClass):
+  # Inputs:
+  ref_id: str
+  xyz: str  # base64 of little-endian float32 x,y,z per atom, frame after frame
+  n_atoms: int
+  n_frames: int
+  capacity: int = 1024 # Frames the viewer buffers for this model
+  keep_frames: bool = False # Keep played frames (needed to loop), else drop them
+  complete: bool = False # No more frames will follow
+  restart: bool = False # Discard frames from a previous stream for this model
+
+  # Outputs:
+  buffered: Optional[int] = None # Frames held by the viewer after appending
+  total: Optional[int] = None # Frames received so far
+
+  @classmethod
+  def from_frames(cls, ref_id, frames, **kwargs):
+    """
+    frames: a list of sites_cart, each a flex.vec3_double or (n_atoms, 3) numpy array
+    """
+    data = []
+    n_atoms = None
+    for sites_cart in frames:
+      values = _flat_sites(sites_cart)
+      if n_atoms is None:
+        n_atoms = len(values) // 3
+      assert len(values) == 3*n_atoms, "All frames must have the same number of atoms"
+      data.append(float32_bytes(values))
+    return cls(ref_id=ref_id, xyz=base64.b64encode(b"".join(data)).decode('ascii'),
+               n_atoms=n_atoms or 0, n_frames=len(data), **kwargs)
+
+@dataclass
+class TrajectoryStatus(ApiClass):
+  # Inputs:
+  ref_id: str
+
+  # Outputs:
+  buffered: Optional[int] = None # Frames held by the viewer
+  capacity: Optional[int] = None
+  total: Optional[int] = None # Frames received so far
+  current: Optional[int] = None # Index of the frame shown
+  playing: Optional[bool] = None
+
+@dataclass
+class PlayTrajectory(ApiClass):
+  # Inputs:
+  ref_id: str
+  fps: float = 10.0
+  loop: bool = False # Requires frames streamed with keep_frames=True
+  play: bool = True # False to pause
 
 @dataclass
 class ClearViewer(ApiClass):
@@ -153,16 +409,81 @@ class SetColor(ApiClass):
 
   def __post_init__(self):
     color = self.color_string
-    if color in mcolors.CSS4_COLORS:
-      rgb = mcolors.to_rgb(mcolors.CSS4_COLORS[color])
-    elif color.startswith('#'):
-      rgb = mcolors.to_rgb(color)
-    else:
+    try:
+      rgb = to_rgb(color)
+    except ValueError:
       raise ValueError("Unknown named color or invalid hex code")
     rgb = tuple(e*255 for e in rgb)
     self.R, self.G, self.B = rgb
 
 
+@dataclass
+class SetColorArray(ApiClass):
+  """
+  Color a loaded model with one value or color per atom (or per residue), in
+  a single call. The viewer applies it as a color theme to every
+  representation of the model.
+  """
+  # Inputs:
+  ref_id: str
+  per: Literal['atom', 'residue'] = 'atom' # atoms in i_seq order, residues in residue_groups() order
+  n_values: int = 0
+  values: Optional[str] = None # base64 of little-endian float32. Colored by color_scale, NaN is missing
+  rgb: Optional[str] = None # base64 of r, g, b bytes per value, used instead of values
+  color_scale: Optional[List[str]] = None # '#rrggbb' colors from low to high, blue-white-red by default
+  domain: Optional[List[float]] = None # [min, max] of color_scale, the range of values by default
+  missing_color: str = '#808080'
+  clear: bool = False # Restore the default coloring instead
+
+  @classmethod
+  def from_values(cls, ref_id, values, per='atom', color_scale=None, domain=None, missing_color='grey'):
+    """
+    values: a flex.double, numpy array or sequence of numbers, e.g. B-factors
+    color_scale: color names or hex codes, from low to high
+    """
+    if color_scale is not None:
+      color_scale = [_hex_color(color) for color in color_scale]
+    if domain is not None:
+      domain = [float(domain[0]), float(domain[1])]
+    return cls(ref_id=ref_id, per=per, n_values=len(values), values=pack_float32(values),
+      color_scale=color_scale, domain=domain, missing_color=_hex_color(missing_color))
+
+  @classmethod
+  def from_colors(cls, ref_id, colors, per='atom', missing_color='grey'):
+    """
+    colors: color names, hex codes or (r, g, b) floats in [0, 1], one per
+      atom or residue. An (n, 3) numpy array of uint8 is sent as is.
+    """
+    if hasattr(colors, 'astype') and colors.dtype.kind == 'u':
+      rgb = pack_uint8(colors.reshape(-1))
+    else:
+      rgb = bytearray()
+      for color in colors:
+        if isinstance(color, str):
+          color = to_rgb(color)
+        rgb.extend(int(round(c*255)) for c in color)
+      rgb = pack_uint8(rgb)
+    return cls(ref_id=ref_id, per=per, n_values=len(colors), rgb=rgb,
+      missing_color=_hex_color(missing_color))
+
+
+
+@dataclass
+class ApiBatch(ApiClass):
+  # Inputs:
+  commands: List[ApiClass]  # Run in order by the viewer, in one round trip
+
+  # Outputs:
+  # The same list, with each command's outputs populated
+
+  def to_dict(self) -> dict:
+    # Each command is wrapped as an ApiRequest so the viewer can resolve its class
+    return {"commands": [ApiRequest(data=command).to_dict() for command in self.commands]}
+
+  @classmethod
+  def from_dict(cls, data: dict):
+    return cls(commands=[ApiRequest.from_dict(command).data for command in data["commands"]])
+
 
 #Specialized ApiRequest class that handles dynamic 'data' field
 
@@ -170,20 +491,30 @@ class SetColor(ApiClass):
 class ApiRequest(ApiClass):
   name: str  # Holds the class name of the data field
   data: ApiClass  # Holds an instance of another ApiClass subclass
+  request_id: Optional[str] = None  # Matches a response to its request
+  target: Optional[str] = None  # Client id of the viewer to send the request to
+  mode: Optional[Literal['target','first','all']] = None  # How the server routes the request
 
-  def __init__(self, data: ApiClass):
+  def __init__(self, data: ApiClass, request_id: Optional[str] = None,
+      target: Optional[str] = None, mode: Optional[str] = None):
     """Automatically populate 'name' from the class of 'data'."""
     self.data = data
     self.name = data.__class__.__name__  # Automatically set the name based on data's class
+    self.request_id = request_id
+    self.target = target
+    self.mode = mode
 
-  def to_json(self) -> str:
-    """Convert ApiRequest to JSON and use the class name of 'data' for 'name'."""
-    data_dict = self.to_dict()
-    data_dict['name'] = self.data.__class__.__name__  # Set the 'name' field to class name of 'data'
-    data_dict['data'] = self.data.to_dict()  # Convert 'data' to dict
-    return json.dumps(data_dict, indent=2)
+  def to_dict(self) -> dict:
+    """Use the data class's own to_dict, so subclasses can customize it."""
+    data_dict = {"name": self.name, "data": self.data.to_dict(), "v": ENVELOPE_VERSION}
+    if self.request_id is not None:
+      data_dict["request_id"] = self.request_id
+    if self.target is not None:
+      data_dict["target"] = self.target
+    if self.mode is not None:
+      data_dict["mode"] = self.mode
+    return data_dict
 
-  
   @classmethod
   def from_json(cls, json_str: str):
     """Convert JSON back to ApiRequest and resolve 'data' based on 'name'."""
@@ -192,97 +523,61 @@ class ApiRequest(ApiClass):
 
   @classmethod
   def from_dict(cls,data_dict:dict):
-
-    # Dynamically resolve the correct class for 'data'
-    data_class = globals().get(data_dict['name'])  # Assuming all classes are in global scope
-    if not data_class or not issubclass(data_class, ApiClass):
+    # Resolve the correct class for 'data'
+    data_class = ApiClass.registry.get(data_dict['name'])
+    if data_class is None:
       raise ValueError(f"Unknown data class in Python: {data_dict['name']}")
 
     # Deserialize 'data' as the resolved class
     data_obj = data_class.from_dict(data_dict['data'])
-    
-    # Create ApiRequest instance
-    return cls(data=data_obj)
-
-#################################################################
-# Api objects for representing Molstar internal state in Python #
-#################################################################
-
-@dataclass
-class Component(ApiClass):
-  phenixKey: str
-  key: str
-  representations: List[str]
-
-@dataclass
-class Representation(ApiClass):
-  phenixKey: str
-  name: str
-
-@dataclass
-class Structure(ApiClass):
-  phenixReferenceKey: str
-  phenixKey: str
-  data_id: str
-  key: str
-  components: List[Component]
-
 
-@dataclass
-class Reference(ApiClass):
-  id_viewer: Optional[str]
-  id_molstar: Optional[str]
-  structures: List[Structure]
+    # Create ApiRequest instance
+    return cls(data=data_obj,request_id=data_dict.get('request_id'))
 
   @classmethod
-  def from_default(cls):
-    return cls(
-      id_viewer = None,
-      id_molstar = None,
-      structure = None
-    )
-
-  @property
-  def representations(self):
-    output = []
-    for structure in self.structures:
-      for component in structure.components:
-        for repr_name in component.representations:
-          output.append(repr_name)
-    return output
-
-@dataclass
-class Component(ApiClass):
-  phenixKey: str
-  key: str
-  representations: List[str]
-
+  def from_response_dict(cls, response_dict: dict):
+    """
+    Unpack the json body returned by the server for a /run request.
+    Raises RuntimeError if it does not have the expected structure.
+    """
+    try:
+      # Mandatory checks
+      assert isinstance(response_dict,dict)
+      assert "success" in response_dict and response_dict["success"]
+      assert "responses" in response_dict
+      assert isinstance(response_dict["responses"],list)
+      assert isinstance(response_dict["responses"][0],dict)
+      assert "data" in response_dict["responses"][0]
+      client_data = response_dict["responses"][0]["data"]
+    except AssertionError as e:
+      raise RuntimeError("Response did not meet expected form.") from e
+    if "error" in client_data:
+      raise RuntimeError(f"Error in viewer: {client_data['error']}")
+    try:
+      output = client_data["output"]
+      # Version 1 viewers send the output as json text, json encoded again
+      while isinstance(output,str):
+        output = json.loads(output)
+      if isinstance(output,dict) and "error" in output:
+        raise RuntimeError(f"Error in viewer: {output['error']}")
+      return cls.from_dict(output)
+    except (KeyError, TypeError, ValueError) as e:
+      raise RuntimeError("Response did not meet expected form.") from e
 
-@dataclass
-class Representation(ApiClass):
-  phenixKey: str
-  name: str
-
-@dataclass
-class Structure(ApiClass):
-  phenixReferenceKey: str
-  phenixKey: str
-  data_id: str
-  key: str
-  components: List[Component]
-
-@dataclass
-class Reference(ApiClass):
-  id_viewer: Optional[str]
-  id_molstar: Optional[str]
-  structures: List[Structure]
+#################################################################
+# Molstar internal state, mirrored in Python by state.StateStore #
+#################################################################
 
 @dataclass
 class MolstarState(ApiClass):
   connection_id: str # A unique id for each adapter connection
   has_synced: bool
-  references: List[Reference]
+  references: List[dict] # The whole state tree, if since_version is None
+  version: int = 0 # Output: bumped by every change to the viewer state
+  since_version: Optional[int] = None # Input: return only the changes after this version
+  changes: Optional[List[dict]] = None # Output, if since_version was given (see state.StateStore)
 
   @classmethod
-  def from_empty(cls,connection_id=""):
-    return cls(references=[],has_synced=False,connection_id=connection_id)
\ No newline at end of file
+  def from_empty(cls,connection_id="",since_version=None):
+    return cls(references=[],has_synced=False,connection_id=connection_id,
+      since_version=since_version)
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""
+Small caches used by the Python interface to avoid repeating work
+"""
+from collections import OrderedDict
+
+
+class LRUCache:
+  """
+  A bounded mapping that evicts the least recently used entries. Entries are
+  evicted when there are more than maxsize of them, or when their total size
+  (the nbytes given to set) exceeds max_bytes. Hits and misses are counted.
+  """
+  def __init__(self, maxsize=128, max_bytes=None):
+    self.maxsize = maxsize
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.nbytes = 0
+    self._data = OrderedDict() # key: (value, nbytes)
+
+  def get(self, key, default=None):
+    entry = self._data.get(key)
+    if entry is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    self._data.move_to_end(key)
+    return entry[0]
+
+  def set(self, key, value, nbytes=0):
+    if key in self._data:
+      self.nbytes -= self._data.pop(key)[1]
+    self._data[key] = (value, nbytes)
+    self.nbytes += nbytes
+    while self._data and (len(self._data) > self.maxsize or
+        (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+      _, (_, evicted_nbytes) = self._data.popitem(last=False)
+      self.nbytes -= evicted_nbytes
+
+  def clear(self):
+    self._data.clear()
+    self.nbytes = 0
+
+  def __contains__(self, key):
+    return key in self._data
+
+  def __len__(self):
+    return len(self._data)
+
+  @property
+  def info(self):
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "size": len(self._data),
+      "maxsize": self.maxsize,
+      "nbytes": self.nbytes,
+    }
@@ -0,0 +1,156 @@
+"""
+Timing of api calls, per stage of the round trip and per api class.
+
+Every request is timed at each stage: encoding in Python, transfer to the
+server, relay to the viewer, run() in the viewer, and the way back. Stages
+measured across processes use wall clock timestamps (ms since the epoch) from
+each side, so on one machine they are accurate to about a millisecond.
+"""
+import bisect
+import math
+import time
+
+# Upper bounds (ms) of the histogram buckets. The same bounds are used by
+#   the /metrics endpoint of server.js.
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Stage: (start stamp, end stamp)
+STAGES = {
+  "encode": ("py_encode", "py_send"),
+  "to_server": ("py_send", "server_receive"),
+  "relay": ("server_receive", "client_receive"),
+  "client_parse": ("client_receive", "run_start"),
+  "run": ("run_start", "run_end"),
+  "client_encode": ("run_end", "client_reply"),
+  "to_server_reply": ("client_reply", "server_reply"),
+  "to_python": ("server_reply", "py_receive"),
+  "decode": ("py_receive", "py_decode"),
+  "total": ("py_encode", "py_decode"),
+}
+
+
+def now_ms():
+  return time.time()*1000
+
+
+def is_valid_duration(value):
+  """
+  False for negative durations, from clocks out of step between processes,
+  and for non-finite ones. These are not recorded, as in server.js.
+  """
+  return isinstance(value, (int, float)) and math.isfinite(value) and value >= 0
+
+
+def stage_durations(stamps):
+  """
+  Durations (ms) of the stages whose start and end stamps are both known
+  """
+  durations = {}
+  for stage, (start, end) in STAGES.items():
+    if start in stamps and end in stamps:
+      durations[stage] = stamps[end] - stamps[start]
+  return durations
+
+
+def response_stamps(response_dict):
+  """
+  The server and viewer timestamps in a response body from server.js
+  """
+  stamps = {}
+  if not isinstance(response_dict, dict):
+    return stamps
+  stamps.update(response_dict.get("timing") or {})
+  responses = response_dict.get("responses") or []
+  if responses and isinstance(responses[0], dict):
+    stamps.update((responses[0].get("data") or {}).get("timing") or {})
+  return stamps
+
+
+class Histogram:
+  """
+  Counts of values (ms) in the BUCKETS, plus count, sum, min and max
+  """
+  def __init__(self):
+    self.counts = [0]*(len(BUCKETS) + 1) # the last bucket is +inf
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, value):
+    if not is_valid_duration(value):
+      return
+    self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+    self.count += 1
+    self.sum += value
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+  def percentile(self, p):
+    """
+    The upper bound of the bucket holding the p-th percentile
+    """
+    if self.count == 0:
+      return None
+    rank = p/100*self.count
+    seen = 0
+    for bound, count in zip(BUCKETS + (self.max,), self.counts):
+      seen += count
+      if seen >= rank and count:
+        return min(bound, self.max)
+    return self.max
+
+  def to_dict(self):
+    return {
+      "count": self.count,
+      "sum": self.sum,
+      "min": self.min,
+      "max": self.max,
+      "mean": self.sum/self.count if self.count else None,
+      "p50": self.percentile(50),
+      "p90": self.percentile(90),
+      "p99": self.percentile(99),
+      "buckets": dict(zip([str(b) for b in BUCKETS] + ["+inf"], self.counts)),
+    }
+
+
+class Metrics:
+  """
+  Histograms of stage durations, per api class name
+  """
+  def __init__(self):
+    self.histograms = {} # api class name: {stage: Histogram}
+
+  def record(self, name, durations):
+    for stage, value in durations.items():
+      if not is_valid_duration(value):
+        continue
+      stages = self.histograms.setdefault(name, {})
+      histogram = stages.get(stage)
+      if histogram is None:
+        histogram = stages[stage] = Histogram()
+      histogram.add(value)
+
+  def clear(self):
+    self.histograms.clear()
+
+  def summary(self):
+    """
+    {api class name: {stage: histogram dict}}
+    """
+    return {name: {stage: histogram.to_dict() for stage, histogram in stages.items()}
+      for name, stages in self.histograms.items()}
+
+  def report(self, stage_names=("encode", "to_server", "relay", "run", "to_python", "decode", "total")):
+    """
+    A text table of mean stage durations (ms) per api class
+    """
+    lines = [f"{'call':<22} {'n':>6} " + " ".join(f"{stage:>10}" for stage in stage_names)]
+    for name, stages in sorted(self.histograms.items()):
+      count = stages["total"].count if "total" in stages else 0
+      cells = []
+      for stage in stage_names:
+        histogram = stages.get(stage)
+        cells.append(f"{histogram.sum/histogram.count:10.2f}" if histogram and histogram.count else f"{'-':>10}")
+      lines.append(f"{name:<22} {count:>6} " + " ".join(cells))
+    return "\n".join(lines)
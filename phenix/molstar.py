@@ -6,13 +6,14 @@ from pathlib import Path
 import time
 import json
 import uuid
+import hashlib
 from typing import Optional
 
-import requests
-import webbrowser
 from contextlib import contextmanager
-import urllib.parse
-import subprocess
+import socket
+import logging
+import queue
+import threading
 
 from qttbx.viewers import ModelViewer
 
@@ -21,12 +22,20 @@ from libtbx import group_args
 from molstar_adaptbx.phenix.api import (
   ApiClass,
   ApiRequest,
+  ApiBatch,
   RawJS,
   RawJSAsync, 
   MolstarState, 
   SelectionPoll,
   MakeSelection,
+  MakeAtomSelection,
+  SelectionCacheInfo,
   LoadModel, 
+  LoadCachedModel,
+  UpdateCoordinates,
+  AppendFrames,
+  TrajectoryStatus,
+  PlayTrajectory,
   Focus,
   ClearViewer,
   ResetView,
@@ -34,7 +43,29 @@ from molstar_adaptbx.phenix.api import (
   SetPickingGranularity,
   AddRepresentation,
   SetColor,
+  SetColorArray,
 )
+from molstar_adaptbx.phenix.cache import LRUCache
+from molstar_adaptbx.phenix.metrics import Metrics, now_ms, response_stamps, stage_durations
+from molstar_adaptbx.phenix.selection import SelectionColumns, SelectionRanges, AtomIndex
+from molstar_adaptbx.phenix.state import StateStore
+
+logger = logging.getLogger(__name__)
+
+def enable_debug_logging(enable=True):
+  """
+  Show debug messages of molstar_adaptbx on stderr. Otherwise, logging is
+  configured by the application as usual.
+  """
+  package_logger = logging.getLogger("molstar_adaptbx")
+  if enable:
+    package_logger.setLevel(logging.DEBUG)
+    if not package_logger.handlers:
+      handler = logging.StreamHandler()
+      handler.setFormatter(logging.Formatter("%(name)s %(levelname)s: %(message)s"))
+      package_logger.addHandler(handler)
+  else:
+    package_logger.setLevel(logging.NOTSET)
 # =============================================================================
 
 class MolstarGraphics(ModelViewer):
@@ -48,6 +79,13 @@ class MolstarGraphics(ModelViewer):
       web_view=None,
       dm=None,
       server=None,
+      pool_connections=1,
+      pool_maxsize=4,
+      connect_timeout=3.05,
+      read_timeout=30,
+      max_retries=0,
+      use_websocket=False,
+      route='target',
       ):
     super().__init__()
     self.server= server  # Exposes the api over http
@@ -56,19 +94,55 @@ class MolstarGraphics(ModelViewer):
     self.dm = dm
     self.loaded = {}
     self.connection_id = str(uuid.uuid4())
+    # How the server routes requests: 'target' to the viewer opened by
+    #   start_viewer (registered with connection_id), 'first' to all viewers
+    #   taking the first response, or 'all' to all viewers, waiting for each.
+    assert route in ['target','first','all']
+    self.route = route
     self.last_response = None
 
+    # HTTP connection pool (keep-alive) to the node server
+    self.pool_connections = pool_connections # Number of distinct hosts to pool
+    self.pool_maxsize = pool_maxsize # Connections kept open per host
+    self.max_retries = max_retries
+    self.timeout = (connect_timeout, read_timeout) # seconds, as used by requests
+    self._session = None
+
+    # Model payloads larger than this (bytes) are gzipped by default
+    self.compress_threshold = 1024*1024
+    # Serialized models (LoadModel calls), keyed by model fingerprint
+    self.model_cache = LRUCache(maxsize=16,max_bytes=512*1024*1024)
+    self.sent_content_hashes = set() # content_hash of every LoadModel sent to the viewer
+    self.atom_indices = {} # ref_id: AtomIndex
+    self.atom_index_cache = LRUCache(maxsize=16) # model fingerprint: AtomIndex
+    self.selection_cache = LRUCache(maxsize=256) # (selection, src, dst): translated selection
+
+    # Callbacks for events pushed by the viewer, run on a dispatcher thread
+    self._event_callbacks = {} # event name: [callback, ...]
+    self._event_queue = None
+    self._event_response = None
+    self._event_threads = []
+
+    # Optional persistent WebSocket to the node server (HTTP is the fallback)
+    self.use_websocket = use_websocket # Connect it in start_viewer
+    self._ws = None
+
     self.log_list = []
-    self.debug = True
+    self.metrics = Metrics() # Stage durations of every api call, per api class
+    self.last_timing = None # Stage durations (ms) of the last api call
+    self.viewer_state = StateStore() # Mirror of the viewer state, see sync_remote
     self._initial_sync_done = False # Set to True the first time communication is established with js viewer
+    self.startup_timings = {} # Duration (s) of each start_viewer phase
 
 
     # Flags
     self._blocking_commands = False
+    self._batch = None # An ApiBatch collecting calls, when inside self.batch()
 
   def log(self,*args):
-    if self.debug:
-      print(*args)
+    # Debug messages, formatted only if debug logging is enabled
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(' '.join(str(arg) for arg in args))
 
   # ---------------------------------------------------------------------------
   # Start API
@@ -113,65 +187,113 @@ class MolstarGraphics(ModelViewer):
   def start_viewer(self,volume_streaming=False,timeout=60):
     '''
     Function for starting Molstar. Sequence of events:
-      1. Start web server for molstar app
-      2. Start volume server for volume streaming
+      1. Start web server for molstar app, wait for its /health endpoint
+      2. Open the viewer in a browser or the web view
+      3. Wait for the viewer to report that its plugin is initialized
+
+    Each phase returns as soon as it is done. Their durations (seconds) are
+    stored in self.startup_timings.
 
     Parameters
     ----------
+      timeout: seconds to wait for the server and the viewer to be ready
 
     Returns
     -------
       Nothing
     '''
+    t_start = time.perf_counter()
+    deadline = t_start + timeout
+    timings = {}
 
     # Start node http-server
     if self.server:
-      self.log()
-      self.log('-'*79)
-      self.log('Starting HTTP server for Molstar')
+      logger.info('Starting HTTP server for Molstar')
       self.server.start()
       self.command = self.server.command
       self.port = self.server.port
       self.url = self.server.url
-    
+
+    # The server process can not notify us, so poll its health endpoint
+    t0 = time.perf_counter()
+    interval = 0.01
+    while not self._check_status():
+      if time.perf_counter() > deadline:
+        raise Sorry(' Molstar server not reachable at {} after '
+                    '{} seconds.'.format(self.url, timeout))
+      time.sleep(interval)
+      interval = min(2*interval, 0.2)
+    timings['server'] = time.perf_counter() - t0
+
     # Set url on web view
+    t0 = time.perf_counter()
     if not self.web_view:
-      time.sleep(2)
       # open in browser
-      webbrowser.open(self.url)
+      import webbrowser
+      webbrowser.open(self.url_viewer)
     else:
       # open in qt web view
-      self.web_view.set_url(self.url)
-
-    # Wait until ready
-    counter = 0
-    while counter<timeout:
-      self._check_status()
-      if self._connected:
-        break
-      counter += 1
-      time.sleep(1)
-    if not self._connected:
-      raise Sorry(' Molstar not reachable at {} after '
-                  '{} seconds.'.format(self.url, counter))
-    self.log('Molstar is ready')
-    self.log('-'*79)
-    self.log()
+      self.web_view.set_url(self.url_viewer)
+    timings['open'] = time.perf_counter() - t0
+
+    # Wait until the viewer signals it is ready. The server holds the request
+    #   open until then.
+    t0 = time.perf_counter()
+    while not self._check_ready(wait=deadline - time.perf_counter()):
+      if time.perf_counter() > deadline:
+        raise Sorry(' Molstar viewer at {} not ready after '
+                    '{} seconds.'.format(self.url, timeout))
+    timings['viewer'] = time.perf_counter() - t0
+
+    if self.use_websocket:
+      self.connect_websocket()
+    timings['total'] = time.perf_counter() - t_start
+    self.startup_timings = timings
+    logger.info('Molstar is ready. Startup timings: %s', ', '.join(
+      f'{phase} {seconds:.3f} s' for phase, seconds in timings.items()))
+
+  @property
+  def url_viewer(self):
+    # The viewer registers with the server using our connection_id
+    return f"{self.server.url}/?client-id={self.connection_id}"
 
+  @property
+  def url_health(self):
+    return self.server.url + "/health"
 
   def _check_status(self):
     '''
     Check if the server is available
     '''
-    output = None
+    import requests
     try:
-      output = requests.get(url=self.url)
-      if output.status_code == 200:
-        self._connected = True
-    except requests.exceptions.ConnectionError:
+      output = self.session.get(url=self.url_health,timeout=self.timeout)
+      self._connected = output.status_code == 200
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
       self._connected = False
     return self._connected
 
+  def _check_ready(self,wait=0):
+    '''
+    Check if a viewer has initialized. If wait (seconds) > 0, the server
+    answers as soon as one is, or after wait.
+    '''
+    import requests
+    wait = max(0, wait)
+    connect_timeout, read_timeout = self.timeout
+    params = {"wait_ready": int(wait*1000)}
+    if self.route == 'target':
+      params["client_id"] = self.connection_id
+    try:
+      output = self.session.get(
+        url=self.url_health,
+        params=params,
+        timeout=(connect_timeout, wait + read_timeout))
+      return output.status_code == 200 and output.json().get("ready", False)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError):
+      time.sleep(0.1) # Server went away, avoid spinning
+      return False
+
   def __del__(self):
     self.close_viewer()
 
@@ -188,6 +310,9 @@ class MolstarGraphics(ModelViewer):
 
   def close_viewer(self):
     with self._wait_for_connection():
+      self._stop_event_listener()
+      self.close_websocket()
+      self._close_session()
       self.server.stop()
 
   def log_message(self,message):
@@ -200,6 +325,169 @@ class MolstarGraphics(ModelViewer):
   def url_api(self):
     return self.server.url + "/run"
 
+  @property
+  def session(self):
+    """
+    A requests.Session holding a keep-alive connection pool to the node
+    server. Created on first use so that every api call reuses the same
+    TCP connection(s) instead of opening a new one.
+    """
+    if self._session is None:
+      import requests
+      from requests.adapters import HTTPAdapter
+      adapter = HTTPAdapter(
+        pool_connections=self.pool_connections,
+        pool_maxsize=self.pool_maxsize,
+        max_retries=self.max_retries,
+      )
+      session = requests.Session()
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+      session.headers.update({"Connection": "keep-alive"})
+      self._session = session
+    return self._session
+
+  @property
+  def url_ws(self):
+    return self.server.url.replace("http://","ws://",1) + "/control"
+
+  def connect_websocket(self):
+    """
+    Open a persistent WebSocket to the node server, which relays each frame
+    directly to the viewer's socket. While it is open, send_request uses it
+    instead of HTTP POST /run. Requires websocket-client.
+    """
+    try:
+      import websocket
+    except ImportError:
+      raise RuntimeError("Unable to import websocket (websocket-client). \
+       Cannot use the WebSocket channel.")
+    connect_timeout, read_timeout = self.timeout
+    self._ws = websocket.create_connection(
+      self.url_ws,
+      timeout=connect_timeout,
+      sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+    )
+    self._ws.settimeout(read_timeout)
+
+  def close_websocket(self):
+    ws = getattr(self,"_ws",None)
+    if ws is not None:
+      ws.close()
+      self._ws = None
+
+  def _send_request_ws(self,request: ApiRequest,body: str):
+    """
+    Send a request (encoded as body) over the persistent WebSocket and wait
+    for its reply. Returns the response dict, or None if the connection was
+    lost before the request was sent (the caller then falls back to HTTP).
+    """
+    import websocket
+    try:
+      self._ws.send(body)
+    except (websocket.WebSocketConnectionClosedException, OSError):
+      logger.warning("WebSocket connection lost, falling back to HTTP")
+      self.close_websocket()
+      return None
+    try:
+      while True:
+        response_dict = json.loads(self._ws.recv())
+        if response_dict.get("request_id") == request.request_id:
+          return response_dict
+        # Otherwise a late reply to an earlier request, discard
+    except websocket.WebSocketTimeoutException:
+      raise RuntimeError(f"Timeout waiting for response to {request.name}")
+    except (websocket.WebSocketConnectionClosedException, OSError):
+      self.close_websocket()
+      raise RuntimeError(f"WebSocket connection lost waiting for response to {request.name}")
+
+  @property
+  def url_events(self):
+    return self.server.url + "/viewer-events"
+
+  def add_event_callback(self,event,callback):
+    """
+    Call callback(event_dict) for each 'hover', 'click' or 'selection' event
+    pushed by the viewer. event_dict has the keys event, time, client_id and
+    data. The server throttles hover and debounces selection events.
+    Callbacks run one at a time on a dispatcher thread, not the caller's.
+    """
+    assert event in ['hover','click','selection']
+    self._event_callbacks.setdefault(event,[]).append(callback)
+    self._start_event_listener()
+
+  def remove_event_callback(self,event,callback):
+    callbacks = self._event_callbacks.get(event,[])
+    if callback in callbacks:
+      callbacks.remove(callback)
+
+  def _start_event_listener(self):
+    """
+    Start a thread reading the server's event stream, and a dispatcher
+    thread running the callbacks, so slow callbacks do not stall the stream
+    """
+    if self._event_threads:
+      return
+    self._event_queue = queue.Queue()
+    self._event_threads = [
+      threading.Thread(target=self._read_events,name="molstar-events",daemon=True),
+      threading.Thread(target=self._dispatch_events,name="molstar-dispatch",daemon=True),
+    ]
+    for thread in self._event_threads:
+      thread.start()
+
+  def _stop_event_listener(self):
+    if not self._event_threads:
+      return
+    if self._event_response is not None:
+      self._event_response.close()
+    self._event_queue.put(None)
+    self._event_threads = []
+
+  def _read_events(self):
+    import requests
+    connect_timeout, read_timeout = self.timeout
+    try:
+      # A separate connection, the pooled session is for requests
+      response = requests.get(self.url_events,stream=True,timeout=(connect_timeout,None))
+      self._event_response = response
+      for line in response.iter_lines(decode_unicode=True):
+        if line and line.startswith("data: "):
+          self._event_queue.put(json.loads(line[len("data: "):]))
+    except (requests.exceptions.RequestException, AttributeError, ValueError) as e:
+      # AttributeError: the response was closed while reading
+      logger.info("Viewer event stream closed: %s", e)
+    finally:
+      self._event_response = None
+
+  def _dispatch_events(self):
+    while True:
+      event = self._event_queue.get()
+      if event is None:
+        return
+      for callback in list(self._event_callbacks.get(event.get("event"),[])):
+        try:
+          callback(event)
+        except Exception as e:
+          logger.exception("Error in %s event callback", event.get('event'))
+
+  def _close_session(self):
+    """
+    Close all pooled connections
+    """
+    session = getattr(self,"_session",None)
+    if session is not None:
+      session.close()
+      self._session = None
+
+  def _new_request(self,api_data: ApiClass):
+    """
+    Wrap a call in an ApiRequest with a new request id, routed per self.route
+    """
+    if self.route == 'target':
+      return ApiRequest(data=api_data,request_id=uuid.uuid4().hex,target=self.connection_id)
+    return ApiRequest(data=api_data,request_id=uuid.uuid4().hex,mode=self.route)
+
   def send_request(self,api_data: ApiClass):
     """
     Package up an instance of ApiClass and send it to the server. 
@@ -207,53 +495,309 @@ class MolstarGraphics(ModelViewer):
     with the results present as populated member variables.
 
     This keeps all API calls contained to a single class definition.
+
+    Inside a batch() block the call is queued instead, and None is returned.
     """
-    request = ApiRequest(data=api_data)
-    # Send the POST request with the JSON data
-    response = requests.post(self.url_api, json=request.to_dict())
-    self.last_response = response
-    # Response must have a very specific structure
-    try:
-      response_dict = response.json()
-      # Mandatory checks
-      assert isinstance(response_dict,dict)
-      assert "responses" in response_dict
-      assert "success" in response_dict and response_dict["success"]
-      assert isinstance(response_dict,dict)
-      assert "responses" in response_dict
-      assert isinstance(response_dict["responses"],list)
-      assert isinstance(response_dict["responses"][0],dict)
-      assert "data" in response_dict["responses"][0]
-      assert "output" in response_dict["responses"][0]["data"]
-      output = response_dict["responses"][0]["data"]["output"]
-      api_request = ApiRequest.from_json(json.loads(output))
-      api_data = api_request.data
-      return api_data
-    except:
-      print(response.text)
-      raise RuntimeError("Response did not meet expected form.")
+    if self._batch is not None:
+      self._batch.commands.append(api_data)
+      return None
+    request = self._new_request(api_data)
+    stamps = {"py_encode": now_ms()}
+    body = request.to_json()
+    stamps["py_send"] = now_ms()
+    response_dict = None
+    if self._ws is not None:
+      response_dict = self._send_request_ws(request,body)
+      if response_dict is not None:
+        stamps["py_receive"] = now_ms()
+        self.last_response = response_dict
+        api_request = ApiRequest.from_response_dict(response_dict)
+
+    if response_dict is None:
+      # Send the POST request with the JSON data
+      response = self.session.post(self.url_api, data=body,
+        headers={"Content-Type": "application/json"}, timeout=self.timeout)
+      stamps["py_receive"] = now_ms()
+      self.last_response = response
+      # Response must have a very specific structure
+      try:
+        response_dict = response.json()
+        api_request = ApiRequest.from_response_dict(response_dict)
+      except (ValueError, RuntimeError) as e:
+        logger.error("Unexpected response to %s: %s", request.name, response.text)
+        if isinstance(e, RuntimeError):
+          raise
+        raise RuntimeError("Response did not meet expected form.")
+
+    stamps["py_decode"] = now_ms()
+    stamps.update(response_stamps(response_dict))
+    self.last_timing = stage_durations(stamps)
+    self.metrics.record(request.name, self.last_timing)
+    return api_request.data
 
   
 
+  @contextmanager
+  def batch(self):
+    """
+    Collect the api calls made inside the block and send them as a single
+    ApiBatch request when the block exits. The viewer runs them in order.
+    Calls inside the block return None; the outputs are available afterwards:
+
+      with graphics.batch() as batch:
+        graphics.select("chain A")
+        graphics.set_color("blue")
+        graphics.poll_selection()
+      atom_records = batch.commands[-1].atom_records
+
+    Nested blocks join the outermost batch. Nothing is sent if the block
+    raises.
+    """
+    if self._batch is not None:
+      yield self._batch
+      return
+    batch = ApiBatch(commands=[])
+    self._batch = batch
+    try:
+      yield batch
+    finally:
+      self._batch = None
+    if batch.commands:
+      result = self.send_request(batch)
+      batch.commands = result.commands
+
+
   # ---------------------------------------------------------------------------
   # Models
 
 
-  def load_model(self,filename=None):
+  def load_model(self,filename=None,format='auto',compress=None):
     """
     Load a model into viewer
+
+    Parameters
+    ----------
+      filename: the model filename in the data manager
+      format: 'pdb', 'mmcif', 'bcif' or 'auto'. 'auto' sends a BinaryCIF file
+        as is, and otherwise pdb if the model fits the format, else mmcif.
+      compress: gzip the payload. If None, compress payloads larger than
+        self.compress_threshold bytes.
+
+    An unchanged model that was loaded before is not serialized again, and
+    if the viewer still holds its data, it is not sent again either. The
+    first load of some content is sent directly, without the handshake.
     """
+    call = self._load_model_call(filename=filename,format=format,compress=compress)
+    if self._batch is None and self._was_sent(call):
+      cached = self.send_request(self._load_cached_model_call(call))
+      if cached.found:
+        return
+    self.send_request(call)
+    self.sent_content_hashes.add(call.content_hash)
+
+  def _was_sent(self,call):
+    """
+    If the viewer may hold the data of a LoadModel call, from an earlier load
+    of the same content. It may have dropped it since, which the handshake
+    reports.
+    """
+    return call.content_hash in self.sent_content_hashes
 
+  def _load_cached_model_call(self,call):
+    """
+    The handshake for a LoadModel call: load from the viewer's copy of the
+    same content, if it has one.
+    """
+    return LoadCachedModel(ref_id=call.ref_id,content_hash=call.content_hash)
+
+  def _load_model_call(self,filename=None,format='auto',compress=None):
+    """
+    Register a new ref_id for a model and build the LoadModel call for it
+    """
+    assert format in ['auto','pdb','mmcif','bcif']
     # Store that this model has been loaded
     ref_id = str(uuid.uuid4())
     self.loaded[ref_id] = filename
 
-    # Serialize as pdb string
-    model = self.dm.get_model(filename=filename)
-    model_str = model.model_as_pdb()
-    call = LoadModel(pdb_str=model_str,ref_id=ref_id)
+    if format == 'auto' and filename is not None and str(filename).lower().endswith('.bcif'):
+      format = 'bcif'
+    if format == 'bcif':
+      # No BinaryCIF writer, so only a file on disk can be sent in that format
+      model_data = Path(filename).read_bytes()
+      key = (hashlib.sha1(model_data).hexdigest(), format, compress)
+      cached = self.model_cache.get(key)
+      if filename in self.dm.get_model_names():
+        self.atom_indices[ref_id] = self._atom_index(self.dm.get_model(filename=filename))
+    else:
+      model = self.dm.get_model(filename=filename)
+      if format == 'auto':
+        format = 'pdb' if model.can_be_output_as_pdb() else 'mmcif'
+      key = (self._model_fingerprint(model), format, compress)
+      cached = self.model_cache.get(key)
+      self.atom_indices[ref_id] = self._atom_index(model, key[0])
+      if cached is None:
+        if format == 'pdb':
+          model_data = model.model_as_pdb()
+        else:
+          model_data = model.model_as_mmcif()
+
+    if cached is None:
+      if compress is None:
+        compress = len(model_data) > self.compress_threshold
+      cached = LoadModel.from_model_data(ref_id,model_data,format=format,compress=compress)
+      self.model_cache.set(key,cached,nbytes=len(cached.pdb_str))
+    return LoadModel(
+      ref_id=ref_id,
+      pdb_str=cached.pdb_str,
+      format=cached.format,
+      encoding=cached.encoding,
+      content_hash=cached.content_hash)
+
+  def _atom_index(self,model,fingerprint=None):
+    """
+    The AtomIndex of a model, shared by loads of the same content
+    """
+    if fingerprint is None:
+      fingerprint = self._model_fingerprint(model)
+    atom_index = self.atom_index_cache.get(fingerprint)
+    if atom_index is None:
+      atom_index = AtomIndex(model.get_hierarchy())
+      self.atom_index_cache.set(fingerprint,atom_index)
+    return atom_index
+
+  def atom_index(self,ref_id):
+    """
+    The AtomIndex of a loaded model, mapping viewer atoms to i_seqs
+    """
+    if ref_id not in self.atom_indices:
+      if ref_id not in self.loaded:
+        raise Sorry(f"No model loaded with ref_id: {ref_id}")
+      filename = self.loaded[ref_id]
+      if filename not in self.dm.get_model_names():
+        raise Sorry(f"The model {ref_id} was loaded from {filename}, which is not in the "
+          "data manager, so its atoms cannot be mapped to i_seqs. Add the file to the data "
+          "manager before loading it.")
+      model = self.dm.get_model(filename=filename)
+      self.atom_indices[ref_id] = self._atom_index(model)
+    return self.atom_indices[ref_id]
+
+  def update_coordinates(self,ref_id,sites_cart=None):
+    """
+    Replace the coordinates of a loaded model, keeping its topology. The
+    viewer applies them without re-parsing the model.
+
+    Parameters
+    ----------
+      ref_id: the ref_id of a loaded model (a key of self.loaded)
+      sites_cart: new coordinates for every atom, in model order, e.g.
+        model.get_sites_cart(). If None, they are taken from the model in
+        the data manager.
+    """
+    if ref_id not in self.loaded:
+      raise Sorry(f"No model loaded with ref_id: {ref_id}")
+    if sites_cart is None:
+      model = self.dm.get_model(filename=self.loaded[ref_id])
+      sites_cart = model.get_sites_cart()
+    call = UpdateCoordinates.from_sites_cart(ref_id,sites_cart)
     self.send_request(call)
 
+  def stream_trajectory(self,ref_id,frames,chunk_size=16,capacity=1024,
+      keep_frames=False,play=True,fps=10.0,loop=False,poll_interval=0.1):
+    """
+    Stream coordinate frames for a loaded model to the viewer for playback.
+    Frames are pulled from the iterable one chunk at a time, so only
+    chunk_size frames are held in Python. The viewer buffers up to
+    'capacity' frames. When the buffer is full, streaming waits until
+    playback has consumed enough of them.
+
+    Parameters
+    ----------
+      ref_id: the ref_id of a loaded model (a key of self.loaded)
+      frames: an iterable (e.g. a generator) of sites_cart, each a
+        flex.vec3_double or (n_atoms, 3) numpy array, in model order
+      keep_frames: keep played frames in the viewer. Needed to loop, and
+        then the trajectory must fit in 'capacity'.
+      play: start playback once the first chunk has arrived
+
+    Returns
+    -------
+      The number of frames streamed
+    """
+    if ref_id not in self.loaded:
+      raise Sorry(f"No model loaded with ref_id: {ref_id}")
+    assert self._batch is None, "Trajectories cannot be streamed inside a batch"
+    assert chunk_size <= capacity
+    assert keep_frames or not loop, "Looping requires keep_frames=True"
+
+    n_sent = 0
+    free = capacity
+    chunk = []
+    iterator = iter(frames)
+    while True:
+      sites_cart = next(iterator,None)
+      if sites_cart is not None:
+        chunk.append(sites_cart)
+        if len(chunk) < chunk_size:
+          continue
+      complete = sites_cart is None
+
+      # Flow control: wait for room in the viewer's buffer
+      while len(chunk) > free:
+        if keep_frames:
+          raise Sorry(f"Trajectory does not fit in {capacity} frames with keep_frames=True")
+        time.sleep(poll_interval)
+        status = self.send_request(TrajectoryStatus(ref_id=ref_id))
+        free = status.capacity - status.buffered
+
+      call = AppendFrames.from_frames(ref_id,chunk,capacity=capacity,
+        keep_frames=keep_frames,complete=complete,restart=(n_sent == 0))
+      result = self.send_request(call)
+      free = capacity - result.buffered
+      if play and n_sent == 0 and chunk:
+        self.send_request(PlayTrajectory(ref_id=ref_id,fps=fps,loop=loop))
+      n_sent += len(chunk)
+      chunk = []
+      if complete:
+        return n_sent
+
+  def play_trajectory(self,ref_id,fps=10.0,loop=False):
+    self.send_request(PlayTrajectory(ref_id=ref_id,fps=fps,loop=loop))
+
+  def pause_trajectory(self,ref_id):
+    self.send_request(PlayTrajectory(ref_id=ref_id,play=False))
+
+  @staticmethod
+  def _model_fingerprint(model):
+    """
+    A hash of what a model would serialize to, computed without serializing
+    it: every per-atom field the PDB and mmCIF writers emit (coordinates, b,
+    occupancy, ANISOU, name, element, charge, segid, hetero flag), and the
+    model, chain, residue and altloc structure around them.
+    """
+    hierarchy = model.get_hierarchy()
+    atoms = hierarchy.atoms()
+    h = hashlib.sha1()
+    h.update(model.get_sites_cart().as_double().as_numpy_array().tobytes())
+    h.update(atoms.extract_b().as_numpy_array().tobytes())
+    h.update(atoms.extract_occ().as_numpy_array().tobytes())
+    h.update(atoms.extract_uij().as_double().as_numpy_array().tobytes())
+    h.update(atoms.extract_hetero().as_numpy_array().tobytes())
+    for strings in [atoms.extract_name(), atoms.extract_element(),
+        atoms.extract_charge(), atoms.extract_segid()]:
+      h.update("\0".join(strings).encode("utf-8"))
+      h.update(b"\1")
+    for hierarchy_model in hierarchy.models():
+      h.update(f"model\0{hierarchy_model.id}\1".encode("utf-8"))
+      for chain in hierarchy_model.chains():
+        h.update(f"chain\0{chain.id}\1".encode("utf-8"))
+        for rg in chain.residue_groups():
+          h.update(f"{rg.resid()}\0".encode("utf-8"))
+          for ag in rg.atom_groups():
+            h.update(f"{ag.altloc}\0{ag.resname}\0{ag.atoms_size()}\1".encode("utf-8"))
+    crystal_symmetry = model.crystal_symmetry()
+    h.update(str(crystal_symmetry).encode("utf-8"))
+    return h.hexdigest()
+
 
   # ---------------------------------------------------------------------------
   # Selection
@@ -261,6 +805,14 @@ class MolstarGraphics(ModelViewer):
   def _convert_selection(self,selection_string,src_type='phenix',dst_type='pymol'):
     assert src_type in ['phenix']
     assert dst_type in ['pymol']
+    key = (selection_string,src_type,dst_type)
+    converted = self.selection_cache.get(key)
+    if converted is None:
+      converted = self._translate_selection(selection_string,src_type,dst_type)
+      self.selection_cache.set(key,converted)
+    return converted
+
+  def _translate_selection(self,selection_string,src_type,dst_type):
     if src_type == 'phenix':
       # Check if cctbx is accessible for selection translation
 
@@ -278,6 +830,25 @@ class MolstarGraphics(ModelViewer):
         pymol_sel = ast.pymol_string()
         return pymol_sel
 
+  def selection_cache_info(self,clear=False):
+    """
+    Hit and miss counts of the selection caches: 'python' for the phenix to
+    pymol translation, 'viewer' for the viewer's compiled queries.
+    """
+    info = {"python": self.selection_cache.info}
+    if clear:
+      self.selection_cache.clear()
+      self.selection_cache.hits = self.selection_cache.misses = 0
+    call = self.send_request(SelectionCacheInfo(clear=clear))
+    if call is not None: # not batched
+      info["viewer"] = {
+        "hits": call.hits,
+        "misses": call.misses,
+        "size": call.size,
+        "maxsize": call.maxsize,
+      }
+    return info
+
   def select(self,selection_string,syntax="phenix"):
     assert syntax in ['phenix','pymol']
     if syntax == 'pymol':
@@ -299,14 +870,91 @@ class MolstarGraphics(ModelViewer):
     return self.send_request(call)
 
 
-  def poll_selection(self,callback=None):
+  def select_atoms(self,ref_id,selection,by='index',focus=True):
     """
-    Get the current selected atoms as a dictionary of atom records
+    Select atoms of a loaded model directly, without a selection string.
+    Much faster than select_from_pymol for large or scattered atom sets.
+
+    Parameters
+    ----------
+      ref_id: the ref_id of a loaded model (a key of self.loaded)
+      selection: a flex.bool over all atoms of the model, atom indices
+        (a flex.size_t, numpy array or list), or a SelectionRanges
+      by: 'index' for 0-based indices in model order (i_seqs), or 'id' for
+        atom serial numbers
+    Returns the number of atoms selected in the viewer, or None for a
+    SelectionRanges, which is sent as runs and not counted back.
     """
-    call = SelectionPoll()
+    if ref_id not in self.loaded:
+      raise Sorry(f"No model loaded with ref_id: {ref_id}")
+    if isinstance(selection,SelectionRanges):
+      assert by == 'index', "SelectionRanges hold atom indices"
+      call = MakeSelection(pymol_sel='',focus=focus,ref_id=ref_id,atom_ranges=selection.to_flat())
+      self.send_request(call)
+      return None
+    call = MakeAtomSelection.from_selection(ref_id,selection,by=by,focus=focus)
     call = self.send_request(call)
+    if call is None: # batched
+      return None
+    return call.n_selected
+
+  def poll_selection(self,callback=None,columnar=False):
+    """
+    Get the current selected atoms as a dictionary of atom records. If
+    columnar, return a SelectionColumns (one list per attribute) instead,
+    which is smaller on the wire and converts directly to numpy/flex arrays.
+
+    If callback is given, it is also called with the new selection (in the
+    same form) every time the selection changes in the viewer, without
+    polling. See add_event_callback.
+    """
+    if callback is not None:
+      def on_selection(event):
+        columns = SelectionColumns(event["data"].get("atom_columns"))
+        callback(columns if columnar else columns.records())
+      self.add_event_callback("selection",on_selection)
+    call = SelectionPoll(columnar=columnar)
+    call = self.send_request(call)
+    if call is None: # batched
+      return None
+    if columnar:
+      return SelectionColumns(call.atom_columns)
     return call.atom_records
 
+  def poll_selection_ranges(self):
+    """
+    Get the current selected atoms as a SelectionRanges: runs of atom
+    indices (i_seqs) of the model they belong to. The reply grows with the
+    number of contiguous runs, not the number of atoms.
+    """
+    call = self.send_request(SelectionPoll(ranges=True))
+    if call is None: # batched
+      return None
+    ref_id = call.ref_id
+    if ref_id is None and len(self.loaded) == 1:
+      ref_id = list(self.loaded.keys())[0]
+    return SelectionRanges.from_flat(call.atom_ranges,ref_id=ref_id)
+
+  def poll_cctbx_selection(self,iselection=False):
+    """
+    Get the current selected atoms as a cctbx selection on the hierarchy of
+    the model they belong to: a flex.bool, or a flex.size_t of i_seqs if
+    iselection. Returns (ref_id, selection).
+    """
+    call = self.send_request(SelectionPoll(columnar=True))
+    if call is None: # batched
+      return None
+    ref_id = call.ref_id
+    if ref_id is None:
+      if len(self.loaded) != 1:
+        raise Sorry("Unable to tell which model the selection belongs to.")
+      ref_id = list(self.loaded.keys())[0]
+    atom_index = self.atom_index(ref_id)
+    columns = SelectionColumns(call.atom_columns)
+    if iselection:
+      return ref_id, atom_index.iselection(columns)
+    return ref_id, atom_index.selection(columns)
+
 
   def focus(self):
     """
@@ -350,8 +998,16 @@ class MolstarGraphics(ModelViewer):
   # Synchronization
 
   def sync_remote(self):
-    call = MolstarState.from_empty(connection_id=self.connection_id)
-    return self.send_request(call)
+    """
+    Bring self.viewer_state up to date with the viewer, transferring only the
+    changes since its version
+    """
+    call = MolstarState.from_empty(connection_id=self.connection_id,
+      since_version=self.viewer_state.version)
+    result = self.send_request(call)
+    if result is not None: # None inside a batch
+      self.viewer_state.update(result)
+    return result
 
   # ---------------------------------------------------------------------------
   # Representation
@@ -364,14 +1020,45 @@ class MolstarGraphics(ModelViewer):
     call = SetColor(color_string=color_string)
     self.send_request(call)
 
+  def color_by_array(self,ref_id,values=None,colors=None,per='atom',color_scale=None,
+      domain=None,missing_color='grey'):
+    """
+    Color a loaded model by one value or color per atom (or residue), e.g. by
+    B-factor or a validation score, in one request.
+
+    Parameters
+    ----------
+      ref_id: the ref_id of a loaded model (a key of self.loaded)
+      values: numbers, in i_seq order (e.g. model.get_b_iso()), mapped to
+        colors by color_scale. NaN values get missing_color.
+      colors: instead of values, a color per atom or residue (names, hex
+        codes or (r, g, b) floats in [0, 1])
+      per: 'atom', or 'residue' for one value per residue group, in the
+        order of hierarchy.residue_groups()
+      color_scale: colors from low to high values, blue-white-red by default
+      domain: (min, max) of the scale, the range of values by default
+    """
+    if ref_id not in self.loaded:
+      raise Sorry(f"No model loaded with ref_id: {ref_id}")
+    assert (values is None) != (colors is None), "Give either values or colors"
+    if values is not None:
+      call = SetColorArray.from_values(ref_id,values,per=per,color_scale=color_scale,
+        domain=domain,missing_color=missing_color)
+    else:
+      call = SetColorArray.from_colors(ref_id,colors,per=per,missing_color=missing_color)
+    self.send_request(call)
+
+  def clear_color_array(self,ref_id):
+    # Restore the default coloring after color_by_array
+    self.send_request(SetColorArray(ref_id=ref_id,clear=True))
+
   # ---------------------------------------------------------------------------
   # Custom javascript
 
   def send_command(self, js_command,callback=print,sync=True,log_js=False):
     # Raw js command
     if log_js:
-      self.log("JavaScript command:")
-      self.log(js_command)
+      logger.info("JavaScript command:\n%s", js_command)
     if sync:
       rawJs = RawJS(js=js_command)
       req = ApiRequest(data=rawJs)
@@ -0,0 +1,260 @@
+"""
+asyncio version of the Python interface for the molstar viewer.
+
+AsyncMolstarGraphics wraps an existing MolstarGraphics (which owns the server,
+the data manager and the loaded models) and sends the same ApiClass calls
+without blocking. Many requests can be in flight at once; each carries a
+request id and is matched to its response by that id.
+
+Usage:
+  client = AsyncMolstarGraphics(graphics)
+  async with client:
+    await client.load_model(filename)
+    await client.select("chain A")
+    records = await client.poll_selection()
+
+Requires aiohttp.
+"""
+import asyncio
+import json
+
+from molstar_adaptbx.phenix.api import (
+  ApiClass,
+  ApiRequest,
+  MolstarState,
+  SelectionPoll,
+  MakeSelection,
+  MakeAtomSelection,
+  UpdateCoordinates,
+  Focus,
+  ClearViewer,
+  ResetView,
+  ToggleSelectionMode,
+  SetPickingGranularity,
+  AddRepresentation,
+  SetColor,
+  SetColorArray,
+)
+from molstar_adaptbx.phenix.selection import SelectionColumns, SelectionRanges
+from molstar_adaptbx.phenix.metrics import now_ms, response_stamps, stage_durations
+# =============================================================================
+
+class AsyncMolstarGraphics:
+  """
+  Awaitable sibling of MolstarGraphics, sharing its ApiClass definitions.
+  """
+
+  def __init__(self, graphics, max_in_flight=8):
+    self.graphics = graphics # The synchronous MolstarGraphics instance
+    self.max_in_flight = max_in_flight
+    self.in_flight = {} # request_id: ApiRequest, for requests awaiting a response
+    self.last_response = None
+    self._session = None
+    self._semaphore = None
+
+  async def __aenter__(self):
+    await self.open()
+    return self
+
+  async def __aexit__(self, *args):
+    await self.close()
+
+  async def open(self):
+    """
+    Create the aiohttp session (a keep-alive pool of max_in_flight connections)
+    """
+    if self._session is not None:
+      return
+    try:
+      import aiohttp
+    except ImportError:
+      raise RuntimeError("Unable to import aiohttp. It is required for AsyncMolstarGraphics.")
+    connect_timeout, read_timeout = self.graphics.timeout
+    self._session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+      timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+    )
+    self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+  async def close(self):
+    if self._session is not None:
+      await self._session.close()
+      self._session = None
+
+  # ---------------------------------------------------------------------------
+  # Remote communication
+
+  async def send_request(self, api_data: ApiClass):
+    """
+    Async version of MolstarGraphics.send_request. Requests sent
+    concurrently (for example with asyncio.gather) are pipelined, up to
+    max_in_flight at a time. The viewer may process them in any order.
+    """
+    await self.open()
+    request = self.graphics._new_request(api_data)
+    request_id = request.request_id
+    self.in_flight[request_id] = request
+    try:
+      async with self._semaphore:
+        stamps = {"py_encode": now_ms()}
+        body = request.to_json()
+        stamps["py_send"] = now_ms()
+        async with self._session.post(self.graphics.url_api, data=body,
+            headers={"Content-Type": "application/json"}) as response:
+          text = await response.text()
+          stamps["py_receive"] = now_ms()
+      response_dict = json.loads(text)
+      self.last_response = response_dict
+      api_request = ApiRequest.from_response_dict(response_dict)
+      stamps["py_decode"] = now_ms()
+    finally:
+      del self.in_flight[request_id]
+    stamps.update(response_stamps(response_dict))
+    self.graphics.metrics.record(request.name, stage_durations(stamps))
+
+    # A viewer that echoes ids must echo this one
+    if api_request.request_id is not None and api_request.request_id != request_id:
+      raise RuntimeError(
+        f"Response for request {api_request.request_id} received for request {request_id}")
+    return api_request.data
+
+  # ---------------------------------------------------------------------------
+  # Models
+
+  async def load_model(self, filename=None, format='auto', compress=None):
+    """
+    Load a model into viewer. See MolstarGraphics.load_model
+    """
+    call = self.graphics._load_model_call(filename=filename, format=format, compress=compress)
+    if self.graphics._was_sent(call):
+      cached = await self.send_request(self.graphics._load_cached_model_call(call))
+      if cached.found:
+        return
+    await self.send_request(call)
+    self.graphics.sent_content_hashes.add(call.content_hash)
+
+  async def update_coordinates(self, ref_id, sites_cart):
+    """
+    Replace the coordinates of a loaded model. See MolstarGraphics.update_coordinates
+    """
+    await self.send_request(UpdateCoordinates.from_sites_cart(ref_id, sites_cart))
+
+  # ---------------------------------------------------------------------------
+  # Selection
+
+  async def select(self, selection_string, syntax="phenix"):
+    assert syntax in ['phenix','pymol']
+    if syntax == 'pymol':
+      pymol_sel = selection_string
+    if syntax == 'phenix':
+      pymol_sel = self.graphics._convert_selection(selection_string)
+    return await self.select_from_pymol(pymol_sel)
+
+  async def select_from_pymol(self, pymol_sel, reset=True, focus=True):
+    """
+    Make a selection from pymol selection string
+    """
+    if reset:
+      await self.select_none()
+    call = MakeSelection(pymol_sel=pymol_sel, focus=focus)
+    return await self.send_request(call)
+
+  async def select_atoms(self, ref_id, selection, by='index', focus=True):
+    """
+    Select atoms by index. See MolstarGraphics.select_atoms
+    """
+    if isinstance(selection, SelectionRanges):
+      await self.send_request(MakeSelection(pymol_sel='', focus=focus, ref_id=ref_id,
+        atom_ranges=selection.to_flat()))
+      return None
+    call = await self.send_request(MakeAtomSelection.from_selection(ref_id, selection, by=by, focus=focus))
+    return call.n_selected
+
+  async def poll_selection(self, callback=None, columnar=False):
+    """
+    Get the current selected atoms as a list of atom records, or as a
+    SelectionColumns if columnar
+
+    If callback is given, it is also called with the new selection (in the
+    same form) every time the selection changes in the viewer, as in
+    MolstarGraphics.poll_selection. It runs on this event loop, and may be a
+    coroutine function.
+    """
+    if callback is not None:
+      loop = asyncio.get_running_loop()
+      def on_selection(event):
+        # On the event dispatcher thread of self.graphics
+        columns = SelectionColumns(event["data"].get("atom_columns"))
+        selection = columns if columnar else columns.records()
+        if asyncio.iscoroutinefunction(callback):
+          asyncio.run_coroutine_threadsafe(callback(selection), loop)
+        else:
+          loop.call_soon_threadsafe(callback, selection)
+      self.graphics.add_event_callback("selection", on_selection)
+    call = await self.send_request(SelectionPoll(columnar=columnar))
+    if columnar:
+      return SelectionColumns(call.atom_columns)
+    return call.atom_records
+
+  async def poll_selection_ranges(self):
+    """
+    Get the current selected atoms as a SelectionRanges
+    """
+    call = await self.send_request(SelectionPoll(ranges=True))
+    return SelectionRanges.from_flat(call.atom_ranges, ref_id=call.ref_id)
+
+  async def focus(self):
+    await self.send_request(Focus())
+
+  async def select_all(self):
+    await self.select_from_pymol("all")
+
+  async def select_none(self):
+    await self.select_from_pymol("none", reset=False, focus=False)
+
+  # ---------------------------------------------------------------------------
+  # Other
+
+  async def clear_viewer(self):
+    await self.send_request(ClearViewer())
+
+  async def reset_camera(self):
+    await self.send_request(ResetView())
+
+  async def selection_mode_on(self):
+    await self.send_request(ToggleSelectionMode(is_selecting=True))
+
+  async def selection_mode_off(self):
+    await self.send_request(ToggleSelectionMode(is_selecting=False))
+
+  async def set_granularity(self, granularity="residue"):
+    await self.send_request(SetPickingGranularity(granularity=granularity))
+
+  async def sync_remote(self):
+    viewer_state = self.graphics.viewer_state
+    call = MolstarState.from_empty(connection_id=self.graphics.connection_id,
+      since_version=viewer_state.version)
+    result = await self.send_request(call)
+    viewer_state.update(result)
+    return result
+
+  # ---------------------------------------------------------------------------
+  # Representation
+
+  async def add_representation(self, representation_name):
+    await self.send_request(AddRepresentation(representation=representation_name))
+
+  async def set_color(self, color_string):
+    await self.send_request(SetColor(color_string=color_string))
+
+  async def color_by_array(self, ref_id, values=None, colors=None, per='atom', color_scale=None,
+      domain=None, missing_color='grey'):
+    """
+    Color a loaded model per atom or residue. See MolstarGraphics.color_by_array
+    """
+    if values is not None:
+      call = SetColorArray.from_values(ref_id, values, per=per, color_scale=color_scale,
+        domain=domain, missing_color=missing_color)
+    else:
+      call = SetColorArray.from_colors(ref_id, colors, per=per, missing_color=missing_color)
+    await self.send_request(call)
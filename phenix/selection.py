@@ -0,0 +1,358 @@
+"""
+Containers for atom selections returned by the viewer
+"""
+import bisect
+
+# Columns holding integers, the rest are strings
+INT_COLUMNS = ('auth_seq_id', 'label_seq_id', 'id', 'source_index')
+
+# Atom indices are sent as uint32
+MAX_ATOM_INDEX = 2**32 - 1
+
+
+def selection_indices(selection):
+  """
+  The atom indices of a selection given as a boolean mask over all atoms
+  (flex.bool, numpy bool array or a sequence of bools), or as atom indices
+  (flex.size_t, numpy integer array or a sequence of ints). Returns a numpy
+  array for numpy input, a flex.size_t for a flex.bool, else a list.
+  Raises ValueError for indices that are negative or do not fit in uint32.
+  """
+  if hasattr(selection, 'iselection'): # flex.bool
+    return selection.iselection()
+  if hasattr(selection, 'as_numpy_array'): # other flex arrays
+    selection = selection.as_numpy_array()
+  dtype = getattr(selection, 'dtype', None)
+  if dtype is not None:
+    if selection.ndim != 1:
+      raise ValueError(f"Expected a 1-dimensional atom selection, got shape {selection.shape}")
+    if dtype.kind == 'b':
+      return selection.nonzero()[0]
+    if dtype.kind not in 'iu':
+      raise TypeError(f"Expected atom indices or a boolean mask, got an array of {dtype}")
+    indices = selection
+    low, high = (int(indices.min()), int(indices.max())) if indices.size else (0, 0)
+  else:
+    values = list(selection)
+    if values and all(isinstance(value, bool) for value in values):
+      return [i for i, value in enumerate(values) if value]
+    indices = [int(value) for value in values]
+    low, high = (min(indices), max(indices)) if indices else (0, 0)
+  if low < 0:
+    raise ValueError(f"Negative atom index in selection: {low}")
+  if high > MAX_ATOM_INDEX:
+    raise ValueError(f"Atom index out of range in selection: {high}")
+  return indices
+
+
+class SelectionColumns:
+  """
+  A polled selection as one list per atom attribute (the keys of locationAttrs
+  in helpers.ts) rather than one dict per atom. Conversion to numpy or flex
+  arrays is done on request.
+  """
+  def __init__(self, columns):
+    self.columns = columns or {}
+
+  def keys(self):
+    return list(self.columns.keys())
+
+  def __getitem__(self, key):
+    return self.columns[key]
+
+  def __contains__(self, key):
+    return key in self.columns
+
+  def __len__(self):
+    for values in self.columns.values():
+      return len(values)
+    return 0
+
+  def as_numpy(self, key=None):
+    """
+    Return a numpy array for one column, or a dict of arrays for all of them
+    """
+    try:
+      import numpy as np
+    except ImportError:
+      raise RuntimeError("Unable to import numpy. It is required for SelectionColumns.as_numpy")
+    def convert(key):
+      values = self.columns[key]
+      if key in INT_COLUMNS:
+        return np.asarray(values, dtype=np.int32)
+      return np.asarray(values, dtype=str)
+    if key is not None:
+      return convert(key)
+    return {key: convert(key) for key in self.columns}
+
+  def as_flex(self, key=None):
+    """
+    Return a flex array for one column, or a dict of arrays for all of them
+    """
+    from scitbx.array_family import flex
+    def convert(key):
+      values = self.columns[key]
+      if key in INT_COLUMNS:
+        return flex.int(values)
+      return flex.std_string([str(v) for v in values])
+    if key is not None:
+      return convert(key)
+    return {key: convert(key) for key in self.columns}
+
+  def records(self):
+    """
+    Return the selection as a list of atom records, as SelectionPoll does
+    when not columnar
+    """
+    keys = self.keys()
+    return [dict(zip(keys, values)) for values in zip(*(self.columns[k] for k in keys))]
+
+
+class AtomIndex:
+  """
+  Maps atoms polled from the viewer to their i_seqs in the hierarchy of a
+  loaded model, so a polled selection can be used as a cctbx selection.
+
+  The viewer returns the source_index of each atom, its row in the model
+  as sent, which is its i_seq, so the conversion is a single array copy.
+  Selections without it (from older viewers) are matched by KEY_COLUMNS
+  instead. The viewer has neither insertion codes nor model ids, so atoms
+  differing only by those cannot be told apart that way, and are an error.
+  """
+  SOURCE_COLUMN = 'source_index'
+  KEY_COLUMNS = ('auth_asym_id', 'auth_seq_id', 'auth_comp_id', 'auth_atom_id', 'label_alt_id')
+
+  def __init__(self, hierarchy):
+    self.hierarchy = hierarchy
+    self.n_atoms = hierarchy.atoms_size()
+    self._lookup = None
+    self._ambiguous = None
+
+  def _build_lookup(self):
+    # KEY_COLUMNS: i_seq, only for selections without source_index
+    self._lookup = {}
+    self._ambiguous = set()
+    i_seq = 0 # hierarchy.atoms() order
+    for model in self.hierarchy.models():
+      for chain in model.chains():
+        chain_id = chain.id.strip()
+        for rg in chain.residue_groups():
+          resseq = rg.resseq_as_int()
+          for ag in rg.atom_groups():
+            resname = ag.resname.strip()
+            altloc = ag.altloc.strip()
+            for atom in ag.atoms():
+              key = (chain_id, resseq, resname, atom.name.strip(), altloc)
+              if key in self._lookup:
+                self._ambiguous.add(key)
+              else:
+                self._lookup[key] = i_seq
+              i_seq += 1
+
+  def _columns(self, selection):
+    if isinstance(selection, SelectionColumns):
+      return selection.columns
+    if isinstance(selection, dict):
+      return selection
+    return None
+
+  def _keys(self, selection):
+    columns = self._columns(selection)
+    if columns is not None:
+      return zip(*(columns[key] for key in self.KEY_COLUMNS))
+    return (tuple(record[key] for key in self.KEY_COLUMNS) for record in selection)
+
+  def _source_indices(self, selection):
+    columns = self._columns(selection)
+    if columns is not None:
+      return columns.get(self.SOURCE_COLUMN)
+    if selection and all(self.SOURCE_COLUMN in record for record in selection):
+      return [record[self.SOURCE_COLUMN] for record in selection]
+    return None
+
+  def iselection(self, selection):
+    """
+    Convert a polled selection (SelectionColumns, a columns dict or a list of
+    atom records) to a flex.size_t of i_seqs
+    """
+    from scitbx.array_family import flex
+    source_indices = self._source_indices(selection)
+    if source_indices is not None:
+      i_seqs = flex.size_t(source_indices)
+      if i_seqs.size() and flex.max(i_seqs) >= self.n_atoms:
+        raise RuntimeError(f"Selected atom with source_index {flex.max(i_seqs)} is out of "
+          f"range for a model of {self.n_atoms} atoms. Was the selection made on another model?")
+      return i_seqs
+    if self._lookup is None:
+      self._build_lookup()
+    i_seqs = []
+    for key in self._keys(selection):
+      i_seq = self._lookup.get(key)
+      if i_seq is None or key in self._ambiguous:
+        chain_id, resseq, resname, name, altloc = key
+        atom = f"chain {chain_id!r} resseq {resseq} resname {resname!r} name {name!r} altloc {altloc!r}"
+        if i_seq is None:
+          raise RuntimeError(f"Selected atom not found in the model: {atom}")
+        raise RuntimeError(f"Selected atom matches several atoms of the model (insertion codes "
+          f"or multiple models): {atom}. Poll with a viewer that returns source_index.")
+      i_seqs.append(i_seq)
+    return flex.size_t(i_seqs)
+
+  def selection(self, selection):
+    """
+    Convert a polled selection to a flex.bool over all atoms of the model
+    """
+    from scitbx.array_family import flex
+    result = flex.bool(self.n_atoms, False)
+    result.set_selected(self.iselection(selection), True)
+    return result
+
+
+class SelectionRanges:
+  """
+  A selection of one model as sorted, disjoint [start, stop) runs of atom
+  indices in model order (i_seqs), the form used by SelectionPoll(ranges=True)
+  and MakeSelection(atom_ranges=...). A chain or residue range is one run, so
+  large contiguous selections cost O(runs) rather than O(atoms) on the wire.
+  """
+  def __init__(self, ranges=(), ref_id=None):
+    """
+    ranges: (start, stop) pairs, in any order and possibly overlapping
+    """
+    self.ref_id = ref_id
+    self.runs = [] # [(start, stop)], sorted and merged
+    for start, stop in sorted((int(start), int(stop)) for start, stop in ranges):
+      if stop <= start:
+        continue
+      if self.runs and start <= self.runs[-1][1]:
+        if stop > self.runs[-1][1]:
+          self.runs[-1] = (self.runs[-1][0], stop)
+      else:
+        self.runs.append((start, stop))
+    self._starts = [start for start, stop in self.runs]
+
+  @classmethod
+  def from_flat(cls, flat, ref_id=None):
+    """
+    From [start0, stop0, start1, stop1, ...], as sent by the viewer
+    """
+    flat = list(flat or [])
+    return cls(zip(flat[0::2], flat[1::2]), ref_id=ref_id)
+
+  @classmethod
+  def from_selection(cls, selection, ref_id=None):
+    """
+    selection: a boolean mask over all atoms (flex.bool, numpy bool array
+      or sequence of bools), or atom indices (a flex.size_t, numpy array or
+      sequence). Negative indices raise ValueError, see selection_indices.
+    """
+    selection = selection_indices(selection)
+    runs = []
+    start = stop = None
+    for i in sorted(int(i) for i in selection):
+      if i == stop:
+        stop += 1
+      elif stop is None or i > stop:
+        if start is not None:
+          runs.append((start, stop))
+        start, stop = i, i + 1
+    if start is not None:
+      runs.append((start, stop))
+    return cls(runs, ref_id=ref_id)
+
+  def to_flat(self):
+    return [value for run in self.runs for value in run]
+
+  @property
+  def n_runs(self):
+    return len(self.runs)
+
+  @property
+  def n_atoms(self):
+    return sum(stop - start for start, stop in self.runs)
+
+  def __len__(self):
+    return self.n_atoms
+
+  def __bool__(self):
+    return bool(self.runs)
+
+  def __iter__(self):
+    return iter(self.runs)
+
+  def __contains__(self, i_seq):
+    k = bisect.bisect_right(self._starts, i_seq) - 1
+    return k >= 0 and i_seq < self.runs[k][1]
+
+  def __eq__(self, other):
+    if not isinstance(other, SelectionRanges):
+      return NotImplemented
+    return self.runs == other.runs
+
+  def __repr__(self):
+    return f"SelectionRanges(ref_id={self.ref_id!r}, n_runs={self.n_runs}, n_atoms={self.n_atoms})"
+
+  def iter_indices(self):
+    for start, stop in self.runs:
+      yield from range(start, stop)
+
+  def intersection(self, other):
+    """
+    The atoms in both, by a merge of the two run lists
+    """
+    runs = []
+    a, b = self.runs, SelectionRanges._coerce(other).runs
+    i = j = 0
+    while i < len(a) and j < len(b):
+      start, stop = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+      if start < stop:
+        runs.append((start, stop))
+      if a[i][1] < b[j][1]:
+        i += 1
+      else:
+        j += 1
+    return SelectionRanges(runs, ref_id=self.ref_id)
+
+  def union(self, other):
+    return SelectionRanges(self.runs + SelectionRanges._coerce(other).runs, ref_id=self.ref_id)
+
+  __and__ = intersection
+  __or__ = union
+
+  @staticmethod
+  def _coerce(other):
+    if isinstance(other, SelectionRanges):
+      return other
+    return SelectionRanges.from_selection(other)
+
+  def iselection(self):
+    """
+    Expand to a flex.size_t of i_seqs
+    """
+    from scitbx.array_family import flex
+    result = flex.size_t()
+    for start, stop in self.runs:
+      result.extend(flex.size_t_range(start, stop))
+    return result
+
+  def selection(self, n_atoms):
+    """
+    Expand to a flex.bool over the n_atoms of the model
+    """
+    from scitbx.array_family import flex
+    result = flex.bool(n_atoms, False)
+    for start, stop in self.runs:
+      result.set_selected(flex.size_t_range(start, stop), True)
+    return result
+
+  def as_numpy(self):
+    """
+    Expand to a numpy array of atom indices
+    """
+    try:
+      import numpy as np
+    except ImportError:
+      raise RuntimeError("Unable to import numpy. It is required for SelectionRanges.as_numpy")
+    if not self.runs:
+      return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, stop) for start, stop in self.runs])
@@ -1,14 +1,13 @@
 """
 Utilities for running the molstar web server
 """
-import http.server
-import socketserver
 from pathlib import Path
 import socket
-import tempfile
-import subprocess
 import json
 import uuid
+import logging
+
+logger = logging.getLogger(__name__)
 
 def generate_uuid():
   return str(uuid.uuid4())
@@ -23,11 +22,10 @@ class NodeHttpServer:
     self.process = None
     self.command_list = command+['--port',str(self.port)]
     self.command = ' '.join(self.command_list)
-    self.debug = True
 
   def log(self,*args):
-    if self.debug:
-      print(*args)
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug(' '.join(str(arg) for arg in args))
 
   @staticmethod
   def find_open_port():
@@ -53,19 +51,19 @@ class NodeHttpServer:
 
   def start(self):
     if self.process is None:
-      print(f"Starting HTTP server at: {self.url}")
-      print(f"Command used: {self.command}")
-      print("Command list: ",self.command_list)
+      logger.info("Starting HTTP server at: %s", self.url)
+      logger.debug("Command used: %s", self.command)
 
+      import subprocess
       self.process = subprocess.Popen(self.command_list,stdout=None,stderr=None)
     else:
-      print("HTTP server is already running.")
+      logger.info("HTTP server is already running.")
 
   def stop(self):
     if self.process:
-      print("Stopping HTTP server...")
+      logger.info("Stopping HTTP server...")
       self.process.terminate()
       self.process = None
     else:
-      print("HTTP server is not running.")
+      logger.debug("HTTP server is not running.")
 
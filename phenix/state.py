@@ -1,93 +1,225 @@
 """
-Data structures to descrine the internal state of the molstar viewer, but in python.
+A Python mirror of the internal state of the molstar viewer.
+
+The viewer state is a tree: references (loaded models) hold structures, which
+hold components, which hold representations. StateStore keeps one record per
+node, indexed by phenix key and by molstar key, with each record holding its
+parent's key and its children. Lookups and updates are O(1) no matter how
+many models are loaded.
+
+The viewer numbers its state with a version, bumped by every change. The
+store is kept up to date by applying the changes since its own version (see
+StateStore.update), rather than rebuilding it.
 """
-from dataclasses import dataclass
-from typing import List, Optional, Dict
 
+class StateRecord:
+  """
+  Base class of the state nodes. parent is the phenixKey of the parent node,
+  and children maps the phenixKey of each child to its record, in the order
+  they were added.
+  """
+  __slots__ = ("phenixKey", "molstarKey", "parent", "children")
+  kind = None
+  fields = ()
+
+  def __init__(self, phenixKey, molstarKey=None, parent=None, **kwargs):
+    self.phenixKey = phenixKey
+    self.molstarKey = molstarKey
+    self.parent = parent
+    self.children = {}
+    for name in self.fields:
+      setattr(self, name, kwargs.get(name))
+
+  def __repr__(self):
+    values = ", ".join(f"{name}={getattr(self, name)!r}"
+      for name in ("phenixKey", "molstarKey") + self.fields)
+    return f"{type(self).__name__}({values})"
+
+
+class Reference(StateRecord):
+  __slots__ = ("representation_names",)
+  kind = "reference"
+
+  def __init__(self, phenixKey, molstarKey=None, parent=None, **kwargs):
+    super().__init__(phenixKey, molstarKey, parent)
+    self.representation_names = [] # Of every representation under this reference
+
+  # Names used before the store
+  @property
+  def id_viewer(self):
+    return self.phenixKey
+
+  @property
+  def id_molstar(self):
+    return self.molstarKey
+
+  @property
+  def structures(self):
+    return list(self.children.values())
 
-@dataclass(frozen=True)
-class Component:
-  phenixKey: str
-  key: str
-  representations: List[str]
+  @property
+  def representations(self):
+    return self.representation_names
 
 
-@dataclass(frozen=True)
-class Representation:
-  phenixKey: str
-  name: str
+class Structure(StateRecord):
+  __slots__ = ("phenixReferenceKey", "data_id", "key")
+  kind = "structure"
+  fields = ("phenixReferenceKey", "data_id", "key")
 
+  @property
+  def components(self):
+    return list(self.children.values())
 
-@dataclass(frozen=True)
-class Structure:
-  phenixReferenceKey: str
-  phenixKey: str
-  data_id: str
-  key: str
-  components: List[Component]
 
+class Component(StateRecord):
+  __slots__ = ("key",)
+  kind = "component"
+  fields = ("key",)
 
+  @property
+  def representations(self):
+    return list(self.children.values())
 
-@dataclass(frozen=True)
-class Reference:
-  id_viewer: Optional[str]
-  id_molstar: Optional[str]
-  structures: List[Structure]
 
-  @classmethod
-  def from_default(cls):
-    return cls(
-      id_viewer = None,
-      id_molstar = None,
-      structure = None
-    )
+class Representation(StateRecord):
+  __slots__ = ("name",)
+  kind = "representation"
+  fields = ("name",)
+
+
+RECORD_CLASSES = {cls.kind: cls for cls in [Reference, Structure, Component, Representation]}
+
+# kind: (key of the children in the viewer's nested state dicts, their kind)
+CHILDREN = {
+  "reference": ("structures", "structure"),
+  "structure": ("components", "component"),
+  "component": ("representations", "representation"),
+}
+
+
+class StateStore:
+  """
+  The viewer state, as records indexed by phenix key and molstar key
+  """
+  def __init__(self):
+    self.has_synced = False
+    self.version = 0 # The viewer state version this mirrors
+    self.by_phenix_key = {} # phenixKey: record
+    self.by_molstar_key = {} # molstarKey: record
+    self.by_kind = {kind: {} for kind in RECORD_CLASSES} # kind: {phenixKey: record}
+
+  @property
+  def references(self):
+    return self.by_kind["reference"]
+
+  @property
+  def structures(self):
+    return self.by_kind["structure"]
+
+  @property
+  def components(self):
+    return self.by_kind["component"]
 
   @property
   def representations(self):
-    output = []
-    for structure in self.structures:
-      for component in structure.components:
-        for repr_name in component.representations:
-          output.append(repr_name)
-    return output
-
-
-@dataclass(frozen=True)
-class MolstarState:
-  has_synced: bool
-  references: Dict[str,Reference]
-
-  @classmethod
-  def from_empty(cls):
-    return cls(references={},has_synced=False)
-
-  @classmethod
-  def from_dict(cls,state_dict):
-    has_synced = state_dict["has_synced"]
-    phenix_state =  cls(references = {}, has_synced=has_synced)
-    # update state from dict
-    for ref_dict in state_dict["references"]:
-      id_molstar = ref_dict["molstarKey"]
-      id_viewer = ref_dict["phenixKey"]
-
-      ref = Reference(id_molstar=id_molstar, id_viewer = id_viewer, structures = [])
-      phenix_state.references[id_viewer] = ref
-      # now modify within a ref
-      for structure_dict in ref_dict['structures']:
-        structure = Structure(
-          phenixKey=structure_dict["phenixKey"],
-          phenixReferenceKey=structure_dict['phenixReferenceKey'],
-          data_id=structure_dict["data_id"],
-          key=structure_dict["key"],
-          components=[])
-        ref.structures.append(structure)
-        for component_dict in structure_dict['components']:
-          component = Component(phenixKey=component_dict["phenixKey"],representations=[],key=component_dict["key"])
-          structure.components.append(component)
-
-          for representation_dict in component_dict["representations"]:
-            representation = Representation(phenixKey=representation_dict["phenixKey"],name=representation_dict["name"])
-
-            component.representations.append(representation)
-
-    return phenix_state
\ No newline at end of file
+    return self.by_kind["representation"]
+
+  def __len__(self):
+    return len(self.by_phenix_key)
+
+  def __contains__(self, phenixKey):
+    return phenixKey in self.by_phenix_key
+
+  def get(self, phenixKey, default=None):
+    return self.by_phenix_key.get(phenixKey, default)
+
+  def get_by_molstar_key(self, molstarKey, default=None):
+    return self.by_molstar_key.get(molstarKey, default)
+
+  def parent(self, record):
+    return self.by_phenix_key.get(record.parent)
+
+  def reference_of(self, record):
+    """
+    The reference a record belongs to
+    """
+    while record is not None and record.kind != "reference":
+      record = self.by_phenix_key.get(record.parent)
+    return record
+
+  # ---------------------------------------------------------------------------
+  # Changes
+
+  def clear(self):
+    self.by_phenix_key.clear()
+    self.by_molstar_key.clear()
+    for records in self.by_kind.values():
+      records.clear()
+
+  def add(self, kind, data, parent=None):
+    """
+    Add a node from the fields in data (phenixKey, molstarKey and those of
+    its kind). Adding a phenixKey that is present again does nothing.
+    """
+    record = self.by_phenix_key.get(data["phenixKey"])
+    if record is not None:
+      return record
+    cls = RECORD_CLASSES[kind]
+    record = cls(data["phenixKey"], data.get("molstarKey"), parent,
+      **{name: data.get(name) for name in cls.fields})
+    if parent is not None:
+      parent_record = self.by_phenix_key[parent]
+      parent_record.children[record.phenixKey] = record
+      if kind == "representation":
+        self.reference_of(parent_record).representation_names.append(record.name)
+    self.by_phenix_key[record.phenixKey] = record
+    if record.molstarKey:
+      self.by_molstar_key[record.molstarKey] = record
+    self.by_kind[kind][record.phenixKey] = record
+    return record
+
+  def apply_changes(self, changes):
+    """
+    Apply change dicts from the viewer, in order. Each is
+      {"version", "op": "reset"} or
+      {"version", "op": "add", "kind", "parent", "data"}
+    where kind is reference, structure, component or representation, parent
+    is the phenixKey of the parent, and data holds the fields of the new node.
+    """
+    for change in changes:
+      op = change["op"]
+      if op == "reset":
+        self.clear()
+      elif op == "add":
+        self.add(change["kind"], change["data"], change.get("parent"))
+      else:
+        raise ValueError(f"Unknown state change: {op}")
+      self.version = change["version"]
+
+  def load_references(self, references):
+    """
+    Replace the contents with the viewer's nested state dicts (the
+    references of a MolstarState requested without since_version)
+    """
+    self.clear()
+    stack = [("reference", ref_dict, None) for ref_dict in reversed(references)]
+    while stack:
+      kind, node_dict, parent = stack.pop()
+      record = self.add(kind, node_dict, parent)
+      if kind in CHILDREN:
+        children_key, child_kind = CHILDREN[kind]
+        for child_dict in reversed(node_dict.get(children_key) or []):
+          stack.append((child_kind, child_dict, record.phenixKey))
+
+  def update(self, api_state):
+    """
+    Apply an api.MolstarState response. With since_version=self.version it
+    holds the changes since then, otherwise the whole tree.
+    """
+    self.has_synced = api_state.has_synced
+    if api_state.changes is None:
+      self.load_references(api_state.references or [])
+    else:
+      self.apply_changes(api_state.changes)
+    self.version = api_state.version
@@ -2,7 +2,6 @@ from __future__ import absolute_import, division, print_function
 import subprocess
 import sys
 import os
-import time
 from pathlib import Path
 import code
 from phenix.program_template import ProgramTemplate
@@ -129,7 +128,6 @@ class Program(ProgramTemplate):
     default_filename = self.data_manager._default_model
     if default_filename:
       print(f"Found default model with filename: {default_filename}")
-      time.sleep(1)
       self.graphics.load_model(default_filename)
 
     # Start interactive shell
@@ -0,0 +1,211 @@
+"""
+Headless end-to-end benchmark of the viewer protocol.
+
+Sends api calls from Python through the server to a FakeViewer (see
+fake_viewer.py) and reports latency percentiles and throughput per api class.
+
+  python bench_e2e.py [--server node|standin] [--iterations N]
+  python bench_e2e.py --replay session.jsonl [--speed 1.0]
+
+--server node (the default) starts molstar/src/phenix/server.js, so the full
+  Python -> server -> SSE -> viewer -> WebSocket -> server -> Python round
+  trip is measured. Requires node with the server's packages installed.
+--server standin uses the in-process stand-in server, which answers directly,
+  to measure the Python side alone.
+
+Recording: start server.js with --record session.jsonl and use the viewer as
+usual. Every request is appended to the file, and --replay sends the same
+request stream again, keeping the original timing scaled by 1/speed, or as
+fast as possible with --speed 0.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import time
+import uuid
+from pathlib import Path
+
+from molstar_adaptbx.phenix.api import (
+  ApiRequest,
+  Focus,
+  MakeSelection,
+  MakeAtomSelection,
+  SelectionPoll,
+  LoadModel,
+  UpdateCoordinates,
+  pack_float32,
+)
+from molstar_adaptbx.phenix.server_utils import NodeHttpServer
+from molstar_adaptbx.testing.fake_viewer import FakeViewer, make_output
+from molstar_adaptbx.testing.standin_server import StandInServer, make_response
+
+SERVER_JS = Path(__file__).parent.parent / "molstar" / "src" / "phenix" / "server.js"
+
+
+def pdb_text(n_bytes):
+  line = "ATOM      1  CA  ALA A   1      11.104   6.134  -6.504  1.00  0.00           C\n"
+  return line*max(1, n_bytes//len(line))
+
+
+# label: (call factory, number of atoms the fake viewer reports as selected)
+WORKLOADS = {
+  "Focus": (lambda: Focus(), 0),
+  "MakeSelection": (lambda: MakeSelection(pymol_sel="chain A and resi 1-50", focus=False), 0),
+  "MakeAtomSelection 10k": (lambda: MakeAtomSelection.from_selection("bench",
+    range(0, 100000, 10), focus=False), 0),
+  "SelectionPoll 1k": (lambda: SelectionPoll(), 1000),
+  "SelectionPoll 10k": (lambda: SelectionPoll(), 10000),
+  "SelectionPoll col 10k": (lambda: SelectionPoll(columnar=True), 10000),
+  "SelectionPoll ranges 10k": (lambda: SelectionPoll(ranges=True), 10000),
+  "UpdateCoordinates 10k": (lambda: UpdateCoordinates(ref_id="bench",
+    xyz=pack_float32([0.0]*30000), n_atoms=10000), 0),
+  "LoadModel 100 kB": (lambda: LoadModel(ref_id="bench", pdb_str=pdb_text(100*1024)), 0),
+  "LoadModel 1 MB": (lambda: LoadModel(ref_id="bench", pdb_str=pdb_text(1024**2)), 0),
+  "LoadModel 10 MB": (lambda: LoadModel(ref_id="bench", pdb_str=pdb_text(10*1024**2)), 0),
+}
+
+
+class Client:
+  """
+  Sends requests the way MolstarGraphics.send_request does
+  """
+  def __init__(self, url, target=None):
+    import requests
+    self.url_api = url + "/run"
+    self.target = target
+    self.session = requests.Session()
+
+  def send_payload(self, payload):
+    response = self.session.post(self.url_api, data=json.dumps(payload),
+      headers={"Content-Type": "application/json"}, timeout=(3.05, 60))
+    return ApiRequest.from_response_dict(response.json()).data
+
+  def send(self, api_data):
+    request = ApiRequest(data=api_data, request_id=uuid.uuid4().hex, target=self.target)
+    return self.send_payload(request.to_dict())
+
+
+class Harness:
+  """
+  Runs a server (node or stand-in) and a fake viewer
+  """
+  def __init__(self, server="node", client_id="bench-viewer"):
+    assert server in ["node", "standin"]
+    self.kind = server
+    self.client_id = client_id
+    self.n_selected = 100 # read by respond
+    self.server = None
+    self.viewer = None
+
+  def respond(self, payload):
+    return make_output(payload, n_selected=self.n_selected)
+
+  def __enter__(self):
+    if self.kind == "standin":
+      self.server = StandInServer(respond=lambda payload: make_response(self.respond(payload)))
+      self.server.start()
+      self.client = Client(self.server.url)
+      return self
+    self.server = NodeHttpServer(["node", str(SERVER_JS), "--request-timeout", "60000"],
+      port=NodeHttpServer.find_open_port())
+    self.server.start()
+    self._wait_for_server(self.server.url)
+    self.viewer = FakeViewer(self.server.url, client_id=self.client_id, respond=self.respond)
+    self.viewer.start()
+    self.client = Client(self.server.url, target=self.client_id)
+    return self
+
+  def __exit__(self, *args):
+    if self.viewer is not None:
+      self.viewer.stop()
+    self.server.stop()
+
+  @staticmethod
+  def _wait_for_server(url, timeout=10):
+    import requests
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+      try:
+        if requests.get(url + "/health", timeout=1).status_code == 200:
+          return
+      except requests.exceptions.ConnectionError:
+        time.sleep(0.05)
+    raise RuntimeError(f"server.js did not start at {url}")
+
+
+def percentile(sorted_values, p):
+  return sorted_values[min(len(sorted_values) - 1, int(round(p/100*(len(sorted_values) - 1))))]
+
+def report(label, latencies, elapsed):
+  ms = sorted(t*1000 for t in latencies)
+  print(f"{label:<24} {len(ms):>6} {statistics.mean(ms):9.2f} {percentile(ms, 50):9.2f} "
+        f"{percentile(ms, 90):9.2f} {percentile(ms, 99):9.2f} {ms[-1]:9.2f} {len(ms)/elapsed:9.1f}")
+
+def print_header():
+  header = (f"{'call':<24} {'n':>6} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} "
+            f"{'calls/s':>9}")
+  print(header + "   (latencies in ms)")
+  print("-"*len(header))
+
+
+def run_workloads(harness, iterations, labels=None):
+  print_header()
+  for label, (factory, n_selected) in WORKLOADS.items():
+    if labels and label not in labels:
+      continue
+    harness.n_selected = n_selected
+    harness.client.send(factory()) # warm up
+    latencies = []
+    t_start = time.perf_counter()
+    for i in range(iterations):
+      call = factory()
+      t0 = time.perf_counter()
+      harness.client.send(call)
+      latencies.append(time.perf_counter() - t0)
+    report(label, latencies, time.perf_counter() - t_start)
+
+
+def replay(harness, path, speed=1.0):
+  """
+  Send the requests recorded by server.js --record, grouped by api class in
+  the report
+  """
+  records = [json.loads(line) for line in Path(path).read_text().splitlines() if line.strip()]
+  latencies = {}
+  t_start = time.perf_counter()
+  t_first = records[0]["time"] if records else 0
+  for record in records:
+    if speed > 0:
+      wait = (record["time"] - t_first)/1000/speed - (time.perf_counter() - t_start)
+      if wait > 0:
+        time.sleep(wait)
+    payload = record["payload"]
+    payload["request_id"] = uuid.uuid4().hex
+    payload.pop("mode", None)
+    payload.pop("target", None)
+    if harness.client.target is not None:
+      payload["target"] = harness.client.target
+    t0 = time.perf_counter()
+    harness.client.send_payload(payload)
+    latencies.setdefault(payload["name"], []).append(time.perf_counter() - t0)
+  elapsed = time.perf_counter() - t_start
+  print(f"Replayed {len(records)} requests from {path} in {elapsed:.2f} s")
+  print_header()
+  for name, values in latencies.items():
+    report(name, values, elapsed)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--server", choices=["node", "standin"], default="node")
+  parser.add_argument("--iterations", type=int, default=50)
+  parser.add_argument("--only", nargs="*", help="Workload labels to run")
+  parser.add_argument("--replay", help="A request stream recorded with server.js --record")
+  parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 0 for no delays")
+  args = parser.parse_args()
+  with Harness(server=args.server) as harness:
+    if args.replay:
+      replay(harness, args.replay, speed=args.speed)
+    else:
+      run_workloads(harness, args.iterations, labels=args.only)
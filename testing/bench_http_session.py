@@ -0,0 +1,67 @@
+"""
+Micro-benchmark of per-call latency for /run requests: a bare requests.post
+per call (new TCP connection each time) versus the pooled keep-alive session
+used by MolstarGraphics.send_request.
+
+Runs against a local stand-in server, so no node or browser is needed:
+  python bench_http_session.py [n_calls]
+"""
+import sys
+import time
+import statistics
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from molstar_adaptbx.phenix.api import ApiRequest, Focus
+from molstar_adaptbx.testing.standin_server import StandInServer
+
+
+def make_session(pool_connections=1, pool_maxsize=4):
+  # Same configuration as MolstarGraphics.session
+  adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+  session = requests.Session()
+  session.mount("http://", adapter)
+  session.headers.update({"Connection": "keep-alive"})
+  return session
+
+
+def time_calls(post, url, payload, n_calls, timeout=(3.05, 30)):
+  latencies = []
+  for i in range(n_calls):
+    t0 = time.perf_counter()
+    response = post(url, json=payload, timeout=timeout)
+    response.json()
+    latencies.append(time.perf_counter() - t0)
+  return latencies
+
+
+def summarize(label, latencies):
+  ms = sorted(e*1000 for e in latencies)
+  p95 = ms[int(0.95*(len(ms)-1))]
+  print(f"{label:<22} mean {statistics.mean(ms):7.3f} ms   "
+        f"median {statistics.median(ms):7.3f} ms   p95 {p95:7.3f} ms")
+  return statistics.median(ms)
+
+
+def run(n_calls=500):
+  payload = ApiRequest(data=Focus()).to_dict()
+  with StandInServer() as server:
+    url = server.url + "/run"
+    # warm up
+    time_calls(requests.post, url, payload, 10)
+
+    bare = time_calls(requests.post, url, payload, n_calls)
+    session = make_session()
+    pooled = time_calls(session.post, url, payload, n_calls)
+    session.close()
+
+  print(f"{n_calls} calls of {payload['name']} against {url}")
+  t_bare = summarize("requests.post", bare)
+  t_pooled = summarize("pooled session", pooled)
+  print(f"Speedup (median): {t_bare/t_pooled:.2f}x")
+
+
+if __name__ == '__main__':
+  n_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+  run(n_calls)
@@ -0,0 +1,112 @@
+"""
+Serialization cost per api class and payload size.
+
+For each call, times the request encoding (ApiRequest -> json text) and the
+response decoding (server body -> ApiClass) of the current code, against the
+previous implementation: dataclasses.asdict with indented json for requests,
+and the double-encoded version 1 envelope for responses.
+
+  python bench_serialization.py [repeats]
+"""
+import sys
+import json
+import time
+import random
+from dataclasses import asdict
+
+from molstar_adaptbx.phenix import api
+from molstar_adaptbx.phenix.api import (
+  ApiRequest,
+  Focus,
+  SetColor,
+  SelectionPoll,
+  LoadModel,
+  UpdateCoordinates,
+  MolstarState,
+)
+from molstar_adaptbx.testing.standin_server import make_response, make_response_v1
+
+
+def legacy_request_json(request):
+  return json.dumps({"name": request.name, "data": asdict(request.data)}, indent=2)
+
+def legacy_decode(body):
+  response_dict = json.loads(body)
+  output = json.loads(response_dict["responses"][0]["data"]["output"])
+  data_dict = json.loads(output)
+  data_class = getattr(api, data_dict["name"])
+  return data_class.from_dict(data_dict["data"])
+
+def decode(body):
+  return ApiRequest.from_response_dict(json.loads(body)).data
+
+
+def atom_records(n):
+  return [{
+    "auth_asym_id": "A", "label_asym_id": "A",
+    "auth_comp_id": "ALA", "label_comp_id": "ALA",
+    "auth_seq_id": i//5, "label_seq_id": i//5,
+    "auth_atom_id": "CA", "label_atom_id": "CA",
+    "label_alt_id": "", "id": i,
+  } for i in range(n)]
+
+def pdb_text(n_bytes):
+  line = "ATOM      1  CA  ALA A   1      11.104   6.134  -6.504  1.00  0.00           C\n"
+  return line*(n_bytes//len(line))
+
+def molstar_state(n_references):
+  # The whole state tree, as the viewer sends it
+  references = []
+  for i in range(n_references):
+    components = [{"phenixKey": f"c{i}{j}", "molstarKey": f"mc{i}{j}", "key": f"k{j}",
+      "representations": [{"phenixKey": f"p{i}{j}{name}", "molstarKey": f"mp{i}{j}{name}", "name": name}
+        for name in ["cartoon", "ball-and-stick"]]} for j in range(4)]
+    structure = {"phenixReferenceKey": f"r{i}", "phenixKey": f"s{i}", "molstarKey": f"ms{i}",
+      "data_id": f"d{i}", "key": f"k{i}", "components": components}
+    references.append({"phenixKey": f"r{i}", "molstarKey": f"m{i}", "structures": [structure]})
+  return MolstarState(connection_id="bench", has_synced=True, references=references)
+
+def calls():
+  sites = [random.uniform(-50, 50) for i in range(3*100000)]
+  return [
+    ("Focus", Focus()),
+    ("SetColor", SetColor(color_string="red")),
+    ("MolstarState 50 refs", molstar_state(50)),
+    ("SelectionPoll 10k atoms", SelectionPoll(atom_records=atom_records(10000))),
+    ("UpdateCoordinates 100k", UpdateCoordinates(ref_id="bench", xyz=api.pack_float32(sites), n_atoms=100000)),
+    ("LoadModel 1 MB", LoadModel(ref_id="bench", pdb_str=pdb_text(1024**2))),
+    ("LoadModel 10 MB", LoadModel(ref_id="bench", pdb_str=pdb_text(10*1024**2))),
+  ]
+
+
+def best_time(func, repeats):
+  best = float("inf")
+  for i in range(repeats):
+    t0 = time.perf_counter()
+    func()
+    best = min(best, time.perf_counter() - t0)
+  return best*1000
+
+
+def run(repeats=5):
+  header = (f"{'call':<24} {'bytes':>10} | {'encode old':>10} {'new':>8} | "
+            f"{'decode old':>10} {'new':>8}  (ms)")
+  print(header)
+  print("-"*len(header))
+  for label, data in calls():
+    request = ApiRequest(data=data, request_id="bench")
+    body_v1 = json.dumps(make_response_v1(request.to_dict()))
+    body_v2 = json.dumps(make_response(request.to_dict()))
+    assert legacy_decode(body_v1) == decode(body_v2) == data
+
+    encode_old = best_time(lambda: legacy_request_json(request), repeats)
+    encode_new = best_time(lambda: request.to_json(), repeats)
+    decode_old = best_time(lambda: legacy_decode(body_v1), repeats)
+    decode_new = best_time(lambda: decode(body_v2), repeats)
+    print(f"{label:<24} {len(request.to_json()):>10} | {encode_old:>10.3f} {encode_new:>8.3f} | "
+          f"{decode_old:>10.3f} {decode_new:>8.3f}")
+
+
+if __name__ == '__main__':
+  repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  run(repeats)
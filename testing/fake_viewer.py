@@ -0,0 +1,158 @@
+"""
+A scriptable stand-in for the browser viewer (index.html + PhenixViewer).
+
+FakeViewer connects to server.js the way a browser tab does: it reads
+requests from the /events SSE stream and from its WebSocket, and answers
+each one on the WebSocket with the same envelope as index.html. Outputs are
+produced by respond(payload), which by default mimics the viewer closely
+enough for the api calls to round trip (see make_output).
+
+  with FakeViewer(server_url, client_id="bench") as viewer:
+    ...  # requests targeted at "bench" are answered by viewer
+
+Requires requests and websocket-client.
+"""
+import json
+import threading
+import time
+
+# Synthetic atom records for SelectionPoll outputs
+ATOM_KEYS = ['auth_asym_id', 'label_asym_id', 'auth_comp_id', 'label_comp_id',
+  'auth_seq_id', 'label_seq_id', 'auth_atom_id', 'label_atom_id', 'label_alt_id', 'id', 'source_index']
+
+
+def atom_columns(n_atoms):
+  names = ['N', 'CA', 'C', 'O', 'CB']
+  return {
+    'auth_asym_id': ['A']*n_atoms,
+    'label_asym_id': ['A']*n_atoms,
+    'auth_comp_id': ['ALA']*n_atoms,
+    'label_comp_id': ['ALA']*n_atoms,
+    'auth_seq_id': [i//5 + 1 for i in range(n_atoms)],
+    'label_seq_id': [i//5 + 1 for i in range(n_atoms)],
+    'auth_atom_id': [names[i % 5] for i in range(n_atoms)],
+    'label_atom_id': [names[i % 5] for i in range(n_atoms)],
+    'label_alt_id': ['']*n_atoms,
+    'id': list(range(1, n_atoms + 1)),
+    'source_index': list(range(n_atoms)),
+  }
+
+
+def make_output(payload, n_selected=100):
+  """
+  The output of the viewer for a request payload: the request itself, with
+  the outputs of the api class filled in as the viewer would.
+  """
+  name, data = payload['name'], payload['data']
+  if name == 'LoadModel':
+    data['pdb_str'] = '' # The viewer does not echo the model back
+  elif name == 'SelectionPoll':
+    columns = atom_columns(n_selected)
+    data['ref_id'] = 'fake'
+    if data.get('ranges'):
+      data['atom_ranges'] = [0, n_selected] if n_selected else []
+    elif data.get('columnar'):
+      data['atom_columns'] = columns
+    else:
+      data['atom_records'] = [dict(zip(ATOM_KEYS, values))
+        for values in zip(*(columns[key] for key in ATOM_KEYS))]
+  elif name == 'MakeAtomSelection':
+    data['indices'] = ''
+    data['n_selected'] = data['n_atoms']
+  elif name == 'SetColorArray':
+    data['values'] = data['rgb'] = None # Nor the color arrays
+  elif name == 'LoadCachedModel':
+    data['found'] = False
+  elif name == 'ApiBatch':
+    data['commands'] = [make_output(command, n_selected) for command in data['commands']]
+  return payload
+
+
+class FakeViewer:
+  """
+  A headless viewer client. processed counts the requests answered.
+  """
+  def __init__(self, url, client_id="fake-viewer", respond=make_output, delay=0.0):
+    self.url = url
+    self.client_id = client_id
+    self.respond = respond
+    self.delay = delay # seconds of simulated work per request
+    self.processed = 0
+    self._ws = None
+    self._sse = None
+    self._threads = []
+    self._send_lock = threading.Lock()
+
+  def start(self, timeout=10):
+    try:
+      import requests
+      import websocket
+    except ImportError:
+      raise RuntimeError("Unable to import requests and websocket (websocket-client). \
+       They are required for FakeViewer.")
+    query = f"?client_id={self.client_id}"
+    self._ws = websocket.create_connection(
+      self.url.replace("http://", "ws://", 1) + "/" + query, timeout=timeout)
+    self._sse = requests.get(self.url + "/events" + query, stream=True, timeout=(timeout, None))
+    self._threads = [
+      threading.Thread(target=self._read_sse, daemon=True),
+      threading.Thread(target=self._read_ws, daemon=True),
+    ]
+    for thread in self._threads:
+      thread.start()
+    self._send({"event": "ready", "time": int(time.time()*1000)})
+
+  def stop(self):
+    if self._sse is not None:
+      self._sse.close()
+      self._sse = None
+    if self._ws is not None:
+      self._ws.close()
+      self._ws = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def _send(self, message):
+    with self._send_lock:
+      self._ws.send(json.dumps(message))
+
+  def _handle(self, text):
+    request_id = None
+    timing = {'client_receive': time.time()*1000}
+    try:
+      payload = json.loads(text)
+      request_id = payload.get('request_id')
+      if self.delay:
+        time.sleep(self.delay)
+      timing['run_start'] = time.time()*1000
+      output = self.respond(payload)
+      timing['run_end'] = timing['client_reply'] = time.time()*1000
+      response = {'status': 'Processed event', 'request_id': request_id, 'v': 2,
+        'timing': timing, 'output': output}
+    except Exception as e:
+      response = {'status': 'Error', 'request_id': request_id, 'timing': timing, 'error': str(e)}
+    self.processed += 1
+    self._send(response)
+
+  def _read_sse(self):
+    try:
+      for line in self._sse.iter_lines(decode_unicode=True):
+        if line and line.startswith("data: "):
+          self._handle(line[len("data: "):])
+    except Exception:
+      pass # stream closed
+
+  def _read_ws(self):
+    try:
+      while True:
+        text = self._ws.recv()
+        if not text:
+          break
+        self._handle(text)
+    except Exception:
+      pass # socket closed
@@ -0,0 +1,110 @@
+"""
+A minimal local stand-in for molstar/src/phenix/server.js, for timing the
+Python side of the api without node or a browser.
+
+POST /run echoes the request back inside the same response envelope that
+server.js produces after a viewer has processed it. GET /health reports a
+ready viewer, and GET / returns a tiny page.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_response(payload):
+  """
+  Wrap a request payload (dict) the way server.js + index.html do for a
+  successful round trip.
+  """
+  return {
+    "success": True,
+    "message": "All clients responded",
+    "request_id": payload.get("request_id"),
+    "responses": [
+      {"clientId": 0, "data": {"status": "Processed event",
+        "request_id": payload.get("request_id"), "v": 2, "output": payload}}
+    ]
+  }
+
+
+def make_response_v1(payload):
+  """
+  The envelope of version 1 viewers, where the output is json text that is
+  json encoded again
+  """
+  output = json.dumps(json.dumps(payload))
+  return {
+    "success": True,
+    "message": "All clients responded",
+    "responses": [
+      {"clientId": 0, "data": {"status": "Processed event", "output": output}}
+    ]
+  }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1" # keep-alive, as express does
+  disable_nagle_algorithm = True # node sets TCP_NODELAY as well
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send_json(self, obj, status=200):
+    body = json.dumps(obj).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path.startswith("/health"):
+      # A stand-in viewer is always ready
+      self._send_json({"status": "ok", "viewers": 1, "ready": True, "pending_requests": 0})
+      return
+    body = b"<html></html>"
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    payload = json.loads(self.rfile.read(length) or b"{}")
+    if self.path == "/run":
+      self._send_json(self.server.respond(payload))
+    else:
+      self._send_json({"success": False, "message": "Unknown endpoint"}, status=404)
+
+
+class StandInServer:
+  """
+  Context manager running the stand-in on a background thread.
+
+  Usage:
+    with StandInServer() as server:
+      requests.post(server.url + "/run", json=...)
+  """
+  def __init__(self, port=0, respond=make_response):
+    self.httpd = ThreadingHTTPServer(("localhost", port), StandInHandler)
+    self.httpd.daemon_threads = True
+    self.httpd.respond = respond
+    self.port = self.httpd.server_address[1]
+    self.url = f"http://localhost:{self.port}"
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
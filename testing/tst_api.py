@@ -1,9 +1,11 @@
 import tempfile
 from pathlib import Path
-from collections import defaultdictfrom cctbx.crystal.tst_super_cell import pdb_str_1yjp
+from collections import defaultdict
+from cctbx.crystal.tst_super_cell import pdb_str_1yjp
 from iotbx.cli_parser import run_program, get_program_params
 from libtbx.utils import null_out
 from molstar_adaptbx.programs import start_molstar_adapter
+from molstar_adaptbx.phenix.selection import SelectionRanges
 
 
 
@@ -38,8 +40,27 @@ atom_records_1yjp = {
 "id":
 [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66],
 
+"source_index":
+[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65],
+
 }
 
+# Two chains, each followed by a water. molstar sorts atoms by entity, so in
+#   the viewer both waters come after chain B, unlike their i_seqs.
+pdb_str_reordered = """\
+ATOM      1  N   GLY A   1      -9.009   4.612   6.102  1.00 16.77           N
+ATOM      2  CA  GLY A   1      -9.052   4.207   4.651  1.00 16.57           C
+ATOM      3  C   GLY A   1      -8.015   3.140   4.419  1.00 16.16           C
+ATOM      4  O   GLY A   1      -7.523   2.521   5.381  1.00 16.78           O
+HETATM    5  O   HOH A 101      -6.471   5.227   7.124  1.00 22.62           O
+ATOM      6  N   GLY B   1       1.009   4.612   6.102  1.00 16.77           N
+ATOM      7  CA  GLY B   1       1.052   4.207   4.651  1.00 16.57           C
+ATOM      8  C   GLY B   1       2.015   3.140   4.419  1.00 16.16           C
+ATOM      9  O   GLY B   1       2.523   2.521   5.381  1.00 16.78           O
+HETATM   10  O   HOH B 101       3.471   5.227   7.124  1.00 22.62           O
+END
+"""
+
 
 def tst_program_template():
 
@@ -93,10 +114,225 @@ def tst_poll_selection(graphics,printing=False):
     pdb.set_trace()
 
 
+def tst_poll_selection_columnar(graphics):
+  columns = graphics.poll_selection(columnar=True)
+  assert columns.columns == atom_records_1yjp
+  assert len(columns) == len(atom_records_1yjp["id"])
+  assert columns.records() == graphics.poll_selection()
+
+
+def tst_poll_cctbx_selection(graphics):
+  ref_id, isel = graphics.poll_cctbx_selection(iselection=True)
+  model = graphics.dm.get_model(filename=graphics.loaded[ref_id])
+  atoms = model.get_hierarchy().atoms()
+  assert list(isel) == list(range(atoms.size()))
+  # Without source_index, atoms are matched by chain, residue and name
+  columns = dict(graphics.poll_selection(columnar=True).columns)
+  del columns["source_index"]
+  assert list(graphics.atom_index(ref_id).iselection(columns)) == list(isel)
+  ref_id, sel = graphics.poll_cctbx_selection()
+  assert sel.count(True) == atoms.size()
+
+
+def tst_select_atoms(graphics):
+  # Select scattered atoms by index, and read them back
+  ref_id = list(graphics.loaded.keys())[0]
+  model = graphics.dm.get_model(filename=graphics.loaded[ref_id])
+  n_atoms = model.get_number_of_atoms()
+  i_seqs = list(range(0, n_atoms, 7))
+  assert graphics.select_atoms(ref_id, i_seqs, focus=False) == len(i_seqs)
+  ref_id, isel = graphics.poll_cctbx_selection(iselection=True)
+  assert list(isel) == i_seqs
+  serials = [int(atom.serial) for atom in model.get_hierarchy().atoms()[:5]]
+  assert graphics.select_atoms(ref_id, serials, by='id') == 5
+
+
+def tst_selection_ranges(graphics):
+  # Select two runs of atoms, and read them back as runs
+  ref_id = list(graphics.loaded.keys())[0]
+  model = graphics.dm.get_model(filename=graphics.loaded[ref_id])
+  n_atoms = model.get_number_of_atoms()
+  ranges = SelectionRanges([(0, n_atoms//4), (n_atoms//2, n_atoms//2 + 10)], ref_id=ref_id)
+  graphics.select_atoms(ref_id, ranges, focus=False)
+  polled = graphics.poll_selection_ranges()
+  assert polled == ranges, (polled.runs, ranges.runs)
+  assert polled.ref_id == ref_id
+  assert list(polled.iselection()) == list(ranges.iter_indices())
+  assert (polled & SelectionRanges.from_selection([1, 2, 3, n_atoms - 1])).runs == [(1, 4)]
+
+
+def tst_selection_cache(graphics):
+  graphics.selection_cache_info(clear=True)
+  for i in range(3):
+    graphics.select("chain A and resseq 1:3")
+  info = graphics.selection_cache_info()
+  assert info["python"]["misses"] == 1 and info["python"]["hits"] == 2, info
+  assert info["viewer"]["hits"] >= 2, info
+
+
 def tst_select_none(graphics):
   graphics.select_none()
 
+
+def tst_update_coordinates(graphics):
+  ref_id = list(graphics.loaded.keys())[0]
+  model = graphics.dm.get_model(filename=graphics.loaded[ref_id])
+  sites_cart = model.get_sites_cart() + (1.0, 0.0, 0.0)
+  graphics.update_coordinates(ref_id, sites_cart)
+  graphics.update_coordinates(ref_id) # back to the original
+
+
+def tst_color_by_array(graphics):
+  ref_id = list(graphics.loaded.keys())[0]
+  model = graphics.dm.get_model(filename=graphics.loaded[ref_id])
+  graphics.color_by_array(ref_id, values=model.get_b_iso(), color_scale=["blue", "white", "red"])
+  n_residues = len(list(model.get_hierarchy().residue_groups()))
+  graphics.color_by_array(ref_id, colors=["green"]*n_residues, per="residue")
+  graphics.clear_color_array(ref_id)
+
+
+def tst_stream_trajectory(graphics):
+  ref_id = list(graphics.loaded.keys())[0]
+  model = graphics.dm.get_model(filename=graphics.loaded[ref_id])
+  sites_cart = model.get_sites_cart()
+  frames = (sites_cart + (0.1*i, 0.0, 0.0) for i in range(40))
+  n_frames = graphics.stream_trajectory(ref_id, frames, chunk_size=8, capacity=16, fps=50)
+  assert n_frames == 40
+
+
+def tst_batch(graphics):
+  with graphics.batch() as batch:
+    graphics.select_all()
+    graphics.focus()
+    graphics.poll_selection()
+  # select_all sends select_none first
+  names = [command.__class__.__name__ for command in batch.commands]
+  assert names == ["MakeSelection", "MakeSelection", "Focus", "SelectionPoll"], names
+  assert len(batch.commands[-1].atom_records) == len(atom_records_1yjp["id"])
+
+def tst_response_envelope():
+  # Version 2 (single encoded) and version 1 (double encoded) responses
+  from molstar_adaptbx.phenix.api import ApiRequest, SetColor
+  from molstar_adaptbx.testing.standin_server import make_response, make_response_v1
+  request = ApiRequest(SetColor(color_string="blue"), request_id="1")
+  for make in [make_response, make_response_v1]:
+    response = ApiRequest.from_response_dict(make(request.to_dict()))
+    assert response.data == request.data
+  assert ApiRequest.from_json(request.to_json()).request_id == "1"
+
+def tst_atom_selection_inputs():
+  # Boolean masks become indices, negative indices are rejected
+  import numpy as np
+  from molstar_adaptbx.phenix.api import MakeAtomSelection
+  from molstar_adaptbx.phenix.selection import selection_indices
+  assert SelectionRanges.from_selection(np.array([True, False, True])).runs == [(0, 1), (2, 3)]
+  try:
+    SelectionRanges.from_selection([-1, 0])
+  except ValueError:
+    pass
+  else:
+    raise AssertionError("Negative index accepted by SelectionRanges")
+  mask = np.array([True, False, True])
+  assert list(selection_indices(mask)) == [0, 2]
+  assert MakeAtomSelection.from_selection("ref", mask).n_atoms == 2
+  assert selection_indices([True, False, True]) == [0, 2]
+  for bad in [[-1, 0], np.array([-1, 0])]:
+    try:
+      MakeAtomSelection.from_selection("ref", bad)
+    except ValueError:
+      pass
+    else:
+      raise AssertionError(f"Negative index accepted: {bad}")
+
+def tst_sync_remote(graphics):
+  # The first sync may be a snapshot, later ones only carry new changes
+  graphics.sync_remote()
+  version = graphics.viewer_state.version
+  assert len(graphics.viewer_state.references) > 0
+  for record in list(graphics.viewer_state.by_phenix_key.values()):
+    assert graphics.viewer_state.get_by_molstar_key(record.molstarKey) is record
+  result = graphics.sync_remote()
+  assert result.changes == []
+  assert graphics.viewer_state.version == version
+
+def tst_metrics(graphics):
+  # Every call is timed end to end and per stage
+  graphics.metrics.clear()
+  tst_focus(graphics)
+  assert graphics.last_timing["total"] >= 0
+  assert graphics.last_timing["run"] >= 0
+  summary = graphics.metrics.summary()
+  assert summary["Focus"]["total"]["count"] == 1
+  assert "Focus" in graphics.metrics.report()
+  # Negative durations (clocks out of step) and NaN are skipped, as in server.js
+  graphics.metrics.record("Focus", {"total": -1.0, "run": float("nan")})
+  assert graphics.metrics.summary()["Focus"]["total"]["count"] == 1
+
+def load_reordered_model(graphics):
+  # Load pdb_str_reordered once, return its ref_id
+  filename = "reordered.pdb"
+  if filename not in graphics.loaded.values():
+    graphics.dm.process_model_str(filename, pdb_str_reordered)
+    graphics.load_model(filename=filename)
+  ref_id = [ref_id for ref_id, name in graphics.loaded.items() if name == filename][-1]
+  return ref_id, graphics.dm.get_model(filename=filename)
+
+def tst_reordered_model(graphics):
+  # Atom indices sent to and read from the viewer are i_seqs, whatever the
+  #   viewer's own atom order
+  ref_id, model = load_reordered_model(graphics)
+  n_atoms = model.get_number_of_atoms()
+  assert graphics.select_atoms(ref_id, range(n_atoms), focus=False) == n_atoms
+  ids = graphics.poll_selection(columnar=True)["id"]
+  assert ids != sorted(ids), ids # reordered by the viewer
+  waters = [atom.i_seq for atom in model.get_hierarchy().atoms() if atom.parent().resname == "HOH"]
+  assert waters == [4, 9]
+  assert graphics.select_atoms(ref_id, waters, focus=False) == 2
+  assert set(graphics.poll_selection(columnar=True)["auth_comp_id"]) == {"HOH"}
+  assert list(graphics.poll_cctbx_selection(iselection=True)[1]) == waters
+  # Chain A with its water is one run of i_seqs, but two runs in the viewer
+  ranges = SelectionRanges([(0, 5)], ref_id=ref_id)
+  graphics.select_atoms(ref_id, ranges, focus=False)
+  assert set(graphics.poll_selection(columnar=True)["auth_asym_id"]) == {"A"}
+  assert graphics.poll_selection_ranges() == ranges
+  assert list(graphics.poll_cctbx_selection(iselection=True)[1]) == list(range(5))
+  graphics.select_none()
+  # Colors follow i_seqs and residue_groups(), here chains blue and waters red
+  hierarchy = model.get_hierarchy()
+  graphics.color_by_array(ref_id, colors=["red" if atom.parent().resname == "HOH" else "blue"
+    for atom in hierarchy.atoms()])
+  graphics.color_by_array(ref_id, colors=["red" if rg.atom_groups()[0].resname == "HOH" else "blue"
+    for rg in hierarchy.residue_groups()], per="residue")
+  graphics.clear_color_array(ref_id)
+
+def tst_model_fingerprint(graphics):
+  # Models differing only in altloc or charge must not share a model_cache entry
+  line = pdb_str_reordered.splitlines()[0]
+  variants = {
+    "base": line,
+    "altloc": line[:16] + "A" + line[17:],
+    "charge": line[:78] + "1+",
+  }
+  fingerprints = set()
+  for label, text in variants.items():
+    filename = f"fingerprint_{label}.pdb"
+    graphics.dm.process_model_str(filename, text + "\n")
+    fingerprints.add(graphics._model_fingerprint(graphics.dm.get_model(filename=filename)))
+  assert len(fingerprints) == len(variants)
+
+def tst_load_model_handshake(graphics):
+  # New content is sent directly, a reload first asks for the viewer's copy
+  graphics.dm.process_model_str("handshake.pdb", pdb_str_reordered.replace("22.62", "22.63"))
+  graphics.metrics.clear()
+  graphics.load_model(filename="handshake.pdb")
+  assert set(graphics.metrics.summary()) == {"LoadModel"}
+  graphics.metrics.clear()
+  graphics.load_model(filename="handshake.pdb")
+  assert set(graphics.metrics.summary()) == {"LoadCachedModel"}
+
 if __name__ == '__main__':
+  tst_response_envelope()
+  tst_atom_selection_inputs()
   task = tst_program_template()
   graphics = task.graphics
   tst_select_all(graphics)
@@ -106,6 +342,20 @@ if __name__ == '__main__':
   tst_selection_mode_off(graphics)
   tst_select_all(graphics)
   tst_poll_selection(graphics)
+  tst_poll_selection_columnar(graphics)
+  tst_poll_cctbx_selection(graphics)
+  tst_select_atoms(graphics)
+  tst_selection_ranges(graphics)
+  tst_selection_cache(graphics)
   tst_select_none(graphics)
   tst_picking_granularity(graphics)
+  tst_batch(graphics)
+  tst_update_coordinates(graphics)
+  tst_color_by_array(graphics)
+  tst_stream_trajectory(graphics)
+  tst_sync_remote(graphics)
+  tst_reordered_model(graphics)
+  tst_model_fingerprint(graphics)
+  tst_load_model_handshake(graphics)
+  tst_metrics(graphics)
   print('OK')
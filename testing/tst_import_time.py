@@ -0,0 +1,89 @@
+"""
+Import-time budget for the molstar_adaptbx.phenix modules.
+
+Each module is imported in a fresh interpreter with -X importtime. The test
+fails if its cumulative import time goes over budget, or if it pulls in a
+dependency that should only be imported on first use. Modules with a heavy
+required dependency (see BASELINES) import it first, so their budget only
+covers the time spent in this package.
+
+  python tst_import_time.py [scale]
+
+scale multiplies every budget, for slow machines.
+"""
+import re
+import subprocess
+import sys
+
+# module: cumulative import budget in ms
+BUDGETS = {
+  "molstar_adaptbx.phenix.colors": 20,
+  "molstar_adaptbx.phenix.cache": 20,
+  "molstar_adaptbx.phenix.metrics": 20,
+  "molstar_adaptbx.phenix.selection": 20,
+  "molstar_adaptbx.phenix.api": 100,
+  "molstar_adaptbx.phenix.server_utils": 50,
+  "molstar_adaptbx.phenix.molstar_async": 100,
+  # Excluding qttbx and libtbx, see BASELINES
+  "molstar_adaptbx.phenix.molstar": 200,
+}
+
+# module: required dependencies, imported before it so that neither their
+#   import time nor their own imports are held against it. qttbx.viewers
+#   provides ModelViewer, the base class, so it is imported eagerly.
+BASELINES = {
+  "molstar_adaptbx.phenix.molstar": ["qttbx.viewers", "libtbx.utils"],
+}
+
+# Only imported when first used
+DEFERRED = ["matplotlib", "requests", "webbrowser", "aiohttp", "websocket", "numpy"]
+
+N_RUNS = 3 # the fastest run is used, to reduce noise
+
+
+def import_time(module, baseline=()):
+  """
+  Return (cumulative import time in ms, set of modules imported). Modules in
+  baseline are imported first, so the time excludes them and what they import.
+  """
+  preload = "".join(f"import {name}; " for name in baseline)
+  code = f"import sys; {preload}import {module}; print(' '.join(sys.modules))"
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+    capture_output=True, text=True)
+  if result.returncode != 0:
+    raise RuntimeError(f"Unable to import {module}:\n{result.stderr}")
+  cumulative = None
+  for line in result.stderr.splitlines():
+    m = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$", line)
+    if m and m.group(2) == module:
+      cumulative = int(m.group(1))/1000
+  return cumulative, set(result.stdout.split())
+
+
+def tst_import_time(scale=1.0):
+  failures = []
+  for module, budget in BUDGETS.items():
+    baseline = BASELINES.get(module, [])
+    times = []
+    for i in range(N_RUNS):
+      ms, imported = import_time(module, baseline)
+      times.append(ms)
+    ms = min(times)
+    note = f", excluding {', '.join(baseline)}" if baseline else ""
+    print(f"{module:<40} {ms:8.1f} ms  (budget {budget*scale:.0f} ms{note})")
+    if ms > budget*scale:
+      failures.append(f"{module} took {ms:.1f} ms to import{note}, budget is {budget*scale:.0f} ms")
+    for name in baseline:
+      dependency_ms, dependency_imported = import_time(name)
+      print(f"  {name:<38} {dependency_ms:8.1f} ms  (dependency, not budgeted)")
+      imported -= dependency_imported
+    for name in DEFERRED:
+      if name in imported:
+        failures.append(f"{module} imports {name}, which should be deferred to first use")
+  assert not failures, "\n".join(failures)
+
+
+if __name__ == '__main__':
+  scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+  tst_import_time(scale)
+  print('OK')